@@ -1,21 +1,12 @@
+import mmap
 import os
-from typing import Any, Callable, cast, Dict, List, Tuple, Union  # noqa
+from typing import Any, Callable, cast, Dict, Iterable, Iterator, List, Tuple, Union  # noqa
 
 
+from . import metrics, registry
 from .constants import SYSEX_START_BYTE, SYSEX_END_BYTE, EXTENDED_MANUFACTURER_ID_BYTE
-from .formats import yamaha
 from .errors import ParseError, NotSupportedError
-
-_PARSERS = {
-    yamaha.MANUFACTURER_ID: yamaha.parse
-}  # type: Dict[Tuple[int,...], Callable]
-
-# This is a map from strings to modules, but typing annotations don't seem to
-# know about modules, so I'm annotating it as having "any" as its value type
-# TODO: is there a more elegant way of doing this?
-_FORMAT_MODULES = {
-    'yamaha': yamaha
-}  # type: Dict[str, Any]
+from .stream import DEFAULT_CHUNK_SIZE, iter_messages, SysExSplitter  # noqa
 
 
 def byte_to_int(byte) -> int:
@@ -26,71 +17,137 @@ def int_to_byte(i: int) -> bytes:
     return i.to_bytes(1, byteorder='little')
 
 
-def parse(sysex_file, **kwargs) -> List[Dict[str, Any]]:
-    with open(sysex_file, 'rb') as fp:
+def _parse_buffer(buf: memoryview, **kwargs) -> List[Dict[str, Any]]:
+    with metrics.timed('dispatch'):
         # Check that the sysex message looks basically valid (i.e. that it starts
         # and ends with the expected SysEx control bytes)
-
-        first_byte = byte_to_int(fp.read(1))
-
-        if first_byte != SYSEX_START_BYTE:
+        if len(buf) == 0 or buf[0] != SYSEX_START_BYTE:
             raise ParseError('Expected SysEx message to start with 0xf0')
 
-        fp.seek(-1, os.SEEK_END)
-        last_byte = byte_to_int(fp.read(1))
-
-        if last_byte != SYSEX_END_BYTE:
+        if buf[-1] != SYSEX_END_BYTE:
             raise ParseError('Expected SysEx message to end in 0xf7')
 
         # Extract the manufacturer ID (which is either 1 or 3 bytes long,
         # depending on which manufacturer we're dealing with
-        fp.seek(1, os.SEEK_SET)
+        manufacturer_id = (buf[1],)  # type: Tuple[int,...]
+
+        if manufacturer_id[0] == EXTENDED_MANUFACTURER_ID_BYTE:
+            manufacturer_id += tuple(buf[2:4])
+
+        # The non-control SysEx bytes. This is a view onto buf, not a copy
+        sysex_bytes = buf[1 + len(manufacturer_id):-1]
+
+        # The format is worked out from the message's header, unless the
+        # caller knows better. The header is copied out so that an error's
+        # traceback doesn't keep a view of buf alive (which would stop an
+        # mmap'd file from being closed)
+        model_hint = kwargs.pop('model_hint', None)
+
+        try:
+            if model_hint is None:
+                fmt = registry.detect_format(manufacturer_id, bytes(sysex_bytes[:4]))
+            else:
+                fmt = registry.get_format(registry.manufacturer(manufacturer_id), model_hint)
+        except Exception:
+            sysex_bytes.release()
+            raise
+
+    # Pass them to the appropriate parser
+    try:
+        return registry.load(fmt).parse(sysex_bytes, **kwargs)
+    finally:
+        sysex_bytes.release()
+
+
+def parse(sysex_file: Union[str, bytes, bytearray, memoryview], use_mmap: bool = True,
+          **kwargs) -> List[Dict[str, Any]]:
+    # In-memory messages are parsed where they are
+    if isinstance(sysex_file, (bytes, bytearray, memoryview)):
+        with memoryview(sysex_file) as buf:
+            return _parse_buffer(buf, **kwargs)
+
+    with open(sysex_file, 'rb') as fp:
+        if not use_mmap or os.fstat(fp.fileno()).st_size == 0:
+            with metrics.timed('read'):
+                contents = fp.read()
 
-        manufacturer_id = (byte_to_int(fp.read(1)),)  # type: Tuple[int,...]
+            return _parse_buffer(memoryview(contents), **kwargs)
 
-        if manufacturer_id == EXTENDED_MANUFACTURER_ID_BYTE:
-            manufacturer_id += tuple(map(byte_to_int, fp.read(2)))
+        # Memory-map the file so that large dumps aren't copied into memory
+        # just to be sliced up again. Pages are read as they're touched, so
+        # most of the reading shows up in whatever touches them first
+        with metrics.timed('read'):
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
 
-        if manufacturer_id not in _PARSERS:
-            raise NotSupportedError("Manufacturer ID for this SysEx (%s) not supported" %
-                                    (manufacturer_id))
+        with mapped:
+            with memoryview(mapped) as buf:
+                return _parse_buffer(buf, **kwargs)
 
-        # Read the non-control SysEx bytes and pass them to the appropriate parser
-        sysex_bytes = fp.read(os.path.getsize(sysex_file) - len(manufacturer_id) - 2)
 
-        return _PARSERS[manufacturer_id](sysex_bytes, **kwargs)
+def parse_messages(stream, skip_unsupported: bool = True, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   **kwargs) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+    # Parses every SysEx message in a stream (see iter_messages), lazily,
+    # yielding (offset, voices) pairs. Messages from manufacturers without a
+    # parser are skipped unless skip_unsupported is False.
+    for offset, message in iter_messages(stream, chunk_size=chunk_size):
+        try:
+            with memoryview(message) as buf:
+                voices = _parse_buffer(buf, **kwargs)
+        except NotSupportedError:
+            if skip_unsupported:
+                continue
 
+            raise
 
-def dump(parsed_sysex: List[Dict[str, Any]], sysex_file: str):
-    manufacturer = parsed_sysex[0]['MANUFACTURER']
+        yield offset, voices
 
-    format_lib = _FORMAT_MODULES[manufacturer]
 
-    with open(sysex_file, 'wb') as fp:
-        fp.write(SYSEX_START_BYTE.to_bytes(1, byteorder='little'))
+def dumps(parsed_sysex: Union[Dict[str, Any], List[Dict[str, Any]]], **kwargs) -> bytes:
+    # A list of voices becomes a multi-voice message; a single voice on its
+    # own becomes a single-voice message
+    first_voice = parsed_sysex[0] if isinstance(parsed_sysex, list) else parsed_sysex
+    fmt = registry.get_format(first_voice['MANUFACTURER'], first_voice['MODEL'])
 
-        for id_chunk in format_lib.MANUFACTURER_ID:
-            fp.write(id_chunk.to_bytes(1, byteorder='little'))
+    return b''.join((bytes([SYSEX_START_BYTE]), bytes(fmt.manufacturer_id),
+                     registry.load(fmt).dump(parsed_sysex, **kwargs), bytes([SYSEX_END_BYTE])))
 
-        dumped_bytes = format_lib.dump(parsed_sysex)
-        fp.write(dumped_bytes)
 
-        fp.write(SYSEX_END_BYTE.to_bytes(1, byteorder='little'))
-        fp.flush()
+def dump(parsed_sysex: Union[Dict[str, Any], List[Dict[str, Any]]], sysex_file: str, **kwargs):
+    sysex_bytes = dumps(parsed_sysex, **kwargs)
+
+    with metrics.timed('write'):
+        with open(sysex_file, 'wb') as fp:
+            fp.write(sysex_bytes)
+
+
+def dump_many(items: Iterable[Tuple[Union[Dict[str, Any], List[Dict[str, Any]]], str]], **kwargs) -> int:
+    # Writes many messages, each given as a (parsed_sysex, sysex_file) pair,
+    # with a single buffered write per file. Returns the number of files
+    # written.
+    count = 0
+
+    for parsed_sysex, sysex_file in items:
+        sysex_bytes = dumps(parsed_sysex, **kwargs)
+
+        with metrics.timed('write'):
+            with open(sysex_file, 'wb', buffering=len(sysex_bytes)) as fp:
+                fp.write(sysex_bytes)
+
+        count += 1
+
+    return count
 
 
 def add_headers_and_footers(bank_file: str, manufacturer: str, model: str) -> bytes:
     with open(bank_file, 'rb') as fp:
-        bank_bytes = fp.read()
-
-        if manufacturer not in _FORMAT_MODULES:
-            raise NotSupportedError('Manufacturer %s is not supported' % (manufacturer))
+        with metrics.timed('read'):
+            bank_bytes = fp.read()
 
-        format_lib = _FORMAT_MODULES[manufacturer]
+        fmt = registry.get_format(manufacturer, model)
 
-        complete_sysex_msg = format_lib.add_headers_and_footers(bank_bytes, model)
+        complete_sysex_msg = registry.load(fmt).add_headers_and_footers(bank_bytes)
 
         header_bytes = [SYSEX_START_BYTE]
-        header_bytes.extend(format_lib.MANUFACTURER_ID)
+        header_bytes.extend(fmt.manufacturer_id)
 
         return bytes(header_bytes) + complete_sysex_msg + bytes([SYSEX_END_BYTE])
@@ -0,0 +1,216 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+import os
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple, Union  # noqa
+
+from . import dumps, parse
+from .errors import NotSupportedError, ParseError
+from .stream import DEFAULT_CHUNK_SIZE, SysExSplitter
+
+# An asyncio front end to parse() and dumps(), for services that take SysEx
+# uploads. Decoding and encoding are CPU-bound, so they run on an executor
+# (a thread pool of its own unless one is passed in; a ProcessPoolExecutor
+# gets around the GIL, at the cost of pickling voices back and forth). Files
+# are read on asyncio's default executor, so reads never queue up behind
+# decoding, and uploads are read from their streams without blocking.
+#
+# No more than max_pending messages are ever being decoded or waiting to be:
+# past that, callers wait for a slot, and ingest() stops pulling uploads from
+# its source until one frees up.
+#
+#     async with AsyncSysEx(max_workers=4) as sysex:
+#         voices = await sysex.parse_bytes(upload)
+#
+# Errors are the same as parse()'s and dumps()'s.
+
+DEFAULT_MAX_PENDING = 16
+
+Source = Union[bytes, bytearray, memoryview, asyncio.StreamReader]
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+
+def _scan_directory(directory: str) -> List[Tuple[str, str]]:
+    # Every .syx file under directory, as (relative path, path) pairs
+    found = []
+
+    for root, dirs, filenames in os.walk(directory):
+        dirs.sort()
+
+        for filename in sorted(filenames):
+            if filename.lower().endswith('.syx'):
+                path = os.path.join(root, filename)
+                found.append((os.path.relpath(path, directory), path))
+
+    return found
+
+
+class AsyncSysEx(object):
+    def __init__(self, executor: Optional[Executor] = None, max_workers: Optional[int] = None,
+                 max_pending: int = DEFAULT_MAX_PENDING):
+        self._owns_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers)
+        self.max_pending = max_pending
+        # Semaphores belong to an event loop, so there's one per loop this is
+        # used from
+        self._slots = {}  # type: Dict[asyncio.AbstractEventLoop, asyncio.Semaphore]
+
+    async def __aenter__(self) -> 'AsyncSysEx':
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+
+    async def _run(self, fn: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        slots = self._slots.get(loop)
+
+        if slots is None:
+            # Forget about loops that have since closed
+            self._slots = {other: other_slots for other, other_slots in self._slots.items() if not other.is_closed()}
+            slots = self._slots[loop] = asyncio.Semaphore(self.max_pending)
+
+        async with slots:
+            return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    async def parse_bytes(self, data: Union[bytes, bytearray, memoryview], **kwargs) -> List[Dict[str, Any]]:
+        # Memoryviews can't be pickled, so they're copied in case the executor
+        # is a process pool
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        return await self._run(parse, data, **kwargs)
+
+    async def dump_bytes(self, parsed_sysex: Union[Dict[str, Any], List[Dict[str, Any]]], **kwargs) -> bytes:
+        return await self._run(dumps, parsed_sysex, **kwargs)
+
+    async def parse_file(self, sysex_file: str, **kwargs) -> List[Dict[str, Any]]:
+        data = await asyncio.get_running_loop().run_in_executor(None, _read_file, sysex_file)
+
+        return await self.parse_bytes(data, **kwargs)
+
+    async def parse_stream(self, reader: asyncio.StreamReader, skip_unsupported: bool = True,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE,
+                           **kwargs) -> AsyncIterator[Tuple[int, List[Dict[str, Any]]]]:
+        # The asynchronous counterpart of parse_messages(): parses every SysEx
+        # message in a stream as it arrives, yielding (offset, voices) pairs
+        splitter = SysExSplitter()
+
+        while True:
+            chunk = await reader.read(chunk_size)
+
+            if not chunk:
+                break
+
+            for offset, message in splitter.feed(chunk):
+                try:
+                    voices = await self.parse_bytes(message, **kwargs)
+                except NotSupportedError:
+                    if skip_unsupported:
+                        continue
+
+                    raise
+
+                yield offset, voices
+
+    async def _parse_source(self, name: str, source: Union[str, Source],
+                            **kwargs) -> Tuple[str, Optional[List[Dict[str, Any]]], Optional[Exception]]:
+        try:
+            if isinstance(source, str):
+                voices = await self.parse_file(source, **kwargs)
+            else:
+                if isinstance(source, asyncio.StreamReader):
+                    source = await source.read()
+
+                voices = await self.parse_bytes(source, **kwargs)
+        except (ParseError, NotSupportedError) as e:
+            return name, None, e
+
+        return name, voices, None
+
+    async def ingest(self, sources: Union[str, AsyncIterator[Tuple[str, Source]], Any],
+                     **kwargs) -> AsyncIterator[Tuple[str, Optional[List[Dict[str, Any]]], Optional[Exception]]]:
+        # Parses many messages concurrently. sources is either a directory, in
+        # which case every .syx file under it is parsed, or an iterable or
+        # asynchronous iterable of (name, upload) pairs, where an upload is
+        # either the message itself or a stream to read it from. Yields
+        # (name, voices, error) triples as parsing finishes, which may not be
+        # in the order the sources came in; error is the ParseError or
+        # NotSupportedError a source failed with, if it did, so that one bad
+        # upload doesn't take the rest down with it. Any other error is
+        # raised.
+        if isinstance(sources, str):
+            sources = await asyncio.get_running_loop().run_in_executor(None, _scan_directory, sources)
+
+        if hasattr(sources, '__aiter__'):
+            source_iterator = sources.__aiter__()
+        else:
+            source_iterator = _aiter(sources)
+
+        pending = set()  # type: Set[asyncio.Task]
+        exhausted = False
+
+        try:
+            while pending or not exhausted:
+                # Only pull another source when there's room for it
+                while not exhausted and len(pending) < self.max_pending:
+                    try:
+                        name, source = await source_iterator.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+
+                    pending.add(asyncio.ensure_future(self._parse_source(name, source, **kwargs)))
+
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+async def _aiter(iterable) -> AsyncIterator:
+    for item in iterable:
+        yield item
+
+
+# A shared instance for the module-level functions below, created on first use
+_default = None  # type: Optional[AsyncSysEx]
+
+
+def _default_instance() -> AsyncSysEx:
+    global _default
+
+    if _default is None:
+        _default = AsyncSysEx()
+
+    return _default
+
+
+async def parse_bytes(data: Union[bytes, bytearray, memoryview], **kwargs) -> List[Dict[str, Any]]:
+    return await _default_instance().parse_bytes(data, **kwargs)
+
+
+async def dump_bytes(parsed_sysex: Union[Dict[str, Any], List[Dict[str, Any]]], **kwargs) -> bytes:
+    return await _default_instance().dump_bytes(parsed_sysex, **kwargs)
+
+
+async def parse_file(sysex_file: str, **kwargs) -> List[Dict[str, Any]]:
+    return await _default_instance().parse_file(sysex_file, **kwargs)
+
+
+def ingest(sources, **kwargs) -> AsyncIterator[Tuple[str, Optional[List[Dict[str, Any]]], Optional[Exception]]]:
+    return _default_instance().ingest(sources, **kwargs)
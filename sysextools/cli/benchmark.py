@@ -0,0 +1,259 @@
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple  # noqa
+
+from .. import dumps, parse
+from ..constants import SYSEX_END_BYTE, SYSEX_START_BYTE
+from ..formats.yamaha import dx7, MANUFACTURER_ID
+from ..formats.yamaha.dx7.layout import packed_layout
+from ..formats.yamaha.dx7.native import normalize_voice
+from ..formats.yamaha.dx7.ranges import valid_raw_values
+
+# Benchmarks for the hot paths: parsing, dumping, signatures, checksums and
+# building a patch bank. Everything runs on synthetic voices generated
+# deterministically from the DX7's parameter ranges in spec.py, so results are
+# comparable from one run (and one commit) to the next, and nothing needs
+# fetching.
+
+RESULTS_VERSION = 1
+
+# Printable ASCII, which every name encoding can cope with
+_NAME_CHARACTERS = bytes(range(0x20, 0x7f))
+
+
+def synthetic_voice(rng: random.Random) -> bytes:
+    # A random voice in the packed (128-byte) layout, with every field set to
+    # one of the values the DX7 accepts for it. That keeps every byte below
+    # 0x80, as it has to be in a SysEx message
+    layout = packed_layout()
+    data = bytearray(layout.size)
+
+    for field in layout.fields:
+        data[field.byte] |= rng.choice(valid_raw_values(field)) << field.shift
+
+    data[layout.name_offset:layout.name_offset + layout.name_length] = bytes(
+        rng.choice(_NAME_CHARACTERS) for _ in range(layout.name_length))
+
+    return bytes(data)
+
+
+def _message(header: bytes, data: bytes) -> bytes:
+    body = header + data
+    body += bytes([dx7.compute_checksum(body, offset_end=0)])
+
+    return bytes([SYSEX_START_BYTE]) + bytes(MANUFACTURER_ID) + body + bytes([SYSEX_END_BYTE])
+
+
+def synthetic_bank(rng: random.Random) -> bytes:
+    # A complete 32-voice SysEx message
+    return _message(dx7.MULTI_VOICE_HEADER, b''.join(synthetic_voice(rng) for _ in range(32)))
+
+
+def synthetic_single_voice(rng: random.Random) -> bytes:
+    # A complete single-voice SysEx message
+    return _message(dx7.SINGLE_VOICE_HEADER, normalize_voice(synthetic_voice(rng), 0, packed_layout()))
+
+
+def _measure(fn: Callable[[], Any], repeat: int) -> Tuple[float, int]:
+    # The best of repeat timed runs, and the peak memory allocated during an
+    # untimed one (tracemalloc slows everything down too much to time with it
+    # switched on)
+    timings = []
+
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return min(timings), peak
+
+
+def _measure_startup(module: Optional[str], repeat: int, sysex_files: List[str]) -> float:
+    # The best of repeat runs of a fresh interpreter importing module and then
+    # parsing each of sysex_files, which is most of what it costs a
+    # command-line tool to get going: much of the work of setting up a parser
+    # is left until it's first used. With no module, this is the cost of
+    # starting Python itself.
+    if module is None:
+        code = 'pass'
+    else:
+        code = 'import %s; import sysextools; [sysextools.parse(f) for f in %r]' % (module, sysex_files)
+
+    command = [sys.executable, '-c', code]
+    timings = []
+
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        subprocess.run(command, check=True)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+# The modules behind each of the command-line tools in bin/
+STARTUP_MODULES = ('sysextools', 'sysextools.cli.build_patch_bank', 'sysextools.cli.extract_voices',
+                   'sysextools.cli.migrate_signatures', 'sysextools.cli.storage')
+
+
+def _result(seconds: float, peak_memory: Optional[int], num_voices: int, num_bytes: int) -> dict:
+    return {
+        'seconds': seconds,
+        'voices_per_second': num_voices / seconds if seconds and num_voices else None,
+        'mb_per_second': num_bytes / seconds / (1 << 20) if seconds and num_bytes else None,
+        'peak_memory_bytes': peak_memory,
+        'voices': num_voices,
+        'bytes': num_bytes
+    }
+
+
+def _build_corpus(corpus_dir: str, banks: List[bytes], singles: List[bytes]):
+    # Laid out the way build_patch_bank expects, with a directory per author
+    for i, message in enumerate(banks + singles):
+        author_dir = os.path.join(corpus_dir, 'author{:02d}'.format(i % 8))
+        os.makedirs(author_dir, exist_ok=True)
+
+        with open(os.path.join(author_dir, 'sysex{:05d}.syx'.format(i)), 'wb') as fp:
+            fp.write(message)
+
+
+def run_benchmarks(num_banks: int = 32, num_singles: int = 256, seed: int = 0, repeat: int = 3,
+                   stages: Optional[List[str]] = None) -> dict:
+    from .build_patch_bank import build_patch_bank
+
+    rng = random.Random(seed)
+    banks = [synthetic_bank(rng) for _ in range(num_banks)]
+    singles = [synthetic_single_voice(rng) for _ in range(num_singles)]
+
+    bank_voices = [voice for bank in banks for voice in parse(bank)]
+    bank_lists = [parse(bank) for bank in banks]
+    single_voices = [voice for single in singles for voice in parse(single)]
+
+    bank_bytes = sum(len(bank) for bank in banks)
+    single_bytes = sum(len(single) for single in singles)
+    dumped_bank_bytes = sum(len(dumps(voices)) for voices in bank_lists)
+    dumped_single_bytes = sum(len(dumps(voice)) for voice in single_voices)
+
+    def build():
+        temp_dir = tempfile.mkdtemp(prefix='sysextools-benchmark-')
+
+        try:
+            corpus_dir = os.path.join(temp_dir, 'corpus')
+            output_dir = os.path.join(temp_dir, 'bank')
+            os.mkdir(output_dir)
+            _build_corpus(corpus_dir, banks, singles)
+            build_patch_bank(corpus_dir, output_dir)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    # stage name -> (function, voices processed, bytes processed)
+    benchmarks = {
+        'parse_bank[native]': (lambda: [parse(bank, engine='native') for bank in banks],
+                               len(bank_voices), bank_bytes),
+        'parse_bank[bread]': (lambda: [parse(bank, engine='bread') for bank in banks], len(bank_voices), bank_bytes),
+        'parse_bank[objects]': (lambda: [parse(bank, as_objects=True) for bank in banks],
+                                len(bank_voices), bank_bytes),
+        'parse_single[native]': (lambda: [parse(single, engine='native') for single in singles],
+                                 len(single_voices), single_bytes),
+        'dump_bank[native]': (lambda: [dumps(voices, engine='native') for voices in bank_lists],
+                              len(bank_voices), dumped_bank_bytes),
+        'dump_bank[bread]': (lambda: [dumps(voices, engine='bread') for voices in bank_lists],
+                             len(bank_voices), dumped_bank_bytes),
+        'dump_single[native]': (lambda: [dumps(voice, engine='native') for voice in single_voices],
+                                len(single_voices), dumped_single_bytes),
+        'signature[json]': (lambda: [dx7.compute_signature(voice, 'json') for voice in bank_voices],
+                            len(bank_voices), bank_bytes),
+        'signature[canonical]': (lambda: [dx7.compute_signature(voice, 'canonical') for voice in bank_voices],
+                                 len(bank_voices), bank_bytes),
+        'checksum': (lambda: [dx7.compute_checksum(bank, 6, 2) for bank in banks], len(bank_voices), bank_bytes),
+        'build_patch_bank': (build, len(bank_voices) + len(single_voices), bank_bytes + single_bytes)
+    }  # type: Dict[str, Tuple[Callable[[], Any], int, int]]
+
+    results = {}
+
+    def selected(stage: str) -> bool:
+        return not stages or any(stage.startswith(prefix) for prefix in stages)
+
+    startup_dir = tempfile.mkdtemp(prefix='sysextools-benchmark-')
+
+    try:
+        # The first parse of a bank and of a single voice, each of which uses
+        # a layout of its own
+        sysex_files = []
+
+        for i, message in enumerate(banks[:1] + singles[:1]):
+            sysex_files.append(os.path.join(startup_dir, 'sysex{:d}.syx'.format(i)))
+
+            with open(sysex_files[-1], 'wb') as fp:
+                fp.write(message)
+
+        for module in (None,) + STARTUP_MODULES:
+            stage = 'startup[%s]' % (module or 'python')
+
+            if selected(stage):
+                results[stage] = _result(_measure_startup(module, repeat, sysex_files), None, 0, 0)
+    finally:
+        shutil.rmtree(startup_dir)
+
+    for stage, (fn, num_voices, num_bytes) in benchmarks.items():
+        if not selected(stage):
+            continue
+
+        seconds, peak_memory = _measure(fn, repeat)
+        results[stage] = _result(seconds, peak_memory, num_voices, num_bytes)
+
+    return {
+        'version': RESULTS_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'banks': num_banks, 'singles': num_singles, 'seed': seed, 'repeat': repeat},
+        'results': results
+    }
+
+
+def format_results(results: dict, baseline: Optional[dict] = None) -> str:
+    lines = ['{:<44} {:>10} {:>12} {:>10} {:>12}{}'.format(
+        'stage', 'seconds', 'voices/s', 'MB/s', 'peak KiB', '  vs baseline' if baseline else '')]
+
+    for stage, result in results['results'].items():
+        line = '{:<44} {:>10.4f} {:>12.0f} {:>10.2f} {:>12.0f}'.format(
+            stage, result['seconds'], result['voices_per_second'] or 0, result['mb_per_second'] or 0,
+            (result['peak_memory_bytes'] or 0) / 1024)
+
+        if baseline is not None and stage in baseline['results'] and result['seconds']:
+            # Above 1 means faster than the baseline
+            line += '  {:>10.2f}x'.format(baseline['results'][stage]['seconds'] / result['seconds'])
+
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def benchmark(output: Optional[str] = None, compare: Optional[str] = None, **kwargs):
+    results = run_benchmarks(**kwargs)
+    baseline = None
+
+    if compare is not None:
+        with open(compare, 'r') as fp:
+            baseline = json.load(fp)
+
+    print(format_results(results, baseline))
+
+    if output is not None:
+        with open(output, 'w') as fp:
+            json.dump(results, fp, indent=2)
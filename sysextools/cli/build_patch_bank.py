@@ -1,82 +1,157 @@
+from contextlib import nullcontext
+from functools import partial
 import itertools
 import json
 import logging
 import os
-from typing import List, Optional
+from typing import Dict, List, Optional, Set, Tuple, Union  # noqa
 
-from .. import parse, dump
+from .. import metrics, parse
+from .catalog import Catalog, CATALOG_FILENAME
+from .manifest import file_record, hash_file, Manifest
+from .storage import DirectoryStorage, VoiceStore
 
-logging.basicConfig(filename='build_patch_bank.log', level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 
-def process_sysex(sysex_file: os.DirEntry, output_dir: str, author: Optional[str], source: Optional[str]) -> List[dict]:
-    patch_list = []
+def _salvage_voices(sysex_path: str, signature_mode: Optional[str], min_confidence: float,
+                    validate: Optional[str] = None) -> List[dict]:
+    # Salvaged voices are validated like parsed ones, so that checking or
+    # clamping can't be got around by a file failing to parse
+    from ..formats.yamaha import dx7
+
+    with open(sysex_path, 'rb') as fp:
+        salvaged = dx7.salvage(fp.read(), signature_mode, validate)
+
+    voices = []
+
+    for result in salvaged:
+        if result.voice is None or result.confidence < min_confidence:
+            logger.info("Not salvaging the voice at byte %d of %s (%s)", result.offset, sysex_path,
+                        ', '.join(result.problems))
+            continue
+
+        voice = result.voice
+
+        if result.problems:
+            voice['SALVAGED'] = {'confidence': result.confidence, 'problems': list(result.problems)}
 
-    logging.info(f"Extracting voices from {sysex_file.name}")
+        voices.append(voice)
+
+    logger.info("Salvaged %d of %d voices from %s", len(voices), len(salvaged), sysex_path)
+
+    return voices
+
+
+def _extract_voices(sysex_path: str, bank: str, author: Optional[str], source: Optional[str],
+                    signature_mode: Optional[str] = None, salvage_confidence: Optional[float] = None,
+                    validate: Optional[str] = None) -> Tuple[List[dict], bool]:
+    # Returns the file's voices and whether it parsed. Voices are salvaged
+    # from files that don't parse if salvage_confidence is set, as long as
+    # they're at least that likely to be intact (see dx7/recover.py).
+    logger.info("Extracting voices from %s", bank)
+    failed = False
 
     try:
-        voices = parse(sysex_file.path)
+        voices = parse(sysex_path, signature_mode=signature_mode, validate=validate)
     except Exception as e:
-        logging.error(f"Failed to parse {sysex_file.path} - {str(e)}")
-        return []
+        logger.error("Failed to parse %s - %s", sysex_path, e)
+        failed = True
+
+        if salvage_confidence is None:
+            return [], failed
+
+        voices = _salvage_voices(sysex_path, signature_mode, salvage_confidence, validate)
 
     for voice in voices:
         if author and 'AUTHOR' not in voice:
             voice['AUTHOR'] = author
 
-        voice['BANK'] = sysex_file.name
+        voice['BANK'] = bank
 
         if source:
             voice['SOURCE'] = source
 
-        signature = voice['SIGNATURE']
-        output_subdir = os.path.join(output_dir, signature[:2])
+    return voices, failed
 
-        output_sysex = os.path.join(output_subdir, f"{signature}.syx")
-        output_json = os.path.join(output_subdir, f"{signature}.json")
 
-        if os.path.exists(output_sysex):
-            logging.info(f"Instrument {voice['NAME']} is a duplicate ({voice['SIGNATURE']}); skipping")
-            continue
+# How many voices each worker writes at a time when writing in parallel
+WRITE_BATCH_SIZE = 256
 
-        logging.info(f"Writing {voice['NAME']} ({voice['SIGNATURE']})")
 
-        dump([voice], output_sysex)
+def _write_voices(voices: List[dict], output_dir: str, collect_stats: bool = False) -> Optional[dict]:
+    # Counts and timings from worker processes are handed back to the parent
+    # when collect_stats is set
+    if not collect_stats:
+        DirectoryStorage(output_dir).put_many(voices)
+        return None
 
-        with open(output_json, 'w+') as fp:
-            json.dump(voice, fp)
+    with metrics.collect_stats() as stats:
+        DirectoryStorage(output_dir).put_many(voices)
 
-        patch_list.append({
-            'name': voice['NAME'],
-            'author': voice['AUTHOR'],
-            'signature': voice['SIGNATURE'],
-            'manufacturer': voice['MANUFACTURER'],
-            'model': voice['MODEL'],
-            'source_bank': voice['BANK']
-        })
+    return stats.to_dict()
+
+
+def _patch_list_entry(voice: dict) -> dict:
+    return {
+        'name': voice['NAME'],
+        'author': voice['AUTHOR'],
+        'signature': voice['SIGNATURE'],
+        'manufacturer': voice['MANUFACTURER'],
+        'model': voice['MODEL'],
+        'source_bank': voice['BANK']
+    }
+
+
+def process_sysex(sysex_file: os.DirEntry, output_dir: str, author: Optional[str], source: Optional[str],
+                  store: Optional[VoiceStore] = None) -> List[dict]:
+    # Voices go into store if one is given, and into output_dir's directory
+    # layout otherwise
+    storage = store if store is not None else DirectoryStorage(output_dir)
+    patch_list = []
+
+    for voice in _extract_voices(sysex_file.path, sysex_file.name, author, source)[0]:
+        if voice['SIGNATURE'] in storage:
+            logger.debug("Instrument %s is a duplicate (%s); skipping", voice['NAME'], voice['SIGNATURE'])
+            continue
+
+        logger.debug("Writing %s (%s)", voice['NAME'], voice['SIGNATURE'])
+
+        storage.put(voice)
+
+        patch_list.append(_patch_list_entry(voice))
 
     return patch_list
 
 
-def build_patch_bank(sysex_files_dir: str, output_dir: str):
-    patch_list_file = os.path.join(output_dir, 'patch_list.json')
+Task = Tuple[str, str, Optional[str], Optional[str]]
+
+
+def _hash_and_extract(task: Task, signature_mode: Optional[str], salvage_confidence: Optional[float],
+                      validate: Optional[str]) -> Tuple[str, List[dict], bool]:
+    with metrics.timed('hash'):
+        content_hash = hash_file(task[0])
+
+    return (content_hash,) + _extract_voices(*task, signature_mode=signature_mode,
+                                             salvage_confidence=salvage_confidence, validate=validate)
 
-    patch_list = []  # type: List[dict]
 
-    if os.path.exists(patch_list_file):
-        with open(patch_list_file, 'r') as fp:
-            patch_list = json.load(fp)
+def _parse_task(task: Task, signature_mode: Optional[str] = None, collect_stats: bool = False,
+                salvage_confidence: Optional[float] = None,
+                validate: Optional[str] = None) -> Tuple[str, List[dict], bool, Optional[dict]]:
+    if not collect_stats:
+        return _hash_and_extract(task, signature_mode, salvage_confidence, validate) + (None,)
 
+    with metrics.collect_stats() as stats:
+        result = _hash_and_extract(task, signature_mode, salvage_confidence, validate)
+
+    return result + (stats.to_dict(),)
+
+
+def _scan_tasks(sysex_files_dir: str) -> List[Tuple[Task, os.stat_result]]:
     builtins = []
     user_built = []
 
-    # Build subdirectories for each of the prefixes so we can keep directories relatively small
-    for i in range(256):
-        try:
-            os.mkdir(os.path.join(output_dir, "{:02x}".format(i)))
-        except FileExistsError:
-            pass
-
     # Partition folders into built-ins and user-constructed sysex files, so
     # that we can scan the built-ins first
     for sysex_dir in os.scandir(sysex_files_dir):
@@ -88,6 +163,8 @@ def build_patch_bank(sysex_files_dir: str, output_dir: str):
         else:
             user_built.append(sysex_dir)
 
+    tasks = []
+
     for sysex_dir in itertools.chain(builtins, user_built):
         if sysex_dir.is_dir():
             if sysex_dir == '_Unknown':
@@ -95,7 +172,7 @@ def build_patch_bank(sysex_files_dir: str, output_dir: str):
             else:
                 author = sysex_dir.name.replace('BUILTIN_', '')
 
-            logging.info(f"Scanning sysex files for author '{author}'")
+            logger.info("Scanning sysex files for author '%s'", author)
 
             source_path = os.path.join(sysex_dir.path, 'source.txt')
             source = None
@@ -106,8 +183,290 @@ def build_patch_bank(sysex_files_dir: str, output_dir: str):
 
             for f in os.scandir(sysex_dir.path):
                 if f.name.lower().endswith('.syx'):
-                    patch_list.extend(process_sysex(f, output_dir, source=source, author=author))
+                    tasks.append(((f.path, f.name, author, source), f.stat()))
+
+    return tasks
+
+
+def _assign_owners(files: Dict[str, dict], parsed: Dict[str, List[dict]]) -> Tuple[Dict[str, str], List[dict]]:
+    # Walk every file's voices in scan order; the first file seen for a
+    # signature owns it, exactly as if everything had been parsed from
+    # scratch
+    owners = {}  # type: Dict[str, str]
+    patch_list = []
+    log_duplicates = logger.isEnabledFor(logging.DEBUG)
+
+    for key, record in files.items():
+        for signature, name, manufacturer, model in record['voices']:
+            if signature in owners:
+                if log_duplicates and key in parsed:
+                    logger.debug("Instrument %s is a duplicate (%s); skipping", name, signature)
+
+                continue
+
+            owners[signature] = key
+            patch_list.append({
+                'name': name,
+                'author': record['author'],
+                'signature': signature,
+                'manufacturer': manufacturer,
+                'model': model,
+                'source_bank': os.path.basename(key)
+            })
+
+    return owners, patch_list
+
+
+NEAR_DUPLICATE_INDEX_FILENAME = 'near_duplicates.idx'
+
+# What to do with voices that are near-duplicates of one already in the bank:
+# mark them as such in the patch list, or leave them out of the bank
+NEAR_DUPLICATE_MODES = ('flag', 'collapse')
+
+
+def _find_near_duplicates(output_dir: str, signature_mode: Optional[str], owners: Dict[str, str],
+                          parsed: Dict[str, List[dict]], reparse, previous: Dict[str, str], mode: str,
+                          max_distance: int) -> Dict[str, str]:
+    # Returns a map from each near-duplicate to the voice it duplicates. Voices
+    # are checked in scan order against the ones kept before them, so the
+    # first of a group of near-duplicates is always the one that's kept.
+    from ..formats.yamaha.dx7 import canonical_bytes
+    from ..formats.yamaha.dx7.similarity import NearDuplicateIndex
+
+    index_file = os.path.join(output_dir, NEAR_DUPLICATE_INDEX_FILENAME)
+    index = NearDuplicateIndex()
+
+    if os.path.exists(index_file):
+        loaded_index, tag = NearDuplicateIndex.load(index_file)
+
+        # Vectors are stored by signature, so they're no use under a
+        # different signature mode
+        if tag == (signature_mode or ''):
+            index = loaded_index
+        else:
+            previous = {}
+
+    for signature in list(index.vectors):
+        if signature not in owners:
+            index.remove(signature)
+
+    # Earlier verdicts stand for as long as the voice that was kept is still
+    # around
+    near_duplicate_of = {signature: original for signature, original in previous.items()
+                         if signature in owners and original in index}
+    pending = [signature for signature in owners if signature not in index and signature not in near_duplicate_of]
+
+    reparse(set(owners[signature] for signature in pending))
+
+    vectors = {}
+
+    for key in set(owners[signature] for signature in pending):
+        for voice in parsed[key]:
+            if voice['MODEL'] == 'dx7' and owners.get(voice['SIGNATURE']) == key:
+                vectors[voice['SIGNATURE']] = canonical_bytes(voice)
+
+    for signature in pending:
+        if signature not in vectors:
+            continue
+
+        matches = index.nearest(vectors[signature], max_distance, k=1)
+
+        if matches:
+            distance, original = matches[0]
+            near_duplicate_of[signature] = original
+            logger.debug("%s is a near-duplicate of %s (distance %d)", signature, original, distance)
+
+            if mode == 'collapse':
+                continue
+
+        index.add(signature, vectors[signature])
+
+    index.save(index_file, signature_mode or '')
+
+    return near_duplicate_of
+
+
+def _update_catalog(catalog_file: str, owners: Dict[str, str], patch_list: List[dict],
+                    near_duplicate_of: Dict[str, str], written: Set[str], parsed: Dict[str, List[dict]], reparse):
+    with Catalog(catalog_file, replace_stale=True) as voice_catalog:
+        existing = voice_catalog.positions()
+        voice_catalog.remove(set(existing.keys()) - set(owners.keys()))
+
+        positions = {entry['signature']: i for i, entry in enumerate(patch_list)}
+
+        # Voices that were just written, or that the catalog doesn't know
+        # about yet, need their parameters; the rest at most need moving
+        to_add = set(signature for signature in owners if signature in written or signature not in existing)
+        keys = set(owners[signature] for signature in to_add)
+        reparse(keys)
+
+        voice_catalog.add_voices((voice, positions[voice['SIGNATURE']], near_duplicate_of.get(voice['SIGNATURE']))
+                                 for key in keys for voice in parsed[key]
+                                 if voice['SIGNATURE'] in to_add and owners[voice['SIGNATURE']] == key)
+
+        entries = ((signature, positions[signature], near_duplicate_of.get(signature)) for signature in owners
+                   if signature not in to_add)
+        voice_catalog.update_positions(entry for entry in entries if existing[entry[0]] != entry[1:])
+
+
+STORAGE = ('files', 'store')
+
+
+def build_patch_bank(sysex_files_dir: str, output_dir: str, jobs: int = 1, signature_mode: Optional[str] = None,
+                     storage: str = 'files', record_format: str = 'single', near_duplicates: Optional[str] = None,
+                     near_duplicate_distance: int = 4, catalog: bool = False,
+                     salvage_confidence: Optional[float] = None, validate: Optional[str] = None):
+    # With storage='store', voices go into a voice store in output_dir (see
+    # storage.py) rather than a pair of files each. near_duplicates can be
+    # 'flag' or 'collapse' (see NEAR_DUPLICATE_MODES); voices whose parameters
+    # are within near_duplicate_distance of one already in the bank are
+    # near-duplicates. With catalog set, the patch list is kept in a catalog
+    # (see catalog.py) instead of patch_list.json. With salvage_confidence
+    # set, voices are salvaged from files that don't parse (see
+    # _extract_voices). validate can be 'check', to leave out files with
+    # parameters outside the DX7's ranges, or 'clamp', to clamp them into
+    # range; either way, --stats counts them parameter by parameter.
+    patch_list_file = os.path.join(output_dir, 'patch_list.json')
+
+    if storage not in STORAGE:
+        raise ValueError(f"Unknown storage {storage}")
+
+    if near_duplicates is not None and near_duplicates not in NEAR_DUPLICATE_MODES:
+        raise ValueError(f"Unknown near-duplicate mode {near_duplicates}")
+
+    if storage == 'store':
+        voice_storage = VoiceStore(output_dir, record_format)  # type: Union[DirectoryStorage, VoiceStore]
+    else:
+        voice_storage = DirectoryStorage(output_dir)
+
+    voice_storage.create()
+
+    manifest = Manifest(output_dir, signature_mode, storage, validate)
+    # Worker processes have to collect their own stats and send them back
+    collect_stats = jobs > 1 and metrics.enabled()
+    parse_task = partial(_parse_task, signature_mode=signature_mode, collect_stats=collect_stats,
+                         salvage_confidence=salvage_confidence, validate=validate)
+
+    files = {}  # type: Dict[str, dict]
+    parsed = {}  # type: Dict[str, List[dict]]
+    to_parse = []  # type: List[Tuple[str, Task]]
+
+    # Only files that are new or have changed since the last build get parsed
+    for task, stat in _scan_tasks(sysex_files_dir):
+        key = os.path.relpath(task[0], sysex_files_dir)
+        record = manifest.unchanged_record(key, task[0], stat, task[2], task[3], salvage_confidence)
+
+        if record is None:
+            to_parse.append((key, task))
+            # Filled in once the file is parsed, but added now so that files
+            # stays in scan order
+            record = {}
+
+        files[key] = record
+
+    if jobs > 1:
+        # Only imported when needed; it's one of the slower imports around
+        from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext() as pool:
+        map_fn = partial(pool.map, chunksize=16) if pool is not None else map
+
+        results = map_fn(parse_task, [t for _, t in to_parse])
+
+        for (key, task), (content_hash, voices, failed, stats) in zip(to_parse, results):
+            metrics.merge(stats)
+            files[key] = file_record(task[0], task[2], task[3], voices, content_hash)
+
+            if failed:
+                # Whether anything was salvaged depends on how hard we tried
+                files[key]['failed'] = True
+                files[key]['salvage_confidence'] = salvage_confidence
+            parsed[key] = voices
+
+        def reparse(keys):
+            # Parses whichever of the given files haven't been parsed yet
+            unparsed = sorted(set(keys) - set(parsed.keys()))
+            reparse_tasks = [(os.path.join(sysex_files_dir, key), os.path.basename(key), files[key]['author'],
+                              files[key]['source']) for key in unparsed]
+
+            for key, (_, voices, _, stats) in zip(unparsed, map_fn(parse_task, reparse_tasks)):
+                metrics.merge(stats)
+                parsed[key] = voices
+
+        with metrics.timed('dedup', sum(len(record['voices']) for record in files.values())):
+            owners, patch_list = _assign_owners(files, parsed)
+
+        near_duplicate_of = {}  # type: Dict[str, str]
+
+        if near_duplicates is not None:
+            with metrics.timed('near_duplicates', len(owners)):
+                near_duplicate_of = _find_near_duplicates(output_dir, signature_mode, owners, parsed, reparse,
+                                                          manifest.near_duplicates, near_duplicates,
+                                                          near_duplicate_distance)
+
+            if near_duplicates == 'collapse':
+                for signature in near_duplicate_of:
+                    del owners[signature]
+
+                patch_list = [entry for entry in patch_list if entry['signature'] not in near_duplicate_of]
+            else:
+                for entry in patch_list:
+                    if entry['signature'] in near_duplicate_of:
+                        entry['near_duplicate_of'] = near_duplicate_of[entry['signature']]
+
+        # A voice needs writing if it's new, if its owner was re-parsed, or if
+        # it has changed hands because the file that used to own it changed
+        # or disappeared
+        to_write = {}  # type: Dict[str, str]
+
+        for signature, key in owners.items():
+            previous_owner = manifest.owners.get(signature)
+
+            if previous_owner == key and key not in parsed:
+                continue
+
+            if previous_owner is None and signature in voice_storage:
+                continue
+
+            to_write[signature] = key
+
+        reparse(to_write.values())
+        written = set(to_write.keys())
+
+        voices_to_write = []
+
+        for key, voices in parsed.items():
+            for voice in voices:
+                if to_write.get(voice['SIGNATURE']) == key:
+                    logger.debug("Writing %s (%s)", voice['NAME'], voice['SIGNATURE'])
+                    voices_to_write.append(voice)
+                    del to_write[voice['SIGNATURE']]
+
+        batches = [voices_to_write[i:i + WRITE_BATCH_SIZE] for i in range(0, len(voices_to_write), WRITE_BATCH_SIZE)]
+
+        if storage == 'store':
+            # A store has a single writer; appending is cheap enough anyway
+            for batch in batches:
+                voice_storage.put_many(batch)
+        else:
+            write_voices = partial(_write_voices, output_dir=output_dir, collect_stats=collect_stats)
+
+            for stats in (pool.map if pool is not None else map)(write_voices, batches):
+                metrics.merge(stats)
+
+        if catalog:
+            with metrics.timed('catalog'):
+                _update_catalog(os.path.join(output_dir, CATALOG_FILENAME), owners, patch_list, near_duplicate_of,
+                                written, parsed, reparse)
+
+    # Voices that no file produces any more are removed from the bank
+    for signature in set(manifest.owners.keys()) - set(owners.keys()):
+        voice_storage.remove(signature)
+
+    voice_storage.close()
 
+    manifest.save(files, owners, near_duplicate_of)
 
-    with open(patch_list_file, 'w+') as fp:
-        json.dump(patch_list, fp, indent=2)
+    if not catalog:
+        with open(patch_list_file, 'w+') as fp:
+            json.dump(patch_list, fp, indent=2)
@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple  # noqa
+
+from .. import metrics
+from ..constants import SYSEX_END_BYTE, SYSEX_START_BYTE
+from .catalog import Catalog, CATALOG_FILENAME
+from .storage import STORE_FILENAME, VoiceStore
+
+logger = logging.getLogger(__name__)
+
+# Packs voices from a patch bank into as few 32-voice banks ("cartridges") as
+# it takes, so that they can be sent to a DX7 a bank at a time rather than a
+# voice at a time. Voices are copied into their slots in the 128-byte packed
+# layout straight from the patch bank: every .syx file build_patch_bank writes
+# is already a bank with its voice in the first slot, and voice store records
+# are either already packed or transcoded without being decoded. Slots left
+# over in the last bank are zeroed, like the unused slots of the patch bank's
+# own .syx files.
+
+VOICES_PER_BANK = 32
+PACKED_VOICE_SIZE = 128
+INDEX_FILENAME = 'cartridges.json'
+
+# Where the first voice starts in a bank message: the start byte, the
+# manufacturer ID and the four-byte header
+_VOICES_OFFSET = 6
+_BANK_SIZE = _VOICES_OFFSET + VOICES_PER_BANK * PACKED_VOICE_SIZE + 2
+
+
+def _packed_voices_from_files(patch_bank_dir: str, signatures: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+    for signature in signatures:
+        path = os.path.join(patch_bank_dir, signature[:2], f"{signature}.syx")
+
+        try:
+            with open(path, 'rb') as fp:
+                fp.seek(_VOICES_OFFSET)
+                packed = fp.read(PACKED_VOICE_SIZE)
+        except FileNotFoundError:
+            logger.warning("Voice %s isn't in the patch bank", signature)
+            continue
+
+        yield signature, packed
+
+
+def _packed_voices_from_store(patch_bank_dir: str, signatures: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+    from ..formats.yamaha.dx7.layout import packed_layout
+    from ..formats.yamaha.dx7.native import transcode_voice
+
+    layout = packed_layout()
+
+    with VoiceStore(patch_bank_dir) as store:
+        for signature in signatures:
+            if signature not in store:
+                logger.warning("Voice %s isn't in the patch bank", signature)
+                continue
+
+            record = store.get_record(signature)
+
+            if store.record_format == 'packed':
+                yield signature, record
+            else:
+                packed = bytearray(PACKED_VOICE_SIZE)
+                transcode_voice(record, layout, packed)
+
+                yield signature, bytes(packed)
+
+
+def packed_voices(patch_bank_dir: str, signatures: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+    # Each voice in the patch bank, in the order given, as (signature, packed
+    # voice) pairs. Voices the bank doesn't have are skipped.
+    if os.path.exists(os.path.join(patch_bank_dir, STORE_FILENAME)):
+        return _packed_voices_from_store(patch_bank_dir, signatures)
+
+    return _packed_voices_from_files(patch_bank_dir, signatures)
+
+
+def compose_banks(voices: Iterable[Tuple[str, bytes]]) -> Iterator[Tuple[bytes, List[str]]]:
+    # Packs (signature, packed voice) pairs into complete 32-voice bank
+    # messages, yielding each bank with the signatures in its slots
+    from ..formats.yamaha import dx7, MANUFACTURER_ID
+
+    def new_bank() -> bytearray:
+        bank = bytearray(_BANK_SIZE)
+        bank[0] = SYSEX_START_BYTE
+        bank[1:_VOICES_OFFSET] = bytes(MANUFACTURER_ID) + dx7.MULTI_VOICE_HEADER
+        bank[-1] = SYSEX_END_BYTE
+
+        return bank
+
+    def finish(bank: bytearray) -> bytes:
+        voice_data = memoryview(bank)[_VOICES_OFFSET:-2]
+        bank[-2] = dx7.compute_checksum(voice_data, 0, 0)
+        voice_data.release()
+
+        return bytes(bank)
+
+    bank = new_bank()
+    signatures = []  # type: List[str]
+
+    for signature, packed in voices:
+        offset = _VOICES_OFFSET + len(signatures) * PACKED_VOICE_SIZE
+        bank[offset:offset + PACKED_VOICE_SIZE] = packed
+        signatures.append(signature)
+
+        if len(signatures) == VOICES_PER_BANK:
+            yield finish(bank), signatures
+            bank = new_bank()
+            signatures = []
+
+    if signatures:
+        yield finish(bank), signatures
+
+
+def _all_signatures(patch_bank_dir: str) -> List[str]:
+    # Every voice in the bank, in patch list order
+    catalog_file = os.path.join(patch_bank_dir, CATALOG_FILENAME)
+
+    if os.path.exists(catalog_file):
+        with Catalog(catalog_file) as catalog:
+            return [entry['signature'] for entry in catalog.patch_list()]
+
+    with open(os.path.join(patch_bank_dir, 'patch_list.json'), 'r') as fp:
+        return [entry['signature'] for entry in json.load(fp)]
+
+
+def build_cartridges(patch_bank_dir: str, output_dir: str, signatures: Optional[Iterable[str]] = None,
+                     prefix: str = 'bank') -> List[dict]:
+    # Writes the given voices (or, by default, every voice in the patch bank)
+    # to output_dir as numbered 32-voice banks, along with an index of which
+    # voice went into which slot of which bank. Returns the index.
+    from ..formats.yamaha.dx7.layout import packed_layout
+    from ..formats.yamaha.dx7.spec import NAME_ENCODING
+
+    if signatures is None:
+        signatures = _all_signatures(patch_bank_dir)
+
+    # Voices asked for more than once only go in once
+    signatures = list(dict.fromkeys(signatures))
+
+    os.makedirs(output_dir, exist_ok=True)
+    layout = packed_layout()
+    index = []
+
+    for number, (bank, bank_signatures) in enumerate(compose_banks(packed_voices(patch_bank_dir, signatures)), 1):
+        bank_file = f"{prefix}-{number:05d}.syx"
+
+        with metrics.timed('write', len(bank_signatures)):
+            with open(os.path.join(output_dir, bank_file), 'wb') as fp:
+                fp.write(bank)
+
+        for slot, signature in enumerate(bank_signatures):
+            name_start = _VOICES_OFFSET + slot * PACKED_VOICE_SIZE + layout.name_offset
+            name = bank[name_start:name_start + layout.name_length].decode(NAME_ENCODING, 'replace')
+            index.append({'signature': signature, 'name': name.strip(), 'bank': bank_file, 'slot': slot + 1})
+
+    with open(os.path.join(output_dir, INDEX_FILENAME), 'w') as fp:
+        json.dump(index, fp, indent=2)
+
+    logger.info('Wrote %d voices to %d banks', len(index), (len(index) + VOICES_PER_BANK - 1) // VOICES_PER_BANK)
+
+    return index
+
+
+def select_and_build_cartridges(patch_bank_dir: str, output_dir: str, signatures_file: Optional[str] = None,
+                                parameters: Optional[List[str]] = None, prefix: str = 'bank', **query) -> List[dict]:
+    # Picks the voices to pack from a file of signatures (one per line), a
+    # query of the patch bank's catalog (see Catalog.query) or, failing both,
+    # the whole patch bank
+    from .catalog import _parse_parameter
+
+    query = {key: value for key, value in query.items() if value is not None}
+    signatures = None  # type: Optional[List[str]]
+
+    if signatures_file is not None:
+        with open(signatures_file, 'r') as fp:
+            signatures = [line.strip() for line in fp if line.strip()]
+
+    if query or parameters:
+        catalog_file = os.path.join(patch_bank_dir, CATALOG_FILENAME)
+
+        if not os.path.exists(catalog_file):
+            raise ValueError(f"Selecting voices by query needs a catalog; build {patch_bank_dir} with --catalog")
+
+        with Catalog(catalog_file) as catalog:
+            matches = [row['signature'] for row in
+                       catalog.query(parameters=dict(_parse_parameter(p) for p in parameters or []), **query)]
+
+        if signatures is None:
+            signatures = matches
+        else:
+            matching = set(matches)
+            signatures = [signature for signature in signatures if signature in matching]
+
+    return build_cartridges(patch_bank_dir, output_dir, signatures, prefix)
@@ -0,0 +1,282 @@
+from functools import lru_cache
+import json
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Tuple  # noqa
+
+from .. import metrics
+
+# A queryable catalog of a patch bank: a SQLite database with a row for every
+# voice in the bank, holding what its patch list entry holds plus every one of
+# its parameters (and a row for each of its operators, with theirs), so that
+# questions like "every algorithm 5 voice by this author" don't mean reading
+# every voice's JSON file. build_patch_bank keeps it up to date as it goes, and
+# export_patch_list turns it back into a patch_list.json.
+
+CATALOG_FILENAME = 'catalog.sqlite'
+CATALOG_VERSION = 2
+
+# The columns that hold a voice's patch list entry, in patch list order
+ENTRY_COLUMNS = ('name', 'author', 'signature', 'manufacturer', 'model', 'source_bank')
+
+# Columns with an index of their own
+INDEXED_COLUMNS = ('name', 'author', 'source_bank', 'algorithm', 'position')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS voices (
+    signature TEXT PRIMARY KEY,
+    position INTEGER,
+    name TEXT COLLATE NOCASE,
+    author TEXT COLLATE NOCASE,
+    manufacturer TEXT,
+    model TEXT,
+    source_bank TEXT,
+    source TEXT,
+    near_duplicate_of TEXT,
+    %s
+);
+CREATE TABLE IF NOT EXISTS operators (
+    signature TEXT REFERENCES voices(signature) ON DELETE CASCADE,
+    operator INTEGER,
+    %s,
+    PRIMARY KEY (signature, operator)
+);
+%s
+'''
+
+
+@lru_cache(maxsize=None)
+def _parameter_columns() -> Tuple[Dict[str, tuple], Dict[str, tuple]]:
+    # A column for every voice-level and per-operator parameter in the DX7's
+    # layouts, and where each one lives in a parsed voice (or operator). Each
+    # is named after where it lives, e.g. lfo_speed or
+    # oscillator_frequency_coarse; the elements of arrays are numbered from 1,
+    # e.g. envelope_generator_rates_1.
+    from ..formats.yamaha.dx7 import OPERATOR_FIELD_PATHS, VOICE_FIELD_PATHS
+    from ..formats.yamaha.dx7.layout import unpacked_layout
+
+    voice_columns = {}  # type: Dict[str, tuple]
+    operator_columns = {}  # type: Dict[str, tuple]
+
+    for field in unpacked_layout().fields:
+        if field.operator is None:
+            columns = voice_columns
+            path = VOICE_FIELD_PATHS[field.name]  # type: tuple
+        elif field.operator == 0:
+            # Every operator has the same parameters
+            columns = operator_columns
+            path = OPERATOR_FIELD_PATHS[field.name]
+        else:
+            continue
+
+        column = '_'.join(path)
+
+        if field.element is not None:
+            column += '_%d' % (field.element + 1)
+            path += (field.element,)
+
+        columns[column] = path
+
+    return voice_columns, operator_columns
+
+
+def voice_parameters() -> Dict[str, tuple]:
+    return _parameter_columns()[0]
+
+
+def operator_parameters() -> Dict[str, tuple]:
+    return _parameter_columns()[1]
+
+
+def _get(voice: dict, path: tuple) -> Any:
+    for key in path:
+        voice = voice[key]
+
+    return voice
+
+
+class Catalog(object):
+    # Catalogs built by other versions have other columns. With replace_stale
+    # set, one is emptied so it can be filled back in (as build_patch_bank
+    # does); otherwise opening one is an error.
+    def __init__(self, path: str, replace_stale: bool = False):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        version = self._version()
+
+        if version is not None and version != str(CATALOG_VERSION):
+            if not replace_stale:
+                self.connection.close()
+                raise ValueError('%s was built by a different version of build-patch-bank; build it again' % (path))
+
+            self.connection.executescript('DROP TABLE IF EXISTS operators; DROP TABLE IF EXISTS voices;')
+
+        self.connection.executescript(_SCHEMA % (
+            ',\n    '.join(voice_parameters().keys()), ',\n    '.join(operator_parameters().keys()),
+            '\n'.join('CREATE INDEX IF NOT EXISTS voices_%s ON voices (%s);' % (column, column)
+                      for column in INDEXED_COLUMNS)))
+        self.connection.execute("INSERT OR REPLACE INTO info VALUES ('version', ?)", (str(CATALOG_VERSION),))
+
+    def _version(self) -> Optional[str]:
+        try:
+            row = self.connection.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+        except sqlite3.OperationalError:
+            # A new catalog
+            return None
+
+        return None if row is None else row[0]
+
+    def __enter__(self) -> 'Catalog':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM voices').fetchone()[0]
+
+    def positions(self) -> Dict[str, Tuple[int, Optional[str]]]:
+        # Maps every signature in the catalog to its position in the patch
+        # list and the voice it's a near-duplicate of, if any
+        return {signature: (position, near_duplicate_of) for signature, position, near_duplicate_of in
+                self.connection.execute('SELECT signature, position, near_duplicate_of FROM voices')}
+
+    def add_voices(self, voices: Iterable[Tuple[dict, int, Optional[str]]]):
+        # Adds (or replaces) voices in a single transaction. Each is given
+        # with its position in the patch list and the voice it's a
+        # near-duplicate of, if any
+        voice_paths = voice_parameters().values()
+        operator_paths = operator_parameters().values()
+        voice_rows = []
+        operator_rows = []
+
+        for voice, position, near_duplicate_of in voices:
+            voice_rows.append((voice['SIGNATURE'], position, voice['NAME'], voice.get('AUTHOR'),
+                               voice['MANUFACTURER'], voice['MODEL'], voice.get('BANK'), voice.get('SOURCE'),
+                               near_duplicate_of, *(_get(voice, path) for path in voice_paths)))
+
+            for i, operator in enumerate(voice['operators']):
+                operator_rows.append((voice['SIGNATURE'], i + 1,
+                                      *(_get(operator, path) for path in operator_paths)))
+
+        with self.connection:
+            self.connection.executemany('DELETE FROM operators WHERE signature = ?',
+                                        [row[:1] for row in voice_rows])
+            self.connection.executemany('INSERT OR REPLACE INTO voices VALUES (%s)' %
+                                        ', '.join('?' * (9 + len(voice_paths))), voice_rows)
+            self.connection.executemany('INSERT INTO operators VALUES (%s)' %
+                                        ', '.join('?' * (2 + len(operator_paths))), operator_rows)
+
+    def update_positions(self, positions: Iterable[Tuple[str, int, Optional[str]]]):
+        # Takes (signature, position, near_duplicate_of) triples
+        with self.connection:
+            self.connection.executemany('UPDATE voices SET position = ?, near_duplicate_of = ? WHERE signature = ?',
+                                        [(position, near_duplicate_of, signature)
+                                         for signature, position, near_duplicate_of in positions])
+
+    def remove(self, signatures: Iterable[str]):
+        with self.connection:
+            self.connection.executemany('DELETE FROM voices WHERE signature = ?',
+                                        [(signature,) for signature in signatures])
+
+    def query(self, name: Optional[str] = None, author: Optional[str] = None, bank: Optional[str] = None,
+              algorithm: Optional[int] = None, parameters: Optional[Dict[str, Any]] = None,
+              limit: Optional[int] = None) -> List[dict]:
+        # Finds voices by name (a pattern in which * matches anything),
+        # author, bank, algorithm and any other parameter. Operator parameters
+        # are given as e.g. 'op1.output_level', or just 'output_level' to
+        # match any operator. Every condition has to hold.
+        conditions = []
+        arguments = []  # type: List[Any]
+
+        if name is not None:
+            conditions.append('name LIKE ?')
+            arguments.append(name.replace('*', '%'))
+
+        for column, value in (('author', author), ('source_bank', bank), ('algorithm', algorithm)):
+            if value is not None:
+                conditions.append('%s = ?' % (column))
+                arguments.append(value)
+
+        for parameter, value in (parameters or {}).items():
+            operator, _, operator_parameter = parameter.rpartition('.')
+
+            if not operator and parameter in voice_parameters():
+                conditions.append('%s = ?' % (parameter))
+            elif operator_parameter in operator_parameters():
+                if operator:
+                    if not (operator.startswith('op') and operator[2:].isdigit()):
+                        raise ValueError('Unknown operator %s' % (operator))
+
+                    conditions.append('EXISTS (SELECT 1 FROM operators o WHERE o.signature = voices.signature '
+                                      'AND o.operator = %d AND o.%s = ?)' % (int(operator[2:]), operator_parameter))
+                else:
+                    conditions.append('EXISTS (SELECT 1 FROM operators o WHERE o.signature = voices.signature '
+                                      'AND o.%s = ?)' % (operator_parameter))
+            else:
+                raise ValueError('Unknown parameter %s' % (parameter))
+
+            arguments.append(value)
+
+        sql = 'SELECT * FROM voices'
+
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+
+        sql += ' ORDER BY position'
+
+        if limit is not None:
+            sql += ' LIMIT %d' % (limit)
+
+        cursor = self.connection.execute(sql, arguments)
+        columns = [description[0] for description in cursor.description]
+
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def patch_list(self) -> List[dict]:
+        # The patch list build_patch_bank would have written
+        patch_list = []
+
+        for row in self.connection.execute('SELECT %s, near_duplicate_of FROM voices ORDER BY position' %
+                                           (', '.join(ENTRY_COLUMNS))):
+            entry = dict(zip(ENTRY_COLUMNS, row[:-1]))
+
+            if row[-1] is not None:
+                entry['near_duplicate_of'] = row[-1]
+
+            patch_list.append(entry)
+
+        return patch_list
+
+
+def export_patch_list(catalog_file: str, patch_list_file: str):
+    with metrics.timed('read'), Catalog(catalog_file) as catalog:
+        patch_list = catalog.patch_list()
+
+    with metrics.timed('write', len(patch_list)), open(patch_list_file, 'w+') as fp:
+        json.dump(patch_list, fp, indent=2)
+
+
+def _parse_parameter(parameter: str) -> Tuple[str, Any]:
+    # 'NAME=VALUE', with VALUE an integer wherever it looks like one
+    name, separator, value = parameter.partition('=')
+
+    if not separator:
+        raise ValueError('Expected NAME=VALUE, got %s' % (parameter))
+
+    return name, int(value) if value.lstrip('-').isdigit() else value
+
+
+def query_catalog(catalog_file: str, name: Optional[str] = None, author: Optional[str] = None,
+                  bank: Optional[str] = None, algorithm: Optional[int] = None,
+                  parameters: Optional[List[str]] = None, limit: Optional[int] = None):
+    with metrics.timed('query'), Catalog(catalog_file) as catalog:
+        voices = catalog.query(name, author, bank, algorithm, dict(_parse_parameter(p) for p in parameters or []),
+                               limit)
+
+    print(json.dumps(voices, indent=2))
@@ -0,0 +1,134 @@
+from collections import Counter
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple  # noqa
+
+from .. import metrics, registry
+from ..errors import NotSupportedError, ParseError
+from ..stream import iter_messages
+from .verify_roundtrip import _body_offset, _scan
+
+logger = logging.getLogger(__name__)
+
+# Counts, parameter by parameter, how many values across a corpus are outside
+# the ranges the synth accepts, using the format module's check_ranges() (see
+# dx7/ranges.py). Nothing is parsed beyond what that takes, so this is a cheap
+# way of finding out how much a build with --validate would leave out or
+# clamp before running one.
+
+# How many files each worker checks at a time when checking in parallel
+CHECK_BATCH_SIZE = 16
+
+
+def check_message(message: bytes) -> Counter:
+    start = _body_offset(message)
+    body = message[start:-1]
+    fmt = registry.detect_format(tuple(message[1:start]), body[:4])
+    check = getattr(registry.load(fmt), 'check_ranges', None)
+
+    if check is None:
+        raise NotSupportedError("%s %s messages can't be checked" % (fmt.manufacturer, fmt.model))
+
+    with metrics.timed('check_ranges'):
+        return check(body)
+
+
+def check_file(sysex_file: str) -> dict:
+    # Out-of-range counts for every message in a file put together. Messages
+    # that can't be checked are counted as skipped.
+    result = {'file': sysex_file, 'messages': 0, 'skipped': 0, 'counts': {}}  # type: Dict[str, Any]
+    counts = Counter()  # type: Counter
+
+    try:
+        for _, message in iter_messages(sysex_file):
+            result['messages'] += 1
+
+            try:
+                counts.update(check_message(message))
+            except NotSupportedError as e:
+                logger.info('%s: skipped: %s', sysex_file, e)
+                result['skipped'] += 1
+    except (OSError, ParseError) as e:
+        result['error'] = str(e)
+
+    result['counts'] = dict(counts.most_common())
+
+    return result
+
+
+def _check_files(args: Tuple[List[str], bool]) -> Tuple[List[dict], Optional[dict]]:
+    paths, collect_stats = args
+
+    if not collect_stats:
+        return [check_file(path) for path in paths], None
+
+    with metrics.collect_stats() as stats:
+        results = [check_file(path) for path in paths]
+
+    return results, stats.to_dict()
+
+
+def check_corpus(paths: List[str], jobs: int = 1) -> List[dict]:
+    # Checks every .syx file in paths (files, or directories to search),
+    # spreading the files across jobs worker processes
+    sysex_files = _scan(paths)
+    batches = [(sysex_files[i:i + CHECK_BATCH_SIZE], metrics.enabled())
+               for i in range(0, len(sysex_files), CHECK_BATCH_SIZE)]
+
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            batch_results = list(pool.map(_check_files, batches))
+    else:
+        batch_results = [_check_files(batch) for batch in batches]
+
+    results = []
+
+    for batch, stats in batch_results:
+        results.extend(batch)
+        metrics.merge(stats)
+
+    return results
+
+
+def summarize(results: List[dict]) -> dict:
+    fields = Counter()  # type: Counter
+
+    for result in results:
+        fields.update(result['counts'])
+
+    return {
+        'files': len(results),
+        'messages': sum(result['messages'] for result in results),
+        'out_of_range_files': sum(1 for result in results if result['counts']),
+        'errors': sum(1 for result in results if 'error' in result),
+        'skipped': sum(result['skipped'] for result in results),
+        'fields': dict(fields.most_common())
+    }
+
+
+def check_ranges(paths: List[str], jobs: int = 1, report: Optional[str] = None) -> bool:
+    # Prints which files have out-of-range parameters and how many values of
+    # each parameter are out of range overall, and returns whether any were
+    results = check_corpus(paths, jobs)
+
+    for result in results:
+        if 'error' in result:
+            print(f"{result['file']}: {result['error']}")
+        elif result['counts']:
+            print(f"{result['file']}: {sum(result['counts'].values())} values out of range")
+
+    summary = summarize(results)
+
+    print(f"{summary['files']} files ({summary['messages']} messages): {summary['out_of_range_files']} with values "
+          f"out of range, {summary['errors']} errors, {summary['skipped']} messages skipped")
+
+    for field, count in summary['fields'].items():
+        print(f"    {field}: {count}")
+
+    if report is not None:
+        with open(report, 'w') as fp:
+            json.dump({'summary': summary, 'results': results}, fp, indent=2)
+
+    return summary['out_of_range_files'] == 0 and summary['errors'] == 0
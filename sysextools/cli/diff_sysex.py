@@ -0,0 +1,129 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple  # noqa
+
+from .. import metrics, registry
+from ..constants import SYSEX_END_BYTE, SYSEX_START_BYTE
+from ..errors import NotSupportedError, ParseError
+from .verify_roundtrip import _body_offset
+
+logger = logging.getLogger(__name__)
+
+# Shows which voices differ between two revisions of a bank and how, and
+# merges two revisions that were edited separately, using the format module's
+# diff_banks() and merge_banks() (see dx7/compare.py).
+
+
+def _read_message(sysex_file: str) -> Tuple[bytes, bytes, Any]:
+    # The file's manufacturer ID, the body of its message (as parse() sees
+    # it) and the module for its format
+    with metrics.timed('read'):
+        with open(sysex_file, 'rb') as fp:
+            message = fp.read()
+
+    if len(message) < 3 or message[0] != SYSEX_START_BYTE or message[-1] != SYSEX_END_BYTE:
+        raise ParseError(f"{sysex_file} is not a complete SysEx message")
+
+    start = _body_offset(message)
+    manufacturer_id = message[1:start]
+    body = message[start:-1]
+
+    return manufacturer_id, body, registry.load(registry.detect_format(tuple(manufacturer_id), body[:4]))
+
+
+def _hook(module: Any, name: str) -> Any:
+    hook = getattr(module, name, None)
+
+    if hook is None:
+        raise NotSupportedError(f"{module.__name__} messages can't be compared")
+
+    return hook
+
+
+def voice_diff_to_dict(voice_diff) -> dict:
+    from ..formats.yamaha.dx7.compare import parameter_label
+
+    return {
+        'slot': voice_diff.slot + 1,
+        'status': voice_diff.status,
+        'old_name': voice_diff.old_name,
+        'new_name': voice_diff.new_name,
+        'moved_from': None if voice_diff.moved_from is None else voice_diff.moved_from + 1,
+        'changes': [{'parameter': parameter_label(change.path), 'old': change.old, 'new': change.new}
+                    for change in voice_diff.changes]
+    }
+
+
+def format_voice_diff(voice_diff: dict) -> List[str]:
+    name = voice_diff['new_name'] if voice_diff['new_name'] is not None else voice_diff['old_name']
+
+    if voice_diff['status'] == 'moved':
+        status = f"moved from slot {voice_diff['moved_from']}"
+    elif voice_diff['status'] == 'changed' and voice_diff['old_name'] != voice_diff['new_name']:
+        status = f"changed (was {voice_diff['old_name']})"
+    else:
+        status = voice_diff['status']
+
+    lines = [f"slot {voice_diff['slot']} ({name}): {status}"]
+    lines.extend(f"    {change['parameter']}: {change['old']!r} -> {change['new']!r}"
+                 for change in voice_diff['changes'] if change['parameter'] != 'NAME')
+
+    return lines
+
+
+def diff_sysex(old_file: str, new_file: str, report: Optional[str] = None) -> List[dict]:
+    # Prints the voices that differ between two files, and returns them
+    _, old_body, old_module = _read_message(old_file)
+    _, new_body, new_module = _read_message(new_file)
+
+    if old_module is not new_module:
+        raise NotSupportedError(f"{old_file} and {new_file} are for different synths")
+
+    with metrics.timed('diff'):
+        voice_diffs = [voice_diff_to_dict(voice_diff)
+                       for voice_diff in _hook(old_module, 'diff_banks')(old_body, new_body)]
+
+    for voice_diff in voice_diffs:
+        for line in format_voice_diff(voice_diff):
+            print(line)
+
+    if report is not None:
+        with open(report, 'w') as fp:
+            json.dump(voice_diffs, fp, indent=2)
+
+    return voice_diffs
+
+
+def merge_sysex(base_file: str, ours_file: str, theirs_file: str, output_file: str,
+                prefer: str = 'ours') -> Dict[int, list]:
+    # Merges the changes theirs_file made to base_file into ours_file,
+    # writing the result to output_file. Prints and returns the conflicts.
+    from ..formats.yamaha.dx7.compare import parameter_label
+
+    manufacturer_id, ours_body, module = _read_message(ours_file)
+    bodies = []
+
+    for sysex_file in (base_file, theirs_file):
+        _, body, other_module = _read_message(sysex_file)
+
+        if other_module is not module:
+            raise NotSupportedError(f"{sysex_file} and {ours_file} are for different synths")
+
+        bodies.append(body)
+
+    with metrics.timed('merge'):
+        merged, conflicts = _hook(module, 'merge_banks')(bodies[0], ours_body, bodies[1], prefer)
+
+    with metrics.timed('write'):
+        with open(output_file, 'wb') as fp:
+            fp.write(bytes([SYSEX_START_BYTE]) + manufacturer_id + merged + bytes([SYSEX_END_BYTE]))
+
+    for slot, slot_conflicts in sorted(conflicts.items()):
+        for conflict in slot_conflicts:
+            print(f"slot {slot + 1}: {parameter_label(conflict.path)}: base {conflict.base!r}, ours {conflict.ours!r}, "
+                  f"theirs {conflict.theirs!r}")
+
+    logger.info('Merged into %s with %d conflicts (kept %s)', output_file,
+                sum(len(slot_conflicts) for slot_conflicts in conflicts.values()), prefer)
+
+    return conflicts
@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional  # noqa
+
+from .. import metrics
+from .catalog import Catalog, CATALOG_FILENAME
+from .cartridges import packed_voices
+from .manifest import MANIFEST_FILENAME
+from .storage import STORE_FILENAME, VoiceStore
+
+logger = logging.getLogger(__name__)
+
+# Exports a patch bank to a single columnar file (see dx7/columnar.py)
+# without reading any of its per-voice .json files. Voices come out in patch
+# list order. Their packed records are read straight out of the .syx files
+# (or the voice store) and decoded a chunk at a time. Authors and banks come
+# from the patch list, and sources from the manifest (or the store's index).
+
+
+def _patch_list(patch_bank_dir: str) -> List[dict]:
+    catalog_file = os.path.join(patch_bank_dir, CATALOG_FILENAME)
+
+    if os.path.exists(catalog_file):
+        with Catalog(catalog_file) as catalog:
+            return catalog.patch_list()
+
+    with open(os.path.join(patch_bank_dir, 'patch_list.json'), 'r') as fp:
+        return json.load(fp)
+
+
+def _sources(patch_bank_dir: str) -> Dict[str, Optional[str]]:
+    # Each voice's SOURCE, where the patch bank knows it
+    if os.path.exists(os.path.join(patch_bank_dir, STORE_FILENAME)):
+        with VoiceStore(patch_bank_dir) as store:
+            return {signature: metadata.get('SOURCE') for signature, (_, _, metadata) in store.index.items()}
+
+    manifest_file = os.path.join(patch_bank_dir, MANIFEST_FILENAME)
+
+    if not os.path.exists(manifest_file):
+        logger.warning('%s has no manifest, so voices will be exported without their sources', patch_bank_dir)
+        return {}
+
+    with open(manifest_file, 'r') as fp:
+        manifest = json.load(fp)
+
+    return {signature: manifest['files'][key]['source'] for signature, key in manifest['owners'].items()
+            if key in manifest['files']}
+
+
+def export_columns(patch_bank_dir: str, output_file: str, chunk_size: Optional[int] = None) -> int:
+    # Returns the number of voices exported
+    from ..formats.yamaha.dx7.columnar import DEFAULT_CHUNK_SIZE, VoiceTableWriter
+    from ..formats.yamaha.dx7.layout import packed_layout
+
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+
+    entries = {entry['signature']: entry for entry in _patch_list(patch_bank_dir)}
+    sources = _sources(patch_bank_dir)
+    layout = packed_layout()
+
+    with VoiceTableWriter(output_file, chunk_size) as writer:
+        chunk = []  # type: List[tuple]
+
+        def flush():
+            with metrics.timed('export', len(chunk)):
+                writer.write_records(b''.join(packed for _, packed in chunk), layout,
+                                     [signature for signature, _ in chunk],
+                                     [{'AUTHOR': entries[signature]['author'],
+                                       'BANK': entries[signature]['source_bank'],
+                                       'SOURCE': sources.get(signature)} for signature, _ in chunk])
+
+        for signature, packed in packed_voices(patch_bank_dir, entries.keys()):
+            chunk.append((signature, packed))
+
+            if len(chunk) == chunk_size:
+                flush()
+                chunk = []
+
+        if chunk:
+            flush()
+
+    logger.info('Exported %d voices to %s', writer.rows, output_file)
+
+    return writer.rows
@@ -13,10 +13,18 @@ def extract_voices(sysex_file: str, output: str, author: Optional[str],
     voices = parse(sysex_file)
 
     if debug:
+        # Show where the voices don't round-trip, and leave the dumped bank
+        # behind to compare by hand
+        from .verify_roundtrip import verify_file, format_difference
+
+        for result in verify_file(sysex_file):
+            for difference in result.get('differences', ()):
+                print(format_difference(difference))
+
         dump(voices, 'debug_output.syx')
 
     for voice in voices:
-        dump([voice], f"{output}/{voice['signature']}.syx")
+        dump([voice], f"{output}/{voice['SIGNATURE']}.syx")
 
         if author and 'AUTHOR' not in voice:
             voice['AUTHOR'] = author
@@ -26,7 +34,7 @@ def extract_voices(sysex_file: str, output: str, author: Optional[str],
         if source:
             voice['SOURCE'] = source
 
-        output_path = f"{output}/{voice['signature']}.json"
+        output_path = f"{output}/{voice['SIGNATURE']}.json"
 
         if not os.path.exists(output_path):
             with open(output_path, 'w+') as fp:
@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple  # noqa
+
+from .. import metrics
+from ..constants import SYSEX_END_BYTE, SYSEX_START_BYTE
+from .build_patch_bank import _scan_tasks
+from .cartridges import packed_voices, PACKED_VOICE_SIZE
+from .diff_sysex import voice_diff_to_dict
+from .manifest import hash_file, MANIFEST_FILENAME
+
+logger = logging.getLogger(__name__)
+
+# What's changed in a directory of sysex files since it was last built into a
+# patch bank: which files are new, gone or different, and for each different
+# file, which voices changed and in which parameters. Everything comes out of
+# one pass over the directory. Files whose size and mtime (or, failing that,
+# content hash) match the patch bank's manifest are skipped without being
+# read. For the rest, the voices the file used to have are put back together
+# from the manifest and the patch bank's packed voices, and compared with the
+# file's voices record by record (see dx7/compare.py), so only voices that
+# actually differ are ever decoded.
+
+
+def _old_body(voices: List[list], packed: Dict[str, bytes]) -> Tuple[bytes, List[int]]:
+    # The message body a file's voices came from, as far as the patch bank
+    # can tell: voices with their names as the manifest has them, laid out
+    # like a bank, or like a single voice if there was only one. Also returns
+    # the slots of voices the patch bank doesn't have (e.g. collapsed
+    # near-duplicates).
+    from ..formats.yamaha import dx7
+    from ..formats.yamaha.dx7.layout import packed_layout
+    from ..formats.yamaha.dx7.native import normalize_voice
+    from ..formats.yamaha.dx7.spec import NAME_ENCODING
+
+    layout = packed_layout()
+    records = bytearray(32 * PACKED_VOICE_SIZE)
+    missing = []
+
+    for slot, (signature, name, _, _) in enumerate(voices[:32]):
+        record = packed.get(signature)
+
+        if record is None:
+            missing.append(slot)
+            continue
+
+        start = slot * PACKED_VOICE_SIZE
+        records[start:start + PACKED_VOICE_SIZE] = record
+        name_start = start + layout.name_offset
+        name_bytes = name.encode(NAME_ENCODING)[:layout.name_length].ljust(layout.name_length)
+        records[name_start:name_start + layout.name_length] = name_bytes
+
+    if len(voices) == 1:
+        records = bytearray(normalize_voice(records, 0, layout))
+        header = dx7.SINGLE_VOICE_HEADER
+    else:
+        header = dx7.MULTI_VOICE_HEADER
+
+    body = header + records + bytes(1)
+
+    return body[:-1] + bytes([dx7.compute_checksum(body)]), missing
+
+
+def _new_body(sysex_path: str) -> bytes:
+    from ..errors import ParseError
+
+    with open(sysex_path, 'rb') as fp:
+        message = fp.read()
+
+    # Only Yamaha's single-byte manufacturer ID gets this far
+    if len(message) < 3 or message[0] != SYSEX_START_BYTE or message[-1] != SYSEX_END_BYTE or message[1] != 0x43:
+        raise ParseError('Not a complete DX7 SysEx message')
+
+    return message[2:-1]
+
+
+def _compare_file(key: str, sysex_path: str, record: Optional[dict], packed: Dict[str, bytes]) -> dict:
+    from ..formats.yamaha import dx7
+    from ..formats.yamaha.dx7.compare import VoiceDiff
+
+    if record is None or not record['voices']:
+        # New, or didn't produce any voices last time
+        status = 'added' if record is None else 'changed'
+        old_body, missing = None, []  # type: Tuple[Optional[bytes], List[int]]
+    else:
+        status = 'changed'
+        old_body, missing = _old_body(record['voices'], packed)
+
+    try:
+        new_body = _new_body(sysex_path)
+
+        if old_body is None:
+            voices = dx7.parse(new_body)
+            voice_diffs = [VoiceDiff(slot, 'added', None, voice['NAME']) for slot, voice in enumerate(voices)]
+        else:
+            with metrics.timed('compare'):
+                voice_diffs = dx7.diff_banks(old_body, new_body)
+    except Exception as e:
+        return {'file': key, 'status': 'error', 'error': str(e), 'voices': []}
+
+    entries = []
+
+    for voice_diff in voice_diffs:
+        entry = voice_diff_to_dict(voice_diff)
+
+        if voice_diff.slot in missing and voice_diff.status != 'added':
+            # Whatever was here isn't in the patch bank to compare against
+            entry.update({'status': 'unknown', 'moved_from': None, 'changes': []})
+
+        entries.append(entry)
+
+    return {'file': key, 'status': status, 'voices': entries}
+
+
+def library_changes(sysex_files_dir: str, patch_bank_dir: str) -> List[dict]:
+    # A report on every file that's been added, removed or changed since
+    # patch_bank_dir was built from sysex_files_dir. Files that changed
+    # without any of their voices changing (e.g. only their padding or
+    # checksum) are reported with no voices.
+    with open(os.path.join(patch_bank_dir, MANIFEST_FILENAME), 'r') as fp:
+        recorded = json.load(fp)['files']
+
+    changed = []  # type: List[Tuple[str, str]]
+    seen = set()
+
+    with metrics.timed('scan'):
+        for task, stat in _scan_tasks(sysex_files_dir):
+            key = os.path.relpath(task[0], sysex_files_dir)
+            record = recorded.get(key)
+            seen.add(key)
+
+            if record is not None and record['size'] == stat.st_size:
+                if record['mtime_ns'] == stat.st_mtime_ns or hash_file(task[0]) == record['sha1']:
+                    continue
+
+            changed.append((key, task[0]))
+
+    # Every voice the changed files used to have, fetched in one go
+    signatures = set(voice[0] for key, _ in changed if key in recorded for voice in recorded[key]['voices'])
+
+    with metrics.timed('read', len(signatures)):
+        packed = dict(packed_voices(patch_bank_dir, sorted(signatures)))
+
+    report = [_compare_file(key, path, recorded.get(key), packed) for key, path in changed]
+    report.extend({'file': key, 'status': 'removed', 'voices': []} for key in sorted(set(recorded) - seen))
+
+    return report
+
+
+def report_library_changes(sysex_files_dir: str, patch_bank_dir: str, report: Optional[str] = None) -> List[dict]:
+    # Prints what library_changes() finds, and writes it to report as JSON
+    from .diff_sysex import format_voice_diff
+
+    changes = library_changes(sysex_files_dir, patch_bank_dir)
+
+    for change in changes:
+        if change['status'] == 'error':
+            print(f"{change['file']}: {change['error']}")
+            continue
+
+        print(f"{change['file']}: {change['status']}")
+
+        for voice_diff in change['voices']:
+            for line in format_voice_diff(voice_diff):
+                print(f"    {line}")
+
+    counts = {}  # type: Dict[str, int]
+
+    for change in changes:
+        counts[change['status']] = counts.get(change['status'], 0) + 1
+
+    changed_voices = sum(1 for change in changes for voice_diff in change['voices'] if voice_diff['status'] != 'added')
+    added_voices = sum(1 for change in changes for voice_diff in change['voices'] if voice_diff['status'] == 'added')
+
+    print(f"{counts.get('added', 0)} files added, {counts.get('removed', 0)} removed, {counts.get('changed', 0)} "
+          f"changed, {counts.get('error', 0)} unreadable; {changed_voices} voices changed, {added_voices} added")
+
+    if report is not None:
+        with open(report, 'w') as fp:
+            json.dump(changes, fp, indent=2)
+
+    return changes
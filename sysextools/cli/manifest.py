@@ -0,0 +1,109 @@
+from hashlib import sha1
+import json
+import os
+from typing import Any, Dict, List, Optional  # noqa
+
+# The manifest records, for every source file that went into a patch bank, what
+# the file looked like when it was last parsed and which voices it produced.
+# That lets build_patch_bank skip files that haven't changed and rebuild the
+# patch list without parsing anything.
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def hash_file(path: str) -> str:
+    digest = sha1()
+
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def file_record(path: str, author: Optional[str], source: Optional[str], voices: List[dict],
+                content_hash: Optional[str] = None) -> dict:
+    stat = os.stat(path)
+
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha1': content_hash if content_hash is not None else hash_file(path),
+        'author': author,
+        'source': source,
+        # Every voice the file produced, duplicates included, in file order
+        'voices': [[v['SIGNATURE'], v['NAME'], v['MANUFACTURER'], v['MODEL']] for v in voices]
+    }
+
+
+class Manifest(object):
+    def __init__(self, output_dir: str, signature_mode: Optional[str] = None, storage: str = 'files',
+                 validate: Optional[str] = None):
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.signature_mode = signature_mode
+        self.storage = storage
+        self.validate = validate
+        self.files = {}  # type: Dict[str, dict]
+        # Maps each signature in the bank to the file whose copy of it was written out
+        self.owners = {}  # type: Dict[str, str]
+        # Maps each voice found to be a near-duplicate to the voice it duplicates
+        self.near_duplicates = {}  # type: Dict[str, str]
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as fp:
+                contents = json.load(fp)
+
+            # Voices written to a different kind of storage aren't in this
+            # one, so they'll all need writing again
+            if contents.get('version') == MANIFEST_VERSION and contents.get('storage', 'files') == storage:
+                self.owners = contents['owners']
+
+                # Signatures recorded under a different mode are no use, and
+                # clamping parameters changes signatures too, so every file
+                # will have to be parsed again
+                if contents.get('signature_mode') == signature_mode and contents.get('validate') == validate:
+                    self.files = contents['files']
+                    self.near_duplicates = contents.get('near_duplicates', {})
+
+    def unchanged_record(self, key: str, path: str, stat: os.stat_result, author: Optional[str],
+                         source: Optional[str], salvage_confidence: Optional[float] = None) -> Optional[dict]:
+        # Returns the file's existing record if the file hasn't changed since
+        # it was recorded. Size and mtime are enough to tell in the common
+        # case; if only the mtime moved, the content hash decides. Files that
+        # didn't parse are tried again if voices are to be salvaged
+        # differently this time.
+        record = self.files.get(key)
+
+        if record is None or record['size'] != stat.st_size:
+            return None
+
+        if record.get('failed') and record.get('salvage_confidence') != salvage_confidence:
+            return None
+
+        if record['author'] != author or record['source'] != source:
+            return None
+
+        if record['mtime_ns'] != stat.st_mtime_ns:
+            if hash_file(path) != record['sha1']:
+                return None
+
+            record['mtime_ns'] = stat.st_mtime_ns
+
+        return record
+
+    def save(self, files: Dict[str, dict], owners: Dict[str, str], near_duplicates: Optional[Dict[str, str]] = None):
+        self.files = files
+        self.owners = owners
+        self.near_duplicates = near_duplicates if near_duplicates is not None else {}
+
+        temp_path = self.path + '.tmp'
+
+        with open(temp_path, 'w') as fp:
+            json.dump({'version': MANIFEST_VERSION, 'signature_mode': self.signature_mode, 'storage': self.storage,
+                       'validate': self.validate, 'files': files, 'owners': owners,
+                       'near_duplicates': self.near_duplicates}, fp)
+
+        os.replace(temp_path, self.path)
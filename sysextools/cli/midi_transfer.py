@@ -0,0 +1,45 @@
+import logging
+import os
+from typing import List, Optional  # noqa
+
+from .. import metrics
+from ..midi import open_backend, Transport
+from ..stream import iter_messages
+
+logger = logging.getLogger(__name__)
+
+
+def _transport(backend: str, port: Optional[str], **kwargs) -> Transport:
+    return Transport(open_backend(backend, **({} if port is None else {'port': port})), **kwargs)
+
+
+def send_sysex(sysex_files: List[str], backend: str = 'raw', port: Optional[str] = None, **kwargs) -> int:
+    # Sends every SysEx message in the given files, in order. Returns the
+    # number of messages sent.
+    with _transport(backend, port, **kwargs) as transport:
+        count = transport.send_messages(message for sysex_file in sysex_files
+                                        for _, message in iter_messages(sysex_file))
+
+    logger.info('Sent %d messages', count)
+
+    return count
+
+
+def receive_sysex(output_dir: str, backend: str = 'raw', port: Optional[str] = None, timeout: float = 10.0,
+                  max_messages: Optional[int] = None, strict: bool = False) -> int:
+    # Writes each SysEx message received to a file of its own in output_dir,
+    # until max_messages have come in or nothing has for timeout seconds.
+    # Returns the number of messages received.
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+
+    with _transport(backend, port) as transport:
+        for message in transport.receive_messages(timeout, max_messages, strict):
+            count += 1
+
+            with metrics.timed('write'), open(os.path.join(output_dir, f"received-{count:05d}.syx"), 'wb') as fp:
+                fp.write(message)
+
+            logger.info('Received a %d-byte message', len(message))
+
+    return count
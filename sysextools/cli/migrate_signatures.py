@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+from typing import Dict, Optional  # noqa
+
+from .. import metrics
+from ..formats.yamaha import dx7
+from .manifest import MANIFEST_FILENAME
+from .storage import STORE_FILENAME, VoiceStore
+
+logger = logging.getLogger(__name__)
+
+# Fields that process_sysex adds to a voice after it's been parsed, and that
+# therefore weren't part of the voice when its signature was computed
+METADATA_KEYS = ('AUTHOR', 'BANK', 'SOURCE', 'SIGNATURE', 'SALVAGED')
+
+SIGNATURE_MAP_FILENAME = 'signature_map.json'
+
+
+def _voice_files(patch_bank_dir: str):
+    for i in range(256):
+        subdir = os.path.join(patch_bank_dir, "{:02x}".format(i))
+
+        if not os.path.isdir(subdir):
+            continue
+
+        for f in os.scandir(subdir):
+            if f.name.endswith('.json'):
+                yield f.path
+
+
+def _is_store(patch_bank_dir: str) -> bool:
+    # Whether the patch bank keeps its voices in a voice store (see
+    # storage.py) rather than a pair of files each
+    return os.path.exists(os.path.join(patch_bank_dir, STORE_FILENAME))
+
+
+def _voices(patch_bank_dir: str):
+    if _is_store(patch_bank_dir):
+        with VoiceStore(patch_bank_dir) as store:
+            for signature in list(store):
+                with metrics.timed('read'):
+                    voice = store.get(signature)
+
+                yield voice
+
+        return
+
+    for json_path in _voice_files(patch_bank_dir):
+        with metrics.timed('read'):
+            with open(json_path, 'r') as fp:
+                voice = json.load(fp)
+
+        yield voice
+
+
+def map_signatures(patch_bank_dir: str, signature_mode: str) -> Dict[str, str]:
+    signature_map = {}
+
+    for voice in _voices(patch_bank_dir):
+        parameters = {key: value for key, value in voice.items() if key not in METADATA_KEYS}
+
+        with metrics.timed('signature'):
+            signature_map[voice['SIGNATURE']] = dx7.compute_signature(parameters, signature_mode)
+
+    return signature_map
+
+
+def _migrate_files(patch_bank_dir: str, signature_map: Dict[str, str]):
+    migrated = set()
+
+    for old_signature, new_signature in signature_map.items():
+        if old_signature == new_signature:
+            migrated.add(new_signature)
+            continue
+
+        old_subdir = os.path.join(patch_bank_dir, old_signature[:2])
+        new_subdir = os.path.join(patch_bank_dir, new_signature[:2])
+
+        if new_signature in migrated:
+            # Two voices that only differed in ways the new signature
+            # normalizes away; the first one keeps the new signature
+            logger.debug("%s is a duplicate of %s under the new signature; removing it", old_signature, new_signature)
+
+            for extension in ('.syx', '.json'):
+                os.remove(os.path.join(old_subdir, old_signature + extension))
+
+            continue
+
+        metrics.count('move')
+        os.replace(os.path.join(old_subdir, f"{old_signature}.syx"),
+                   os.path.join(new_subdir, f"{new_signature}.syx"))
+
+        new_json = os.path.join(new_subdir, f"{new_signature}.json")
+        os.replace(os.path.join(old_subdir, f"{old_signature}.json"), new_json)
+
+        def update_voice(voice):
+            voice['SIGNATURE'] = new_signature
+            return voice
+
+        _rewrite_json(new_json, update_voice)
+        migrated.add(new_signature)
+
+
+def _rewrite_json(path: str, rewrite):
+    with open(path, 'r') as fp:
+        contents = json.load(fp)
+
+    contents = rewrite(contents)
+
+    with open(path, 'w+') as fp:
+        json.dump(contents, fp, indent=2 if path.endswith('patch_list.json') else None)
+
+
+def migrate_signatures(patch_bank_dir: str, signature_mode: str = 'canonical', dry_run: bool = False,
+                       signature_map_file: Optional[str] = None) -> Dict[str, str]:
+    signature_map = map_signatures(patch_bank_dir, signature_mode)
+
+    if signature_map_file is None:
+        signature_map_file = os.path.join(patch_bank_dir, SIGNATURE_MAP_FILENAME)
+
+    with open(signature_map_file, 'w+') as fp:
+        json.dump(signature_map, fp, indent=2)
+
+    if dry_run:
+        return signature_map
+
+    if _is_store(patch_bank_dir):
+        # Records don't include their signatures, so only the index changes
+        metrics.count('move', sum(1 for old, new in signature_map.items() if old != new))
+
+        with VoiceStore(patch_bank_dir) as store:
+            store.rename_many(signature_map)
+    else:
+        _migrate_files(patch_bank_dir, signature_map)
+
+    patch_list_file = os.path.join(patch_bank_dir, 'patch_list.json')
+
+    if os.path.exists(patch_list_file):
+        def update_patch_list(patch_list):
+            seen = set()
+            updated = []
+
+            for entry in patch_list:
+                entry['signature'] = signature_map.get(entry['signature'], entry['signature'])
+
+                if entry['signature'] not in seen:
+                    seen.add(entry['signature'])
+                    updated.append(entry)
+
+            return updated
+
+        _rewrite_json(patch_list_file, update_patch_list)
+
+    manifest_file = os.path.join(patch_bank_dir, MANIFEST_FILENAME)
+
+    if os.path.exists(manifest_file):
+        def update_manifest(manifest):
+            for record in manifest['files'].values():
+                for voice in record['voices']:
+                    voice[0] = signature_map.get(voice[0], voice[0])
+
+            owners = {}
+
+            for signature, owner in manifest['owners'].items():
+                owners.setdefault(signature_map.get(signature, signature), owner)
+
+            manifest['owners'] = owners
+            manifest['signature_mode'] = signature_mode
+
+            return manifest
+
+        _rewrite_json(manifest_file, update_manifest)
+
+    return signature_map
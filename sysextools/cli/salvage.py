@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple  # noqa
+
+from .. import dumps, metrics, parse
+
+logger = logging.getLogger(__name__)
+
+# Sweeps a corpus for files that don't parse, and salvages what voices it can
+# from each of them (see dx7/recover.py), reporting on every voice found and
+# optionally writing the ones worth keeping back out as well-formed banks.
+
+# How many files each worker salvages at a time when salvaging in parallel
+SALVAGE_BATCH_SIZE = 16
+
+# (file, output file) pairs, min_confidence, everything, and whether to
+# collect stats
+_Batch = Tuple[List[Tuple[str, Optional[str]]], float, bool, bool]
+
+
+def salvage_file(sysex_file: str, output_file: Optional[str] = None, min_confidence: float = 0.5,
+                 everything: bool = False) -> Optional[dict]:
+    # Reports on the voices that could be salvaged from a file, writing those
+    # at least min_confidence likely to be intact to output_file (as 32-voice
+    # banks, one after the other) if it's given. Files that parse are left
+    # alone, and None returned, unless everything is set.
+    from ..formats.yamaha import dx7
+
+    with metrics.timed('read'), open(sysex_file, 'rb') as fp:
+        data = fp.read()
+
+    error = None
+
+    try:
+        parse(data)
+    except Exception as e:
+        error = str(e)
+
+    if error is None and not everything:
+        return None
+
+    with metrics.timed('salvage'):
+        salvaged = dx7.salvage(data)
+
+    kept = [result.voice for result in salvaged if result.voice is not None and result.confidence >= min_confidence]
+
+    if output_file is not None and kept:
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+
+        with metrics.timed('write', len(kept)), open(output_file, 'wb') as fp:
+            for i in range(0, len(kept), 32):
+                fp.write(dumps(kept[i:i + 32]))
+
+    return {
+        'file': sysex_file,
+        'error': error,
+        'recovered': len(kept),
+        'voices': [{
+            'offset': result.offset,
+            'slot': result.slot,
+            'status': result.status,
+            'confidence': result.confidence,
+            'problems': list(result.problems),
+            'name': result.voice['NAME'] if result.voice is not None else None,
+            'signature': result.voice['SIGNATURE'] if result.voice is not None else None
+        } for result in salvaged]
+    }
+
+
+def _salvage_batch(files: List[Tuple[str, Optional[str]]], min_confidence: float, everything: bool) -> List[dict]:
+    reports = []
+
+    for sysex_file, output_file in files:
+        report = salvage_file(sysex_file, output_file, min_confidence, everything)
+
+        if report is not None:
+            reports.append(report)
+
+    return reports
+
+
+def _salvage_files(args: _Batch) -> Tuple[List[dict], Optional[dict]]:
+    files, min_confidence, everything, collect_stats = args
+
+    if not collect_stats:
+        return _salvage_batch(files, min_confidence, everything), None
+
+    with metrics.collect_stats() as stats:
+        reports = _salvage_batch(files, min_confidence, everything)
+
+    return reports, stats.to_dict()
+
+
+def salvage_corpus(sysex_files_dir: str, output_dir: Optional[str] = None, report: Optional[str] = None,
+                   jobs: int = 1, min_confidence: float = 0.5, everything: bool = False) -> List[dict]:
+    # Salvages every .syx file under sysex_files_dir that doesn't parse,
+    # writing what's recovered to the same place under output_dir, if given,
+    # and a report on every file to report, if given
+    files = []
+
+    for root, dirs, filenames in os.walk(sysex_files_dir):
+        dirs.sort()
+
+        for filename in sorted(filenames):
+            if filename.lower().endswith('.syx'):
+                path = os.path.join(root, filename)
+                output_file = None if output_dir is None else os.path.join(
+                    output_dir, os.path.relpath(path, sysex_files_dir))
+                files.append((path, output_file))
+
+    # Worker processes have to collect their own stats and send them back
+    batches = [(files[i:i + SALVAGE_BATCH_SIZE], min_confidence, everything, jobs > 1 and metrics.enabled())
+               for i in range(0, len(files), SALVAGE_BATCH_SIZE)]
+
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            batch_reports = list(pool.map(_salvage_files, batches))
+    else:
+        batch_reports = list(map(_salvage_files, batches))
+
+    reports = []
+
+    for batch, stats in batch_reports:
+        reports.extend(batch)
+        metrics.merge(stats)
+
+    for file_report in reports:
+        statuses = [voice['status'] for voice in file_report['voices']]
+        logger.info('%s: recovered %d voices (%d ok, %d suspect, %d invalid)', file_report['file'],
+                    file_report['recovered'], statuses.count('ok'), statuses.count('suspect'),
+                    statuses.count('invalid'))
+
+    print(f"{len(files)} files, {sum(1 for r in reports if r['error'])} that don't parse; "
+          f"recovered {sum(r['recovered'] for r in reports)} voices")
+
+    if report is not None:
+        with open(report, 'w') as fp:
+            json.dump(reports, fp, indent=2)
+
+    return reports
@@ -0,0 +1,298 @@
+import json
+import os
+import shutil
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Tuple  # noqa
+
+from .. import dump_many, metrics
+from ..errors import NotSupportedError
+from .manifest import MANIFEST_FILENAME
+
+# The places build_patch_bank can keep a patch bank's voices. Both kinds of
+# storage can be asked whether they hold a signature, given voices to write and
+# told to remove one.
+
+
+class DirectoryStorage(object):
+    # The original layout: a .syx and a .json file per voice, spread across 256
+    # subdirectories by the first two characters of the voice's signature
+    def __init__(self, path: str):
+        self.path = path
+
+    def create(self):
+        # Build subdirectories for each of the prefixes so we can keep directories relatively small
+        for i in range(256):
+            os.makedirs(os.path.join(self.path, "{:02x}".format(i)), exist_ok=True)
+
+    def __contains__(self, signature: str) -> bool:
+        return os.path.exists(self.output_paths(signature)[0])
+
+    def output_paths(self, signature: str) -> Tuple[str, str]:
+        output_subdir = os.path.join(self.path, signature[:2])
+
+        return (os.path.join(output_subdir, f"{signature}.syx"),
+                os.path.join(output_subdir, f"{signature}.json"))
+
+    def put_many(self, voices: List[dict]) -> int:
+        # Each voice is written as a bank of its own, as it always has been
+        count = dump_many(([voice], self.output_paths(voice['SIGNATURE'])[0]) for voice in voices)
+
+        for voice in voices:
+            with metrics.timed('write_json'):
+                with open(self.output_paths(voice['SIGNATURE'])[1], 'w+') as fp:
+                    json.dump(voice, fp)
+
+        return count
+
+    def put(self, voice: dict):
+        self.put_many([voice])
+
+    def remove(self, signature: str):
+        for path in self.output_paths(signature):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        pass
+
+
+# A voice store keeps the voices in a handful of large segment files instead. Every voice is a fixed-size record, either
+# in the 155-byte single-voice layout (which can hold anything the DX7 can
+# send) or the 128-byte packed layout of 32-voice banks. An append-only index
+# maps each signature to its record and the metadata (author, bank and so on)
+# that build_patch_bank attaches to the voice.
+
+STORE_FILENAME = 'store.json'
+INDEX_FILENAME = 'index.jsonl'
+STORE_VERSION = 1
+
+# Segments are started afresh once they would grow past this size
+SEGMENT_SIZE = 1 << 26
+
+# The layout (from dx7/layout.py) each record format uses. The DX7 modules
+# are only imported once a store is opened, so that tools that never touch a
+# store don't pay for them
+RECORD_LAYOUTS = {
+    'single': 'unpacked_layout',
+    'packed': 'packed_layout'
+}
+
+# The keys that parsing a voice produces, as opposed to metadata
+_PARSED_KEYS = ('NAME', 'MANUFACTURER', 'MODEL', 'SIGNATURE')
+
+
+class VoiceStore(object):
+    def __init__(self, path: str, record_format: str = 'single'):
+        self.path = path
+        store_file = os.path.join(path, STORE_FILENAME)
+
+        if os.path.exists(store_file):
+            with open(store_file, 'r') as fp:
+                contents = json.load(fp)
+
+            if contents.get('version') != STORE_VERSION:
+                raise ValueError('Unsupported voice store version %s' % (contents.get('version')))
+
+            # The record format is fixed when the store is created
+            record_format = contents['record_format']
+        else:
+            if record_format not in RECORD_LAYOUTS:
+                raise ValueError('Unknown record format %s' % (record_format))
+
+            os.makedirs(path, exist_ok=True)
+
+            with open(store_file, 'w') as fp:
+                json.dump({'version': STORE_VERSION, 'record_format': record_format}, fp)
+
+        self.record_format = record_format
+        from ..formats.yamaha.dx7 import layout
+
+        self.layout = getattr(layout, RECORD_LAYOUTS[record_format])()
+
+        # Maps each signature to (segment, offset, metadata)
+        self.index = {}  # type: Dict[str, Tuple[int, int, dict]]
+        self._index_path = os.path.join(path, INDEX_FILENAME)
+
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'r') as fp:
+                for line in fp:
+                    signature, segment, offset, metadata = json.loads(line)
+
+                    # Later entries supersede earlier ones; a null segment
+                    # means the voice was removed
+                    if segment is None:
+                        self.index.pop(signature, None)
+                    else:
+                        self.index[signature] = (segment, offset, metadata)
+
+        self._segment = 0
+
+        while os.path.exists(self._segment_path(self._segment + 1)):
+            self._segment += 1
+
+        self._readers = {}  # type: Dict[int, IO[bytes]]
+
+    def __enter__(self) -> 'VoiceStore':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, signature: str) -> bool:
+        return signature in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def close(self):
+        for reader in self._readers.values():
+            reader.close()
+
+        self._readers = {}
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, 'segment-{:05d}.dat'.format(segment))
+
+    def create(self):
+        pass
+
+    def put_many(self, voices: Iterable[dict]):
+        # Appends every voice to the current segment with a single write (or
+        # one per segment, if the batch spills over into a new one), then
+        # records them in the index
+        from ..formats.yamaha import dx7
+
+        segment_path = self._segment_path(self._segment)
+        segment_size = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+        records = bytearray()
+        entries = []
+
+        for voice in voices:
+            if voice['MANUFACTURER'] != 'yamaha' or voice['MODEL'] != 'dx7':
+                raise NotSupportedError('Voice stores can only hold DX7 voices')
+
+            if segment_size + len(records) + self.layout.size > SEGMENT_SIZE:
+                self._append(records)
+                self._segment += 1
+                segment_size = 0
+                records = bytearray()
+
+            offset = segment_size + len(records)
+            records.extend(bytes(self.layout.size))
+            dx7.encode_voice_into(voice, self.layout, records, len(records) - self.layout.size)
+
+            if isinstance(voice, dx7.DX7Voice):
+                metadata = voice.metadata
+            else:
+                metadata = {key: value for key, value in voice.items() if key.isupper() and key not in _PARSED_KEYS}
+
+            entries.append([voice['SIGNATURE'], self._segment, offset, metadata])
+
+        self._append(records)
+        self._write_index(entries)
+
+    def put(self, voice: dict):
+        self.put_many([voice])
+
+    def remove(self, signature: str):
+        # The record itself stays where it is; only the index forgets it
+        if signature in self.index:
+            self._write_index([[signature, None, None, None]])
+
+    def _append(self, records: bytearray):
+        if len(records) == 0:
+            return
+
+        with open(self._segment_path(self._segment), 'ab') as fp:
+            fp.write(records)
+
+    def _write_index(self, entries: List[list]):
+        with open(self._index_path, 'a') as fp:
+            fp.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+        for signature, segment, offset, metadata in entries:
+            if segment is None:
+                self.index.pop(signature, None)
+            else:
+                self.index[signature] = (segment, offset, metadata)
+
+    def rename_many(self, signature_map: Dict[str, str]):
+        # Moves each voice in signature_map over to its new signature. The
+        # index is written out afresh rather than appended to, since every
+        # entry in it may change. Voices that end up with the signature of one
+        # before them are dropped, as their records would be identical.
+        index = {}  # type: Dict[str, Tuple[int, int, dict]]
+
+        for signature, entry in self.index.items():
+            index.setdefault(signature_map.get(signature, signature), entry)
+
+        temp_path = self._index_path + '.tmp'
+
+        with open(temp_path, 'w') as fp:
+            fp.write(''.join(json.dumps([signature, segment, offset, metadata]) + '\n'
+                             for signature, (segment, offset, metadata) in index.items()))
+
+        os.replace(temp_path, self._index_path)
+        self.index = index
+
+    def get_record(self, signature: str) -> bytes:
+        segment, offset, _ = self.index[signature]
+
+        if segment not in self._readers:
+            self._readers[segment] = open(self._segment_path(segment), 'rb')
+
+        reader = self._readers[segment]
+        reader.seek(offset)
+
+        return reader.read(self.layout.size)
+
+    def get(self, signature: str) -> dict:
+        # The voice exactly as build_patch_bank would have written it to its
+        # .json file
+        from ..formats.yamaha import dx7
+        from ..formats.yamaha.dx7.native import decode_voice
+
+        voice = dx7.parse_voice_parameters(decode_voice(self.get_record(signature), 0, self.layout))
+        voice['SIGNATURE'] = signature
+        voice.update(self.index[signature][2])
+
+        return voice
+
+
+def export_directory_layout(store_dir: str, output_dir: str, batch_size: int = 256) -> int:
+    # Writes a voice store's voices out in the directory layout, along with
+    # its patch list and manifest, so that the result is what building the
+    # patch bank without a store would have produced. Returns the number of
+    # voices exported.
+    directory = DirectoryStorage(output_dir)
+    directory.create()
+    count = 0
+
+    with VoiceStore(store_dir) as store:
+        signatures = list(store)
+
+        for i in range(0, len(signatures), batch_size):
+            count += directory.put_many([store.get(signature) for signature in signatures[i:i + batch_size]])
+
+    patch_list_file = os.path.join(store_dir, 'patch_list.json')
+
+    if os.path.exists(patch_list_file):
+        shutil.copyfile(patch_list_file, os.path.join(output_dir, 'patch_list.json'))
+
+    manifest_file = os.path.join(store_dir, MANIFEST_FILENAME)
+
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as fp:
+            manifest = json.load(fp)
+
+        # Later builds into the exported directory carry on from here
+        manifest['storage'] = 'files'
+
+        with open(os.path.join(output_dir, MANIFEST_FILENAME), 'w') as fp:
+            json.dump(manifest, fp)
+
+    return count
@@ -0,0 +1,265 @@
+from collections import Counter
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple  # noqa
+
+from .. import dumps, metrics, parse, registry
+from ..constants import EXTENDED_MANUFACTURER_ID_BYTE
+from ..errors import NotSupportedError, ParseError
+from ..stream import iter_messages
+
+logger = logging.getLogger(__name__)
+
+# Checks that parsing a message and dumping what was parsed gives back the
+# same bytes, for every message in a corpus. Everything happens in memory. By
+# default, messages that don't come back the same are diffed parameter by
+# parameter, using the format's describe_differences() if it has one. The
+# fast path only compares lengths and checksums, which is enough to know
+# whether a corpus round-trips, but not why it doesn't. Optionally, messages
+# are also checked for parity: that the format's parsing engines agree on them,
+# for formats with a check_parity().
+
+# How many files each worker verifies at a time when verifying in parallel
+VERIFY_BATCH_SIZE = 16
+
+
+def _body_offset(message: bytes) -> int:
+    # Where the part of the message that format modules see starts
+    return 4 if message[1] == EXTENDED_MANUFACTURER_ID_BYTE else 2
+
+
+def _byte_differences(original, dumped) -> List[dict]:
+    differences = [{'offset': offset, 'field': 'byte', 'original': a, 'dumped': b}
+                   for offset, (a, b) in enumerate(zip(original, dumped)) if a != b]
+
+    if len(original) != len(dumped):
+        differences.append({'offset': min(len(original), len(dumped)), 'field': 'length',
+                            'original': len(original), 'dumped': len(dumped)})
+
+    return differences
+
+
+def _format_function(message: bytes, name: str):
+    # The named function from the message's format module, if the format is
+    # supported and has one
+    start = _body_offset(message)
+
+    try:
+        module = registry.load(registry.detect_format(tuple(message[1:start]), message[start:start + 4]))
+    except NotSupportedError:
+        return None
+
+    return getattr(module, name, None)
+
+
+def describe_differences(original: bytes, dumped: bytes) -> List[dict]:
+    # Differences between two complete messages, with offsets into the
+    # message
+    start = _body_offset(original)
+    original_body = original[start:-1]
+    dumped_body = dumped[start:-1]
+    describe = _format_function(original, 'describe_differences')
+
+    if describe is None:
+        differences = _byte_differences(original_body, dumped_body)
+    else:
+        differences = [difference._asdict() for difference in describe(original_body, dumped_body)]
+
+    for difference in differences:
+        difference['offset'] += start
+
+    return differences
+
+
+def verify_message(message: bytes, fast: bool = False, engine: Optional[str] = None, parity: bool = False) -> dict:
+    # Round-trips a single message. A message with a single voice in it is
+    # dumped as a single-voice message, and anything else as a bank, same as
+    # dumps() does.
+    kwargs = {} if engine is None else {'engine': engine}  # type: Dict[str, Any]
+
+    with metrics.timed('verify'):
+        voices = parse(message, **kwargs)
+        dumped = dumps(voices[0] if len(voices) == 1 else voices, **kwargs)
+
+    result = {'voices': len(voices)}  # type: Dict[str, Any]
+
+    if fast:
+        # The checksum is the last byte before the end byte
+        result['ok'] = len(dumped) == len(message) and dumped[-2] == message[-2]
+    else:
+        result['ok'] = dumped == message
+
+        if not result['ok']:
+            with metrics.timed('diff'):
+                result['differences'] = describe_differences(message, dumped)
+
+    check_parity = _format_function(message, 'check_parity') if parity else None
+
+    if check_parity is not None:
+        with metrics.timed('parity'):
+            result['parity'] = check_parity(message[_body_offset(message):-1])
+
+    return result
+
+
+def verify_file(sysex_file: str, fast: bool = False, engine: Optional[str] = None,
+                parity: bool = False) -> List[dict]:
+    # Verifies every message in a file. Messages from manufacturers that
+    # aren't supported are reported as skipped.
+    results = []
+
+    try:
+        messages = list(iter_messages(sysex_file))
+    except OSError as e:
+        return [{'file': sysex_file, 'offset': None, 'ok': False, 'error': str(e)}]
+
+    for offset, message in messages:
+        result = {'file': sysex_file, 'offset': offset}  # type: Dict[str, Any]
+
+        try:
+            result.update(verify_message(message, fast, engine, parity))
+        except NotSupportedError as e:
+            result.update({'ok': None, 'skipped': str(e)})
+        except (ParseError, ValueError) as e:
+            result.update({'ok': False, 'error': str(e)})
+
+        results.append(result)
+
+    if not messages:
+        results.append({'file': sysex_file, 'offset': None, 'ok': False, 'error': 'No SysEx messages found'})
+
+    return results
+
+
+def _verify_files(args: Tuple[List[str], bool, Optional[str], bool, bool]) -> Tuple[List[dict], Optional[dict]]:
+    paths, fast, engine, parity, collect_stats = args
+
+    if not collect_stats:
+        return [result for path in paths for result in verify_file(path, fast, engine, parity)], None
+
+    with metrics.collect_stats() as stats:
+        results = [result for path in paths for result in verify_file(path, fast, engine, parity)]
+
+    return results, stats.to_dict()
+
+
+def _scan(paths: List[str]) -> List[str]:
+    sysex_files = []
+
+    for path in paths:
+        if not os.path.isdir(path):
+            sysex_files.append(path)
+            continue
+
+        for root, dirs, filenames in os.walk(path):
+            dirs.sort()
+            sysex_files.extend(os.path.join(root, filename) for filename in sorted(filenames)
+                               if filename.lower().endswith('.syx'))
+
+    return sysex_files
+
+
+def verify_corpus(paths: List[str], jobs: int = 1, fast: bool = False, engine: Optional[str] = None,
+                  parity: bool = False) -> List[dict]:
+    # Verifies every .syx file in paths (files, or directories to search),
+    # spreading the files across jobs worker processes
+    sysex_files = _scan(paths)
+    batches = [(sysex_files[i:i + VERIFY_BATCH_SIZE], fast, engine, parity, metrics.enabled())
+               for i in range(0, len(sysex_files), VERIFY_BATCH_SIZE)]
+
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            batch_results = list(pool.map(_verify_files, batches))
+    else:
+        batch_results = [_verify_files(batch) for batch in batches]
+
+    results = []
+
+    for batch, stats in batch_results:
+        results.extend(batch)
+        metrics.merge(stats)
+
+    return results
+
+
+def summarize(results: List[dict]) -> dict:
+    fields = Counter()  # type: Counter
+
+    for result in results:
+        fields.update(difference['field'] for difference in result.get('differences', ()))
+
+    return {
+        'messages': len(results),
+        'ok': sum(1 for result in results if result['ok']),
+        'mismatched': sum(1 for result in results if result['ok'] is False and 'error' not in result),
+        'errors': sum(1 for result in results if 'error' in result),
+        'skipped': sum(1 for result in results if result['ok'] is None),
+        'parity_failures': sum(1 for result in results if result.get('parity') is False),
+        'fields': dict(fields.most_common())
+    }
+
+
+def format_difference(difference: dict) -> str:
+    location = []
+
+    if difference.get('voice') is not None:
+        location.append('voice %d' % (difference['voice'] + 1))
+
+    if difference.get('operator') is not None:
+        location.append('OP%d' % (difference['operator']))
+
+    line = '%s%s at byte %d: %r -> %r' % (' '.join(location) + ' ' if location else '', difference['field'],
+                                          difference['offset'], difference['original'], difference['dumped'])
+
+    original_value = difference.get('original_value')
+    dumped_value = difference.get('dumped_value')
+
+    if original_value is not None and original_value == dumped_value:
+        # Usually an enum with more than one raw value for the same thing
+        line += ' (both %r)' % (original_value)
+    elif original_value is not None or dumped_value is not None:
+        line += ' (%r -> %r)' % (original_value, dumped_value)
+
+    return line
+
+
+def verify_roundtrip(paths: List[str], jobs: int = 1, fast: bool = False, engine: Optional[str] = None,
+                     parity: bool = False, report: Optional[str] = None) -> bool:
+    # Prints what didn't round-trip (or, with parity, wasn't parsed the same
+    # way by every engine) and a summary, and returns whether everything did
+    results = verify_corpus(paths, jobs, fast, engine, parity)
+
+    for result in results:
+        if result.get('parity') is False:
+            print(f"{result['file']} @ {result['offset']}: the parsing engines disagree on it")
+
+        if result['ok']:
+            continue
+
+        if result['ok'] is None:
+            logger.info('%s @ %d: skipped: %s', result['file'], result['offset'], result['skipped'])
+        elif 'error' in result:
+            print(f"{result['file']} @ {result['offset']}: {result['error']}")
+        else:
+            print(f"{result['file']} @ {result['offset']}: does not round-trip")
+
+            for difference in result.get('differences', ()):
+                print(f"    {format_difference(difference)}")
+
+    summary = summarize(results)
+
+    print(f"{summary['messages']} messages: {summary['ok']} ok, {summary['mismatched']} mismatched, "
+          f"{summary['errors']} errors, {summary['skipped']} skipped"
+          + (f", {summary['parity_failures']} parsed differently by different engines" if parity else ''))
+
+    for field, count in summary['fields'].items():
+        print(f"    {field}: {count}")
+
+    if report is not None:
+        with open(report, 'w') as fp:
+            json.dump({'summary': summary, 'results': results}, fp, indent=2)
+
+    return summary['mismatched'] == 0 and summary['errors'] == 0 and summary['parity_failures'] == 0
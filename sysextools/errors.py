@@ -4,3 +4,11 @@ class ParseError(Exception):
 
 class NotSupportedError(Exception):
     pass
+
+
+class ChecksumError(ParseError):
+    pass
+
+
+class RangeError(ParseError):
+    pass
@@ -1,26 +1,30 @@
-from typing import Any, Dict, List
-from . import dx7
-from ...errors import NotSupportedError
+from typing import Any, Dict, List, Union
+from . import dx7  # noqa
+from ... import registry
 
 MANUFACTURER_ID = (0x43,)
 
 
-def parse(sysex_bytes: bytes, model_hint: str = None) -> list:
-    # TODO: actually try to guess the model from sysex
-    return dx7.parse(sysex_bytes)
+def parse(sysex_bytes: bytes, model_hint: str = None, **kwargs) -> list:
+    # The model is worked out from the message's header unless it's given
+    if model_hint is None:
+        fmt = registry.detect_format(MANUFACTURER_ID, sysex_bytes[:4])
+    else:
+        fmt = registry.get_format('yamaha', model_hint)
 
+    return registry.load(fmt).parse(sysex_bytes, **kwargs)
 
-def dump(parsed_sysex: List[Dict[str, Any]]) -> bytes:
-    model = parsed_sysex[0]['MODEL']
 
-    if model == 'dx7':
-        return dx7.dump(parsed_sysex)
+def dump(parsed_sysex: Union[Dict[str, Any], List[Dict[str, Any]]], **kwargs) -> bytes:
+    # A single voice (rather than a list of them) is dumped as a single-voice
+    # message
+    if isinstance(parsed_sysex, list):
+        model = parsed_sysex[0]['MODEL']
     else:
-        raise NotSupportedError()
+        model = parsed_sysex['MODEL']
+
+    return registry.load(registry.get_format('yamaha', model)).dump(parsed_sysex, **kwargs)
 
 
 def add_headers_and_footers(bank_bytes: bytes, model: str) -> bytes:
-    if model == 'dx7':
-        return dx7.add_headers_and_footers(bank_bytes)
-    else:
-        raise NotSupportedError()
+    return registry.load(registry.get_format('yamaha', model)).add_headers_and_footers(bank_bytes)
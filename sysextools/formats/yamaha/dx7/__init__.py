@@ -1,11 +1,22 @@
-from copy import deepcopy
+from collections import Counter
+from functools import lru_cache
 from hashlib import sha1
 import json
-from typing import cast, Type, Union
+import logging
+from typing import Any, cast, Dict, List, Optional, Tuple, Type, Union  # noqa
 
 import bread
 
-from .spec import sysex_dump_message
+from .... import metrics
+from ....errors import ParseError, RangeError
+from .bulk import ENUMS, enum_lookup, field_enums, parse_many_to_array  # noqa
+from .layout import Layout, packed_layout, per_layout, unpacked_layout
+from .native import DecodedStruct, decode_voice, normalize_voice, transcode_voice
+from .ranges import record_counts, validate_voices, VALIDATE_MODES
+from .spec import NAME_ENCODING, sysex_dump_message
+from .voice import DX7Operator, DX7Voice  # noqa
+
+logger = logging.getLogger(__name__)
 
 # Single-voice SysEx messages for the DX7 expand all 155 parameters into a
 # parameter per byte. Multi-voice messages compact each voice into 128 bytes
@@ -15,8 +26,18 @@ SYSEX_HEADER_SIZE = 4
 SINGLE_VOICE_SYSEX_LENGTH = 155 + SYSEX_HEADER_SIZE + 1
 MULTI_VOICE_SYSEX_LENGTH = 32 * 128 + SYSEX_HEADER_SIZE + 1
 
+# Headers for each kind of message: sub-status and channel, format number, and
+# the byte count as a 7-bit MSB and LSB
+SINGLE_VOICE_HEADER = bytes([0x00, 0x00, 0x01, 0x1b])
+MULTI_VOICE_HEADER = bytes([0x00, 0x09, 0x20, 0x00])
+
+# Voices and operators are parsed by reading their fields as attributes: from a
+# bread struct, or from a DecodedStruct, DX7Voice or DX7Operator standing in
+# for one. None of them declare those fields, hence Any
+_StructLike = Any
 
-def parse_operator(operator: Type[bread.BreadStruct]) -> dict:
+
+def parse_operator(operator: _StructLike) -> dict:
     parsed_operator = {
         'envelope_generator': {
             'rates': operator.eg_rates.as_native(),
@@ -66,14 +87,151 @@ def load_parsed_operator_into_struct(operator: dict, struct: Type[bread.BreadStr
     struct.output_level = operator['output_level']
 
 
-def compute_signature(voice):
-    voice_copy = deepcopy(voice)
-    del voice_copy['NAME']
+# Where each field in the layouts (see spec.py) ends up in a parsed voice, as
+# the keys to follow from the voice (or, for operator fields, the operator) to
+# get to it. These mirror parse_operator() and parse_voice_parameters(), and
+# let parsed voices be encoded without loading them into a struct first.
+OPERATOR_FIELD_PATHS = {
+    'eg_rates': ('envelope_generator', 'rates'),
+    'eg_levels': ('envelope_generator', 'levels'),
+    'keyboard_level_scaling_break_point': ('keyboard', 'level_scaling', 'break_point'),
+    'keyboard_level_scaling_left_depth': ('keyboard', 'level_scaling', 'left_depth'),
+    'keyboard_level_scaling_right_depth': ('keyboard', 'level_scaling', 'right_depth'),
+    'keyboard_level_scaling_left_curve': ('keyboard', 'level_scaling', 'left_curve'),
+    'keyboard_level_scaling_right_curve': ('keyboard', 'level_scaling', 'right_curve'),
+    'keyboard_rate_scaling': ('keyboard', 'rate_scaling'),
+    'key_velocity_sensitivity': ('keyboard', 'velocity_sensitivity'),
+    'osc_detune': ('oscillator', 'detune'),
+    'osc_frequency_fine': ('oscillator', 'frequency', 'fine'),
+    'osc_frequency_coarse': ('oscillator', 'frequency', 'coarse'),
+    'osc_mode': ('oscillator', 'mode'),
+    'amp_mod_sensitivity': ('amp_mod_sensitivity',),
+    'output_level': ('output_level',)
+}
+
+VOICE_FIELD_PATHS = {
+    'pitch_eg_rates': ('pitch_envelope_generator', 'rates'),
+    'pitch_eg_levels': ('pitch_envelope_generator', 'levels'),
+    'algorithm': ('algorithm',),
+    'feedback': ('feedback',),
+    'oscillator_sync': ('oscillator_key_sync',),
+    'lfo_speed': ('lfo', 'speed'),
+    'lfo_delay': ('lfo', 'delay'),
+    'lfo_pitch_mod_depth': ('lfo', 'pitch_mod_depth'),
+    'lfo_amp_mod_depth': ('lfo', 'amp_mod_depth'),
+    'lfo_sync': ('lfo', 'key_sync'),
+    'lfo_waveform': ('lfo', 'waveform'),
+    'pitch_mod_sensitivity': ('pitch_mod_sensitivity',),
+    'transpose': ('transpose',)
+}
+
+
+@per_layout
+def _encoding_plan(layout: Layout) -> Tuple[List[Tuple[Optional[int], tuple]], list]:
+    # The containers (dicts and lists) in a parsed voice that the layout's
+    # fields are found in, as (operator, keys) pairs, and for each field, the
+    # container it's in, its key there, and how to encode it. Operators are
+    # listed from OP1 in parsed voices, and from OP6 in the layouts.
+    containers = []  # type: List[Tuple[Optional[int], tuple]]
+    fields = []
+
+    for field in layout.fields:
+        if field.operator is None:
+            operator = None
+            path = VOICE_FIELD_PATHS[field.name]
+        else:
+            operator = 5 - field.operator
+            path = OPERATOR_FIELD_PATHS[field.name]
+
+        if field.element is None:
+            container = (operator, path[:-1])
+            key = path[-1]  # type: Any
+        else:
+            container = (operator, path)
+            key = field.element
+
+        if container not in containers:
+            containers.append(container)
+
+        fields.append((containers.index(container), key, field.encode, field.name, field.byte, field.shift))
+
+    return containers, fields
+
+
+def encode_parsed_fields(voice: dict, layout: Layout, out: bytearray, offset: int = 0):
+    # Writes every parameter of a parsed voice except the name into out, which
+    # is expected to be zeroed where the voice will go
+    container_paths, fields = _encoding_plan(layout)
+    operators = voice['operators']
+    containers = []
+
+    for operator, path in container_paths:
+        container = voice if operator is None else operators[operator]
+
+        for key in path:
+            container = container[key]
+
+        containers.append(container)
+
+    for container, key, encode, name, byte, shift in fields:
+        value = containers[container][key]
+
+        try:
+            raw = encode[value]
+        except (KeyError, TypeError):
+            raise ValueError('%s is not a valid value for %s' % (value, name))
+
+        out[offset + byte] |= raw << shift
+
+
+def _json_signature(voice: dict) -> str:
+    # The original signature: a hash of the voice's JSON representation, minus
+    # its name. A shallow copy is enough since nothing nested is modified
+    voice_copy = {key: value for key, value in voice.items() if key != 'NAME'}
 
     return sha1(json.dumps(voice_copy, sort_keys=True).encode('utf-8')).hexdigest()
 
 
-def parse_voice(voice: Type[bread.BreadStruct]) -> dict:
+def canonical_bytes(voice: Union[dict, DX7Voice]) -> bytes:
+    # The voice's parameters in the single-voice (unpacked) layout, minus the
+    # name. Values with several encodings, like the sample-and-hold waveform,
+    # are normalized to the one that would be written back out
+    if isinstance(voice, DX7Voice):
+        return voice.canonical_bytes
+
+    layout = unpacked_layout()
+    data = bytearray(layout.size)
+    encode_parsed_fields(voice, layout, data)
+
+    return bytes(data[:layout.canonical_size])
+
+
+def _canonical_signature(voice: dict) -> str:
+    return sha1(canonical_bytes(voice)).hexdigest()
+
+
+# 'json' signatures are the ones existing patch banks are laid out by;
+# 'canonical' ones are much cheaper to compute. migrate-signatures converts a
+# patch bank from one to the other.
+SIGNATURE_MODES = {
+    'json': _json_signature,
+    'canonical': _canonical_signature
+}
+
+DEFAULT_SIGNATURE_MODE = 'json'
+
+
+def compute_signature(voice: dict, mode: Optional[str] = None) -> str:
+    if mode is None:
+        mode = DEFAULT_SIGNATURE_MODE
+
+    if mode not in SIGNATURE_MODES:
+        raise ValueError('Unknown signature mode %s' % (mode))
+
+    return SIGNATURE_MODES[mode](voice)
+
+
+def parse_voice_parameters(voice: _StructLike) -> dict:
     parsed_voice = {
         'operators': [],
         'pitch_envelope_generator': {
@@ -104,12 +262,30 @@ def parse_voice(voice: Type[bread.BreadStruct]) -> dict:
     for op in reversed(voice.operators):
         parsed_voice['operators'].append(parse_operator(op))
 
-    parsed_voice['SIGNATURE'] = compute_signature(parsed_voice)
+    return parsed_voice
+
+
+def parse_voice(voice: _StructLike, signature_mode: Optional[str] = None) -> dict:
+    with metrics.timed('parse_voice'):
+        parsed_voice = parse_voice_parameters(voice)
+
+    if signature_mode is None:
+        signature_mode = DEFAULT_SIGNATURE_MODE
+
+    with metrics.timed('signature'):
+        if signature_mode == 'canonical' and isinstance(voice, DecodedStruct):
+            # The native decoder has already worked out the canonical encoding
+            parsed_voice['SIGNATURE'] = sha1(voice.canonical_bytes).hexdigest()
+        else:
+            parsed_voice['SIGNATURE'] = compute_signature(parsed_voice, signature_mode)
 
     return parsed_voice
 
 
-def load_parsed_voice_into_struct(voice: dict, struct: Type[bread.BreadStruct]):
+def load_parsed_voice_into_struct(voice: Union[dict, DX7Voice], struct: Type[bread.BreadStruct]):
+    if isinstance(voice, DX7Voice):
+        voice = parse_voice_parameters(voice)
+
     for parsed_operator, struct_operator in zip(reversed(voice['operators']), struct.operators):
         load_parsed_operator_into_struct(parsed_operator, struct_operator)
 
@@ -129,37 +305,187 @@ def load_parsed_voice_into_struct(voice: dict, struct: Type[bread.BreadStruct]):
     struct.name = voice['NAME'].ljust(len(struct.name))
 
 
-def parse(sysex_bytes: bytes) -> list:
-    raw_struct = bread.parse(sysex_bytes, sysex_dump_message)
+def _parse_bread(sysex_bytes: bytes, signature_mode: Optional[str] = None) -> list:
+    # bread needs its input as bytes; the native engines can work on views.
+    # bread decodes fields as they're accessed, so much of its decoding is
+    # counted as part of parse_voice
+    with metrics.timed('decode'):
+        raw_struct = bread.parse(bytes(sysex_bytes), sysex_dump_message)
 
     if raw_struct.format_number == 0:
-        parsed_voices = [parse_voice(raw_struct)]
+        parsed_voices = [parse_voice(raw_struct, signature_mode)]
     else:
-        parsed_voices = [parse_voice(x) for x in raw_struct.voices]
+        parsed_voices = [parse_voice(x, signature_mode) for x in raw_struct.voices]
 
     return parsed_voices
 
 
-def compute_checksum(data: bytes, offset_start: int = SYSEX_HEADER_SIZE, offset_end: int = 1):
+def _voice_layout(sysex_bytes: bytes) -> Tuple[Layout, int]:
+    format_number = sysex_bytes[1]
+
+    if format_number == 0:
+        layout = unpacked_layout()
+        num_voices = 1
+    elif format_number == 9:
+        layout = packed_layout()
+        num_voices = 32
+    else:
+        raise ParseError('Unsupported DX7 format number %d' % (format_number))
+
+    if len(sysex_bytes) < SYSEX_HEADER_SIZE + num_voices * layout.size:
+        raise ParseError('Expected at least %d bytes of voice data, but only found %d' %
+                         (num_voices * layout.size, len(sysex_bytes) - SYSEX_HEADER_SIZE))
+
+    return layout, num_voices
+
+
+def _parse_native(sysex_bytes: bytes, signature_mode: Optional[str] = None) -> list:
+    layout, num_voices = _voice_layout(sysex_bytes)
+    parsed_voices = []
+
+    for i in range(num_voices):
+        with metrics.timed('decode'):
+            voice = decode_voice(sysex_bytes, SYSEX_HEADER_SIZE + i * layout.size, layout)
+
+        parsed_voices.append(parse_voice(voice, signature_mode))
+
+    return parsed_voices
+
+
+def _parse_objects(sysex_bytes: bytes, signature_mode: Optional[str] = None) -> List[DX7Voice]:
+    layout, num_voices = _voice_layout(sysex_bytes)
+
+    with metrics.timed('decode', num_voices):
+        return [DX7Voice(normalize_voice(sysex_bytes, SYSEX_HEADER_SIZE + i * layout.size, layout), signature_mode)
+                for i in range(num_voices)]
+
+
+# Both engines produce identical output; the native one skips bread's
+# bit-level machinery and is considerably faster. Bread remains available so
+# that the two can be benchmarked and diffed against one another (see
+# check_parity()).
+ENGINES = {
+    'native': _parse_native,
+    'bread': _parse_bread
+}
+
+
+@lru_cache(maxsize=None)
+def default_engine() -> str:
+    # The native engine is only the default if its layouts compile, which
+    # includes checking every value they decode against bread (see
+    # layout.py). Otherwise, everything goes through bread.
+    try:
+        packed_layout()
+        unpacked_layout()
+    except Exception:
+        logger.warning('Falling back to the bread engine for DX7 messages', exc_info=True)
+        return 'bread'
+
+    return 'native'
+
+
+def check_ranges(sysex_bytes: bytes) -> Counter:
+    # How many of each parameter's values in a message are outside the range
+    # the DX7 accepts (see ranges.py)
+    layout, num_voices = _voice_layout(sysex_bytes)
+
+    return validate_voices(sysex_bytes, SYSEX_HEADER_SIZE, num_voices, layout)
+
+
+def _validate(sysex_bytes: bytes, mode: str) -> bytes:
+    # In 'check' mode, raises a RangeError if any parameter is out of range;
+    # in 'clamp' mode, returns a copy of the message with every parameter
+    # clamped into range (and its checksum updated to match). Either way, what
+    # was out of range is counted.
+    if mode not in VALIDATE_MODES:
+        raise ValueError('Unknown validation mode %s' % (mode))
+
+    layout, num_voices = _voice_layout(sysex_bytes)
+    # Clamping happens in place, so it needs a copy that can be written to
+    data = bytearray(sysex_bytes) if mode == 'clamp' else sysex_bytes  # type: Union[bytes, bytearray]
+
+    with metrics.timed('validate', num_voices):
+        counts = validate_voices(data, SYSEX_HEADER_SIZE, num_voices, layout, clamp=mode == 'clamp')
+
+    record_counts(counts)
+
+    if counts and mode == 'check':
+        raise RangeError('%d parameter values are out of range (%s)' %
+                         (sum(counts.values()), ', '.join(sorted(counts))))
+
+    if counts and isinstance(data, bytearray):
+        data[-1] = compute_checksum(data)
+
+        return bytes(data)
+
+    return sysex_bytes
+
+
+def parse(sysex_bytes: bytes, engine: Optional[str] = None, signature_mode: Optional[str] = None,
+          as_objects: bool = False, validate: Optional[str] = None) -> list:
+    # validate can be 'check' or 'clamp' (see _validate); by default,
+    # parameters are taken as they are
+    if engine is None:
+        engine = default_engine()
+
+    if engine not in ENGINES:
+        raise ValueError('Unknown DX7 parsing engine %s' % (engine))
+
+    if validate is not None:
+        sysex_bytes = _validate(sysex_bytes, validate)
+
+    try:
+        if as_objects:
+            # Voices are returned as DX7Voice objects rather than dicts
+            if engine == 'native':
+                return _parse_objects(sysex_bytes, signature_mode)
+
+            return [DX7Voice.from_dict(voice, signature_mode)
+                    for voice in ENGINES[engine](sysex_bytes, signature_mode)]
+
+        return ENGINES[engine](sysex_bytes, signature_mode)
+    except ValueError as e:
+        # A value that doesn't decode (an enum value that doesn't exist, or a
+        # name that isn't valid text) means the message is malformed
+        raise ParseError(str(e)) from e
+
+
+def check_parity(sysex_bytes: bytes) -> bool:
+    # Whether both engines parse a message the same way
+    return _parse_native(sysex_bytes) == _parse_bread(sysex_bytes)
+
+
+def compute_checksum(data: Union[bytes, bytearray, memoryview], offset_start: int = SYSEX_HEADER_SIZE,
+                     offset_end: int = 1):
     # To compute the checksum for DX7 SysEx messages:
     #
     # 1. compute the sum of the message's data bytes
     # 2. mask that number so that it's 7 bits long
     # 3. compute the masked number's 2s complement, and mask the result so it's 7 bits long
+    #    (a sum of 0 has a checksum of 0, not 128, which isn't a data byte)
 
     if offset_end == 0:
         off_end = None
     else:
         off_end = -(offset_end)
 
-    return (~(sum(data[offset_start:off_end]) & 0x7f) & 0x7f) + 1
+    return ((~(sum(data[offset_start:off_end]) & 0x7f) & 0x7f) + 1) & 0x7f
+
 
+def validate_checksum(sysex_bytes: bytes) -> bool:
+    # Whether a message's checksum (its last byte) matches its voice data
+    if len(sysex_bytes) <= SYSEX_HEADER_SIZE:
+        return False
 
-def dump(sysex_json: Union[dict, list]) -> bytes:
-    if type(sysex_json) == dict:
+    return compute_checksum(sysex_bytes) == sysex_bytes[-1]
+
+
+def _dump_bread(sysex_json: Union[dict, DX7Voice, list]) -> bytes:
+    if isinstance(sysex_json, (dict, DX7Voice)):
         # Single voice
         single_voice_blank_data = bytearray(SINGLE_VOICE_SYSEX_LENGTH)
-        single_voice_blank_data[1] = 1
+        single_voice_blank_data[1] = 0
         sysex = bread.new(sysex_dump_message, data=single_voice_blank_data)
         sysex.format_number = 0
         sysex.byte_count = 0x011b
@@ -181,13 +507,101 @@ def dump(sysex_json: Union[dict, list]) -> bytes:
     return bread.write(sysex, sysex_dump_message)
 
 
-def add_headers_and_footers(bank_bytes: bytes) -> bytes:
-    output_bytes = bytes([0x00])
+def encode_voice_into(voice: Union[dict, DX7Voice], layout: Layout, out: bytearray, offset: int):
+    # Encodes a voice in a single pass into out, which must be zeroed where
+    # the voice will go
+    if isinstance(voice, DX7Voice):
+        if layout is unpacked_layout():
+            out[offset:offset + layout.size] = voice.data
+        else:
+            transcode_voice(voice.data, layout, out, offset)
+    else:
+        encode_parsed_fields(voice, layout, out, offset)
+
+        name_start = offset + layout.name_offset
+        name = voice['NAME'].ljust(layout.name_length).encode(NAME_ENCODING)[:layout.name_length]
+        out[name_start:name_start + layout.name_length] = name.ljust(layout.name_length)
+
+
+def _dump_native(sysex_json: Union[dict, DX7Voice, list]) -> bytes:
+    if isinstance(sysex_json, (dict, DX7Voice)):
+        layout = unpacked_layout()
+        voices = [sysex_json]  # type: list
+        sysex = bytearray(SINGLE_VOICE_SYSEX_LENGTH)
+        sysex[:SYSEX_HEADER_SIZE] = SINGLE_VOICE_HEADER
+    else:
+        layout = packed_layout()
+        voices = sysex_json
+        sysex = bytearray(MULTI_VOICE_SYSEX_LENGTH)
+        sysex[:SYSEX_HEADER_SIZE] = MULTI_VOICE_HEADER
+
+    for i, voice in enumerate(voices):
+        encode_voice_into(voice, layout, sysex, SYSEX_HEADER_SIZE + i * layout.size)
 
+    sysex[-1] = compute_checksum(sysex)
+
+    return bytes(sysex)
+
+
+DUMP_ENGINES = {
+    'native': _dump_native,
+    'bread': _dump_bread
+}
+
+
+def dump(sysex_json: Union[dict, DX7Voice, list], engine: Optional[str] = None,
+         validate: Optional[str] = None) -> bytes:
+    # validate works as it does for parse(), on the dumped message
+    if engine is None:
+        engine = default_engine()
+
+    if engine not in DUMP_ENGINES:
+        raise ValueError('Unknown DX7 dumping engine %s' % (engine))
+
+    with metrics.timed('encode'):
+        sysex = DUMP_ENGINES[engine](sysex_json)
+
+    if validate is None:
+        return sysex
+
+    return bytes(_validate(sysex, validate))
+
+
+def salvage(data: bytes, signature_mode: Optional[str] = None, validate: Optional[str] = None) -> list:
+    # Every voice that can be recovered from data, however malformed (see
+    # recover.py). validate works as it does for parse()
+    from .recover import salvage
+
+    return salvage(data, signature_mode, validate)
+
+
+def describe_differences(original: bytes, dumped: bytes) -> list:
+    # Differences between two messages, parameter by parameter (see diff.py)
+    from .diff import describe_differences
+
+    return describe_differences(original, dumped)
+
+
+def diff_banks(old: bytes, new: bytes) -> list:
+    # Which voices differ between two messages, and in which parameters (see
+    # compare.py)
+    from .compare import diff_banks
+
+    return diff_banks(old, new)
+
+
+def merge_banks(base: bytes, ours: bytes, theirs: bytes, prefer: str = 'ours') -> Tuple[bytes, dict]:
+    # Three-way merges two revisions of a message (see compare.py)
+    from .compare import merge_banks
+
+    return merge_banks(base, ours, theirs, prefer)
+
+
+def add_headers_and_footers(bank_bytes: bytes) -> bytes:
     if len(bank_bytes) == 32 * 128:
-        output_bytes += bytes([0x09, 0x20, 0x00])
+        output_bytes = MULTI_VOICE_HEADER
     elif len(bank_bytes) == 155:
-        output_bytes += bytes([0x00, 0x01, 0x1b])
+        output_bytes = SINGLE_VOICE_HEADER
     else:
         raise ValueError('Bank of size %d bytes not supported' % (len(bank_bytes)))
 
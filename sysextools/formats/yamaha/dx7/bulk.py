@@ -0,0 +1,192 @@
+from functools import lru_cache
+import os
+from typing import Iterable, List, Tuple, Union  # noqa
+
+from ....constants import SYSEX_START_BYTE, SYSEX_END_BYTE
+from ....errors import NotSupportedError, ParseError
+from .layout import Layout, packed_layout, unpacked_layout
+from .spec import NAME_ENCODING, enums
+
+# Bulk decoding of many DX7 messages into a single NumPy structured array, one
+# row per voice. Enum-valued parameters (curves, oscillator modes, LFO
+# waveforms) are kept as their raw integer codes; field_enums() and
+# enum_lookup() give the tables needed to turn those codes back into names.
+# Operators are stored as a sub-array in the same order parse_voice uses (OP1
+# first).
+
+ENUMS = enums
+
+# Offset of the voice data within a complete SysEx message: the start byte,
+# Yamaha's manufacturer ID and the four-byte DX7 header
+_DATA_OFFSET = 6
+_MANUFACTURER_ID = 0x43
+
+# SysEx data bytes only ever have seven significant bits
+_DATA_BYTE_MASK = 0x7f
+
+
+def _field_dtype(layout_fields) -> str:
+    values = [field.decode[raw] for field in layout_fields for raw in range(min(len(field.decode), 128))]
+
+    if min(values) < 0:
+        return 'i1'
+
+    return 'u1'
+
+
+@lru_cache(maxsize=None)
+def field_enums() -> dict:
+    # Maps each enum-valued column to the name of its table in ENUMS
+    return {field.name: field.enum for field in packed_layout().fields if field.enum is not None}
+
+
+@lru_cache(maxsize=None)
+def enum_lookup(enum_name: str) -> dict:
+    # ENUMS keys some names by a tuple of codes; this flattens a table so that
+    # every code can be looked up directly
+    lookup = {}
+
+    for codes, value in ENUMS[enum_name].items():
+        for code in (codes if isinstance(codes, tuple) else (codes,)):
+            lookup[code] = value
+
+    return lookup
+
+
+@lru_cache(maxsize=None)
+def _build_dtype():
+    np = _require_numpy()
+    operator_fields = {}  # type: dict
+    voice_fields = {}  # type: dict
+
+    for layout in (packed_layout(), unpacked_layout()):
+        for field in layout.fields:
+            fields = voice_fields if field.operator is None else operator_fields
+            fields.setdefault(field.name, []).append(field)
+
+    def entry(name, fields):
+        if name in field_enums():
+            dtype = 'u1'
+        else:
+            dtype = _field_dtype(fields)
+
+        array_length = max(-1 if f.element is None else f.element for f in fields) + 1
+
+        if array_length > 0:
+            return (name, dtype, (array_length,))
+
+        return (name, dtype)
+
+    operator_dtype = np.dtype([entry(name, fields) for name, fields in operator_fields.items()])
+
+    dtype = np.dtype([
+        ('source_index', 'u4'),
+        ('voice_index', 'u1'),
+        ('name', 'U10'),
+        ('operators', operator_dtype, (6,))
+    ] + [entry(name, fields) for name, fields in voice_fields.items()])
+
+    return dtype
+
+
+def _require_numpy():
+    # numpy takes longer to import than everything else put together, so it's
+    # only imported once something actually needs it
+    try:
+        import numpy
+    except ImportError:  # pragma: no cover
+        raise NotSupportedError('Bulk decoding of DX7 voices requires numpy')
+
+    return numpy
+
+
+def _read_message(path_or_buffer) -> bytes:
+    if isinstance(path_or_buffer, (str, os.PathLike)):
+        with open(path_or_buffer, 'rb') as fp:
+            return fp.read()
+
+    return bytes(path_or_buffer)
+
+
+def _unpack_into(out, rows, matrix, layout: Layout, raw_mask: int):
+    np = _require_numpy()
+
+    for field in layout.fields:
+        column = (matrix[:, field.byte] >> field.shift) & (field.mask & raw_mask)
+
+        if field.enum is None:
+            # Non-enum fields are stored with bread's offset applied, which is
+            # the value the lookup table holds for a raw zero
+            column = column.astype(np.int16) + field.decode[0]
+
+        if field.operator is None:
+            target = out[field.name]
+        else:
+            target = out['operators'][field.name][:, 5 - field.operator]
+
+        if field.element is None:
+            target[rows] = column
+        else:
+            target[rows, field.element] = column
+
+    names = np.ascontiguousarray(matrix[:, layout.name_offset:layout.name_offset + layout.name_length])
+    names = np.char.decode(names.view('S%d' % (layout.name_length)).ravel(), NAME_ENCODING, 'replace')
+    out['name'][rows] = np.char.strip(names)
+
+
+def parse_many_to_array(paths_or_buffers: Iterable[Union[str, bytes]]):
+    np = _require_numpy()
+    dtype = _build_dtype()
+
+    # Gather the payloads of every 32-voice bank and every single voice into
+    # two contiguous buffers, remembering where each voice came from
+    packed = bytearray()
+    packed_sources = []  # type: List[Tuple[int, int]]
+    unpacked = bytearray()
+    unpacked_sources = []  # type: List[Tuple[int, int]]
+
+    for source_index, path_or_buffer in enumerate(paths_or_buffers):
+        message = _read_message(path_or_buffer)
+
+        if len(message) < _DATA_OFFSET + 1 or message[0] != SYSEX_START_BYTE or message[-1] != SYSEX_END_BYTE:
+            raise ParseError('Input %d is not a complete SysEx message' % (source_index))
+
+        if message[1] != _MANUFACTURER_ID:
+            raise NotSupportedError('Input %d is not a Yamaha SysEx message' % (source_index))
+
+        format_number = message[3]
+
+        if format_number == 9:
+            layout, buf, sources, num_voices = packed_layout(), packed, packed_sources, 32
+        elif format_number == 0:
+            layout, buf, sources, num_voices = unpacked_layout(), unpacked, unpacked_sources, 1
+        else:
+            raise ParseError('Input %d has unsupported DX7 format number %d' % (source_index, format_number))
+
+        payload_length = num_voices * layout.size
+
+        if len(message) < _DATA_OFFSET + payload_length:
+            raise ParseError('Input %d is truncated' % (source_index))
+
+        buf += message[_DATA_OFFSET:_DATA_OFFSET + payload_length]
+        sources.extend((source_index, i) for i in range(num_voices))
+
+    # Rows are emitted in input order, so interleave the two kinds of voices
+    # back together by sorting on their source positions
+    all_sources = sorted(packed_sources + unpacked_sources)
+    row_of = {source: row for row, source in enumerate(all_sources)}
+
+    out = np.zeros(len(all_sources), dtype=dtype)
+    out['source_index'] = [source for source, _ in all_sources]
+    out['voice_index'] = [voice for _, voice in all_sources]
+
+    for layout, buf, sources, raw_mask in ((packed_layout(), packed, packed_sources, 0xff),
+                                           (unpacked_layout(), unpacked, unpacked_sources, _DATA_BYTE_MASK)):
+        if not sources:
+            continue
+
+        matrix = np.frombuffer(bytes(buf), dtype=np.uint8).reshape(-1, layout.size)
+        rows = np.fromiter((row_of[source] for source in sources), dtype=np.intp, count=len(sources))
+        _unpack_into(out, rows, matrix, layout, raw_mask)
+
+    return out
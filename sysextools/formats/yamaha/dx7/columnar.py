@@ -0,0 +1,302 @@
+import io
+import os
+import struct
+import tempfile
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union  # noqa
+import zipfile
+
+from .bulk import _build_dtype, _require_numpy, _unpack_into
+from .layout import Layout, unpacked_layout
+from .voice import DX7Voice
+
+# A whole voice library in a single columnar file: every parameter as a flat,
+# typed column (op1_eg_rates_0, ..., algorithm, transpose), plus NAME,
+# SIGNATURE, AUTHOR, BANK and SOURCE. Values are as bulk.py decodes them, so
+# enum-valued parameters are raw codes (see bulk.enum_lookup).
+#
+# The file is an uncompressed .npz, so np.load() reads it as it is, but
+# load_voice_table() memory-maps each column in place instead, so that
+# filtering a library of hundreds of thousands of voices only touches the
+# columns involved. AUTHOR, BANK and SOURCE have few distinct values, so they
+# are stored as int32 codes (-1 for none) into a table of their values, under
+# <column>_values.
+#
+# Voices are written a chunk at a time: each chunk is encoded into a matrix of
+# voice records, decoded into columns in one go by bulk.py and appended to a
+# spool file per column. Closing the writer copies the spooled columns into
+# the .npz, so memory use is bounded by the chunk size, not the library size.
+#
+#     with VoiceTableWriter('library.npz') as writer:
+#         writer.write_voices(parse('bank.syx'))
+#
+#     table = load_voice_table('library.npz')
+#     names = table['NAME'][(table['algorithm'] == 22) & table.equals('AUTHOR', 'Yamaha')]
+
+DEFAULT_CHUNK_SIZE = 8192
+
+METADATA_COLUMNS = ('NAME', 'SIGNATURE', 'AUTHOR', 'BANK', 'SOURCE')
+CODED_COLUMNS = ('AUTHOR', 'BANK', 'SOURCE')
+
+_VALUES_SUFFIX = '_values'
+
+# Signatures are SHA-1 hex digests
+_SIGNATURE_LENGTH = 40
+
+# A zip file's local file header, up to the file name
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+def _parameter_columns() -> List[Tuple[str, tuple, Any]]:
+    # (column name, where it is in a bulk array, dtype) for every parameter.
+    # Operators are numbered as on the front panel.
+    np = _require_numpy()
+    dtype = _build_dtype()
+    columns = []
+
+    def add(name, path, field_dtype):
+        if field_dtype.shape:
+            for i in range(field_dtype.shape[0]):
+                columns.append(('%s_%d' % (name, i), path + (i,), field_dtype.base))
+        else:
+            columns.append((name, path, field_dtype))
+
+    operator_dtype = dtype['operators'].base
+
+    for operator in range(6):
+        for field in operator_dtype.names:
+            add('op%d_%s' % (operator + 1, field), ('operators', operator, field), operator_dtype[field])
+
+    for field in dtype.names:
+        if field not in ('source_index', 'voice_index', 'name', 'operators'):
+            add(field, (field,), dtype[field])
+
+    return [(name, path, np.dtype(field_dtype)) for name, path, field_dtype in columns]
+
+
+def _column_values(array, path: tuple):
+    if path[0] == 'operators':
+        values = array['operators'][:, path[1]][path[2]]
+        path = path[3:]
+    else:
+        values = array[path[0]]
+        path = path[1:]
+
+    return values if not path else values[:, path[0]]
+
+
+class VoiceTableWriter(object):
+    def __init__(self, path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.rows = 0
+        self._columns = _parameter_columns()
+        self._spool = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path)))
+        self._pending = []  # type: List[Tuple[Union[dict, DX7Voice], Dict[str, Optional[str]]]]
+        # Maps each coded column's values to their codes, in order of appearance
+        self._codes = {column: {} for column in CODED_COLUMNS}  # type: Dict[str, Dict[str, int]]
+
+    def __enter__(self) -> 'VoiceTableWriter':
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self._spool.cleanup()
+
+    def write_voices(self, voices: Iterable[Union[dict, DX7Voice]]):
+        # Voices as parse() returns them, with whatever metadata has been
+        # attached to them
+        for voice in voices:
+            metadata = {column: voice[column] if column in voice else None for column in CODED_COLUMNS}
+            self._pending.append((voice, metadata))
+
+            if len(self._pending) >= self.chunk_size:
+                self._flush_voices()
+
+    def _flush_voices(self):
+        from . import encode_voice_into
+
+        layout = unpacked_layout()
+        records = bytearray(len(self._pending) * layout.size)
+
+        for i, (voice, _) in enumerate(self._pending):
+            encode_voice_into(voice, layout, records, i * layout.size)
+
+        signatures = [voice['SIGNATURE'] for voice, _ in self._pending]
+        metadata = [metadata for _, metadata in self._pending]
+        self._pending = []
+
+        self.write_records(records, layout, signatures, metadata)
+
+    def write_records(self, records: bytes, layout: Layout, signatures: List[str],
+                      metadata: List[Dict[str, Optional[str]]]):
+        # Voice records in either layout, back to back, with each one's
+        # signature and metadata. This is what write_voices() comes down to,
+        # and how voices that are already encoded are written without
+        # decoding them one at a time.
+        np = _require_numpy()
+        count = len(signatures)
+
+        if count == 0:
+            return
+
+        array = np.zeros(count, dtype=_build_dtype())
+        matrix = np.frombuffer(bytes(records), dtype=np.uint8).reshape(count, layout.size)
+        _unpack_into(array, np.arange(count), matrix, layout, 0xff)
+
+        self._append('NAME', array['name'].astype('U%d' % (layout.name_length)))
+        self._append('SIGNATURE', np.array(signatures, dtype='U%d' % (_SIGNATURE_LENGTH)))
+
+        for column in CODED_COLUMNS:
+            codes = self._codes[column]
+            values = [entry.get(column) for entry in metadata]
+            self._append(column, np.array([-1 if value is None else codes.setdefault(value, len(codes))
+                                           for value in values], dtype=np.int32))
+
+        for name, path, dtype in self._columns:
+            self._append(name, _column_values(array, path).astype(dtype))
+
+        self.rows += count
+
+    def _append(self, column: str, values):
+        with open(os.path.join(self._spool.name, column), 'ab') as fp:
+            fp.write(values.tobytes())
+
+    def close(self):
+        np = _require_numpy()
+
+        if self._pending:
+            self._flush_voices()
+
+        columns = [('NAME', np.dtype('U%d' % (unpacked_layout().name_length))),
+                   ('SIGNATURE', np.dtype('U%d' % (_SIGNATURE_LENGTH)))]
+        columns.extend((column, np.dtype(np.int32)) for column in CODED_COLUMNS)
+        columns.extend((name, dtype) for name, _, dtype in self._columns)
+
+        temp_path = self.path + '.tmp'
+
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for column, dtype in columns:
+                spooled = os.path.join(self._spool.name, column)
+
+                if os.path.exists(spooled):
+                    with open(spooled, 'rb') as fp:
+                        _write_member(archive, column, dtype, self.rows, fp)
+                else:
+                    _write_member(archive, column, dtype, 0, io.BytesIO())
+
+            for column in CODED_COLUMNS:
+                values = list(self._codes[column])
+                width = max([len(value) for value in values] + [1])
+                _write_member(archive, column + _VALUES_SUFFIX, np.dtype('U%d' % (width)), len(values),
+                              io.BytesIO(np.array(values, dtype='U%d' % (width)).tobytes()))
+
+        os.replace(temp_path, self.path)
+        self._spool.cleanup()
+
+
+def _write_member(archive: zipfile.ZipFile, column: str, dtype, rows: int, data):
+    # Copies a column into the archive as a .npy file, a block at a time
+    np = _require_numpy()
+
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                  'fortran_order': False, 'shape': (rows,)})
+
+    info = zipfile.ZipInfo(column + '.npy', date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_STORED
+    info.file_size = len(header.getvalue()) + rows * dtype.itemsize
+
+    with archive.open(info, 'w') as member:
+        member.write(header.getvalue())
+
+        for block in iter(lambda: data.read(1 << 20), b''):
+            member.write(block)
+
+
+class VoiceTable(object):
+    def __init__(self, path: str, columns: Dict[str, Any]):
+        self.path = path
+        self._columns = columns
+
+    def __len__(self) -> int:
+        return len(self._columns['SIGNATURE'])
+
+    def __contains__(self, column: str) -> bool:
+        return column in self._columns and not column.endswith(_VALUES_SUFFIX)
+
+    @property
+    def columns(self) -> List[str]:
+        return [column for column in self._columns if not column.endswith(_VALUES_SUFFIX)]
+
+    def __getitem__(self, column: str):
+        # A column, memory-mapped; AUTHOR, BANK and SOURCE are decoded into
+        # their values (None where there's no value), which reads the whole
+        # column. codes() is cheaper for filtering on them.
+        if column in CODED_COLUMNS:
+            np = _require_numpy()
+            values = np.array(list(self._columns[column + _VALUES_SUFFIX]) + [None], dtype=object)
+
+            return values[self._columns[column]]
+
+        return self._columns[column]
+
+    def codes(self, column: str):
+        # AUTHOR, BANK or SOURCE's codes, memory-mapped (-1 for no value)
+        return self._columns[column]
+
+    def equals(self, column: str, value: Optional[str]):
+        # Which voices have the given AUTHOR, BANK or SOURCE, worked out from
+        # the codes without decoding the column
+        np = _require_numpy()
+        codes = self._columns[column]
+
+        if value is None:
+            return codes == -1
+
+        matches = (self._columns[column + _VALUES_SUFFIX] == value).nonzero()[0]
+
+        if not len(matches):
+            return np.zeros(len(codes), dtype=bool)
+
+        return codes == matches[0]
+
+
+def load_voice_table(path: str) -> VoiceTable:
+    # Memory-maps every column of a file VoiceTableWriter wrote
+    np = _require_numpy()
+    columns = {}
+
+    with zipfile.ZipFile(path, 'r') as archive:
+        members = archive.infolist()
+
+    with open(path, 'rb') as fp:
+        for info in members:
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('%s is compressed, so it can only be loaded with np.load()' % (info.filename))
+
+            fp.seek(info.header_offset)
+            local_header = _LOCAL_HEADER.unpack(fp.read(_LOCAL_HEADER.size))
+            fp.seek(info.header_offset + _LOCAL_HEADER.size + local_header[-2] + local_header[-1])
+
+            if np.lib.format.read_magic(fp) == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(fp)
+            column = info.filename[:-len('.npy')]
+
+            if shape[0] == 0:
+                columns[column] = np.empty(shape, dtype=dtype)
+            else:
+                columns[column] = np.memmap(path, dtype=dtype, mode='r', offset=fp.tell(), shape=shape)
+
+    return VoiceTable(path, columns)
+
+
+def export_voices(voices: Iterable[Union[dict, DX7Voice]], path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    # Writes voices (e.g. what parse() returns) to path; returns how many
+    with VoiceTableWriter(path, chunk_size) as writer:
+        writer.write_voices(voices)
+
+    return writer.rows
@@ -0,0 +1,238 @@
+from copy import deepcopy
+from typing import Any, cast, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union  # noqa
+
+from . import (_voice_layout, compute_checksum, compute_signature, DX7Voice, encode_voice_into,
+               parse_voice_parameters, SYSEX_HEADER_SIZE)
+from .layout import Layout
+from .native import decode_voice
+
+# Parameter-by-parameter diffs and three-way merges of voices and banks.
+# Voices are compared in the shape parse_voice gives them, so a change is
+# reported as the path to the parameter that changed, e.g. ('operators', 2,
+# 'oscillator', 'detune') for OP3's detune. Metadata (SIGNATURE, AUTHOR, BANK
+# and so on) is left out; NAME is compared like any other parameter.
+#
+# Banks are compared voice record by voice record first: records that are
+# byte-for-byte the same are skipped with a single slice comparison, and only
+# the voices that differ are decoded and diffed. A bank with one edited voice
+# costs two decodes, not sixty-four.
+
+
+class Change(NamedTuple):
+    path: Tuple[Union[str, int], ...]
+    old: Any
+    new: Any
+
+
+class VoiceDiff(NamedTuple):
+    # The voice's slot in the new bank (or, for removed voices, the old one)
+    slot: int
+    # 'changed', 'moved' (the same voice is in a different slot in the old
+    # bank), 'added' or 'removed'
+    status: str
+    old_name: Optional[str]
+    new_name: Optional[str]
+    # The old slot, for moved voices
+    moved_from: Optional[int] = None
+    changes: Tuple[Change, ...] = ()
+
+
+class Conflict(NamedTuple):
+    path: Tuple[Union[str, int], ...]
+    base: Any
+    ours: Any
+    theirs: Any
+
+
+def parameter_label(path: Tuple[Union[str, int], ...]) -> str:
+    # ('operators', 2, 'oscillator', 'detune') -> 'OP3 oscillator.detune'
+    label = ''
+    prefix = ''
+
+    if len(path) > 1 and path[0] == 'operators':
+        prefix = 'OP%d ' % (cast(int, path[1]) + 1)
+        path = path[2:]
+
+    for part in path:
+        if isinstance(part, int):
+            label += '[%d]' % (part)
+        else:
+            label += ('.' if label else '') + part
+
+    return prefix + label
+
+
+def _parameters(voice: Union[dict, DX7Voice]) -> dict:
+    if isinstance(voice, DX7Voice):
+        return parse_voice_parameters(voice)
+
+    return voice
+
+
+def _walk(old, new, path: Tuple[Union[str, int], ...]) -> Iterator[Change]:
+    if isinstance(old, dict):
+        for key, value in old.items():
+            # Metadata keys are upper-case; NAME is a parameter like the rest
+            if not path and key.isupper() and key != 'NAME':
+                continue
+
+            yield from _walk(value, new[key], path + (key,))
+    elif isinstance(old, list):
+        for i, (a, b) in enumerate(zip(old, new)):
+            yield from _walk(a, b, path + (i,))
+    elif old != new:
+        yield Change(path, old, new)
+
+
+def diff_voices(old: Union[dict, DX7Voice], new: Union[dict, DX7Voice]) -> List[Change]:
+    # Every parameter that differs between two voices, in parse_voice's order
+    return list(_walk(_parameters(old), _parameters(new), ()))
+
+
+def _get(voice: dict, path: Tuple[Union[str, int], ...]) -> Any:
+    for part in path:
+        voice = voice[part]
+
+    return voice
+
+
+def _set(voice: dict, path: Tuple[Union[str, int], ...], value: Any):
+    _get(voice, path[:-1])[path[-1]] = value
+
+
+def merge_voices(base: Union[dict, DX7Voice], ours: Union[dict, DX7Voice], theirs: Union[dict, DX7Voice],
+                 prefer: str = 'ours', signature_mode: Optional[str] = None) -> Tuple[dict, List[Conflict]]:
+    # Takes the parameters theirs changed from base into ours. Parameters
+    # both sides changed, differently, are conflicts; they're resolved in
+    # favour of prefer ('ours' or 'theirs'). The merged voice keeps ours'
+    # metadata, with a fresh signature.
+    if prefer not in ('ours', 'theirs'):
+        raise ValueError('Unknown merge preference %s' % (prefer))
+
+    base = _parameters(base)
+    merged = deepcopy(_parameters(ours))
+    conflicts = []
+
+    for change in diff_voices(base, theirs):
+        ours_value = _get(merged, change.path)
+
+        if ours_value == change.old or ours_value == change.new:
+            _set(merged, change.path, change.new)
+            continue
+
+        conflicts.append(Conflict(change.path, change.old, ours_value, change.new))
+
+        if prefer == 'theirs':
+            _set(merged, change.path, change.new)
+
+    merged['SIGNATURE'] = compute_signature(merged, signature_mode)
+
+    return merged, conflicts
+
+
+def _decode(body, slot: int, layout: Layout) -> dict:
+    return parse_voice_parameters(decode_voice(body, SYSEX_HEADER_SIZE + slot * layout.size, layout))
+
+
+def _record(body, slot: int, layout: Layout):
+    start = SYSEX_HEADER_SIZE + slot * layout.size
+
+    return body[start:start + layout.size]
+
+
+def diff_banks(old_body, new_body) -> List[VoiceDiff]:
+    # Which voices differ between two messages (as parse() sees them), and
+    # how, slot by slot. A single voice compares against the first slot of a
+    # bank, and the rest of the bank counts as added or removed. Voices
+    # that are the same apart from how they're encoded (e.g. padding bits)
+    # aren't reported.
+    old_layout, old_count = _voice_layout(old_body)
+    new_layout, new_count = _voice_layout(new_body)
+    same_layout = old_layout is new_layout
+    old_slots = None  # type: Optional[Dict[bytes, int]]
+    diffs = []
+
+    for slot in range(max(old_count, new_count)):
+        if slot >= new_count:
+            diffs.append(VoiceDiff(slot, 'removed', _decode(old_body, slot, old_layout)['NAME'], None))
+            continue
+
+        if slot >= old_count:
+            diffs.append(VoiceDiff(slot, 'added', None, _decode(new_body, slot, new_layout)['NAME']))
+            continue
+
+        new_record = _record(new_body, slot, new_layout)
+
+        if same_layout:
+            if _record(old_body, slot, old_layout) == new_record:
+                continue
+
+            if old_slots is None:
+                # Only worked out once something's changed
+                old_slots = {}
+
+                for old_slot in reversed(range(old_count)):
+                    old_slots[bytes(_record(old_body, old_slot, old_layout))] = old_slot
+
+            moved_from = old_slots.get(bytes(new_record))
+
+            if moved_from is not None:
+                name = _decode(new_body, slot, new_layout)['NAME']
+                diffs.append(VoiceDiff(slot, 'moved', name, name, moved_from))
+                continue
+
+        old_voice = _decode(old_body, slot, old_layout)
+        new_voice = _decode(new_body, slot, new_layout)
+        changes = diff_voices(old_voice, new_voice)
+
+        if changes:
+            diffs.append(VoiceDiff(slot, 'changed', old_voice['NAME'], new_voice['NAME'], None, tuple(changes)))
+
+    return diffs
+
+
+def merge_banks(base_body, ours_body, theirs_body, prefer: str = 'ours') -> Tuple[bytes, Dict[int, List[Conflict]]]:
+    # Three-way merges two revisions of a bank, slot by slot, into a new
+    # message body (with its checksum worked out again). Slots that only one
+    # side changed are copied from that side without being decoded; only
+    # slots both sides changed are merged parameter by parameter (see
+    # merge_voices). Returns the merged body and the conflicts in each slot.
+    if prefer not in ('ours', 'theirs'):
+        raise ValueError('Unknown merge preference %s' % (prefer))
+
+    layout, count = _voice_layout(ours_body)
+
+    for body in (base_body, theirs_body):
+        other_layout, other_count = _voice_layout(body)
+
+        if other_layout is not layout or other_count != count:
+            raise ValueError("Banks with different layouts can't be merged")
+
+    merged = bytearray(ours_body)
+    conflicts = {}
+
+    for slot in range(count):
+        base_record = _record(base_body, slot, layout)
+        theirs_record = _record(theirs_body, slot, layout)
+
+        if theirs_record == base_record or theirs_record == _record(ours_body, slot, layout):
+            continue
+
+        start = SYSEX_HEADER_SIZE + slot * layout.size
+
+        if _record(ours_body, slot, layout) == base_record:
+            merged[start:start + layout.size] = theirs_record
+            continue
+
+        voice, slot_conflicts = merge_voices(_decode(base_body, slot, layout), _decode(ours_body, slot, layout),
+                                             _decode(theirs_body, slot, layout), prefer)
+
+        merged[start:start + layout.size] = bytes(layout.size)
+        encode_voice_into(voice, layout, merged, start)
+
+        if slot_conflicts:
+            conflicts[slot] = slot_conflicts
+
+    merged[-1] = compute_checksum(merged)
+
+    return bytes(merged), conflicts
@@ -0,0 +1,134 @@
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple  # noqa
+
+from . import SYSEX_HEADER_SIZE
+from .layout import Field, INVALID, Layout, packed_layout, per_layout, unpacked_layout
+
+# Byte-level comparison of two DX7 messages (everything between the
+# manufacturer ID and the end byte, as parse() and dump() see them), with each
+# difference put down to the parameter it's in, using the compiled layouts.
+# Voices that are byte-for-byte the same are skipped with a single slice
+# comparison, so comparing two banks that differ in one voice costs little
+# more than comparing that voice.
+
+
+class Difference(NamedTuple):
+    # Offset into the message body
+    offset: int
+    # Which voice in the message, if the difference is in one
+    voice: Optional[int]
+    # Operator number (1-6, as on the front panel), for operator parameters
+    operator: Optional[int]
+    # The parameter's name (with its index, for parameters in arrays), or
+    # 'name', 'padding', 'header', 'checksum', 'trailing' or 'length'
+    field: str
+    original: Optional[int]
+    dumped: Optional[int]
+    # What the parameter's raw values decode to, where that means anything
+    original_value: Any = None
+    dumped_value: Any = None
+
+
+def _layout(body) -> Optional[Layout]:
+    format_number = body[1] if len(body) > 1 else None
+
+    if format_number == 0:
+        return unpacked_layout()
+    elif format_number == 9:
+        return packed_layout()
+
+    return None
+
+
+@per_layout
+def _byte_fields(layout: Layout) -> Tuple[Tuple[Tuple[Field, ...], int], ...]:
+    # For each byte of a voice, the fields in it and a mask of the bits no
+    # field uses
+    fields = [[] for _ in range(layout.size)]  # type: List[List[Field]]
+    padding = [0xff] * layout.size
+
+    for field in layout.fields:
+        fields[field.byte].append(field)
+        padding[field.byte] &= ~(field.mask << field.shift) & 0xff
+
+    for byte in range(layout.name_offset, layout.name_offset + layout.name_length):
+        padding[byte] = 0
+
+    return tuple((tuple(byte_fields), mask) for byte_fields, mask in zip(fields, padding))
+
+
+def field_label(field: Field) -> str:
+    return field.name if field.element is None else '%s[%d]' % (field.name, field.element)
+
+
+def _decoded(field: Field, raw: int) -> Any:
+    value = field.decode[raw]
+
+    return None if value is INVALID else value
+
+
+def _voice_differences(original, dumped, offset: int, voice: int, layout: Layout) -> List[Difference]:
+    differences = []
+    byte_fields = _byte_fields(layout)
+    name_end = layout.name_offset + layout.name_length
+
+    for byte in range(layout.size):
+        a = original[offset + byte]
+        b = dumped[offset + byte]
+
+        if a == b:
+            continue
+
+        if layout.name_offset <= byte < name_end:
+            differences.append(Difference(offset + byte, voice, None, 'name', a, b))
+            continue
+
+        fields, padding = byte_fields[byte]
+
+        for field in fields:
+            raw_a = (a >> field.shift) & field.mask
+            raw_b = (b >> field.shift) & field.mask
+
+            if raw_a != raw_b:
+                differences.append(Difference(offset + byte, voice,
+                                              None if field.operator is None else 6 - field.operator,
+                                              field_label(field), raw_a, raw_b,
+                                              _decoded(field, raw_a), _decoded(field, raw_b)))
+
+        if (a ^ b) & padding:
+            differences.append(Difference(offset + byte, voice, None, 'padding', a & padding, b & padding))
+
+    return differences
+
+
+def describe_differences(original, dumped) -> List[Difference]:
+    # Every difference between two message bodies, in offset order. Bodies
+    # that aren't in a DX7 voice format are compared byte by byte.
+    differences = []  # type: List[Difference]
+    size = min(len(original), len(dumped))
+    layout = _layout(original)
+    voices_end = 0
+
+    if original[:size] != dumped[:size] and layout is not None:
+        for offset in range(SYSEX_HEADER_SIZE):
+            if original[offset] != dumped[offset]:
+                differences.append(Difference(offset, None, None, 'header', original[offset], dumped[offset]))
+
+        num_voices = 1 if layout is unpacked_layout() else 32
+        voices_end = min(SYSEX_HEADER_SIZE + num_voices * layout.size, size)
+
+        for voice in range((voices_end - SYSEX_HEADER_SIZE) // layout.size):
+            start = SYSEX_HEADER_SIZE + voice * layout.size
+
+            if original[start:start + layout.size] != dumped[start:start + layout.size]:
+                differences.extend(_voice_differences(original, dumped, start, voice, layout))
+
+    if original[voices_end:size] != dumped[voices_end:size]:
+        for offset in range(voices_end, size):
+            if original[offset] != dumped[offset]:
+                field = 'checksum' if layout is not None and offset == voices_end else 'trailing'
+                differences.append(Difference(offset, None, None, field, original[offset], dumped[offset]))
+
+    if len(original) != len(dumped):
+        differences.append(Difference(size, None, None, 'length', len(original), len(dumped)))
+
+    return differences
@@ -0,0 +1,224 @@
+from functools import lru_cache, wraps
+import inspect
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, TypeVar  # noqa
+
+import bread
+from bread.array import BreadArray
+from bitstring import BitArray
+
+from .spec import compressed_voice, enums, raw_voice
+
+# The bread specs in spec.py are the single source of truth for where each of
+# a voice's parameters lives. Walking them through bread is slow, so this
+# module compiles them once into flat tables of (byte offset, shift, mask)
+# triples plus a lookup table that maps every possible raw value to what bread
+# would have decoded it as. Every field in both voice layouts fits inside a
+# single byte, except for the name.
+#
+# Running bread's decoder on every raw value of every field would mean tens of
+# thousands of BitArrays, which is most of the time it takes to parse a single
+# file. Bread's decoders are closures over everything they need (an offset,
+# and a table of values for enums), so the lookup tables are worked out from
+# those instead. Most fields share one of a handful of decoders (a uint8, a
+# 3-bit int, the curves enum and so on), so each distinct decoder's table is
+# then checked against bread for every raw value, once.
+
+# Marks raw values that bread would refuse to decode (e.g. an out-of-range
+# enum value in a single-voice dump)
+INVALID = object()
+
+
+class Field(NamedTuple):
+    name: str
+    # Index of the operator (in struct order, i.e. OP6 first) this field
+    # belongs to, or None for voice-level fields
+    operator: Optional[int]
+    # Index into the field's array, or None for scalar fields
+    element: Optional[int]
+    byte: int
+    shift: int
+    mask: int
+    # decode[raw] is the decoded value for raw, or INVALID
+    decode: Tuple[Any, ...]
+    # Maps decoded values back to their canonical raw value
+    encode: dict
+    # Name of the table in spec.enums this field's values come from, if any
+    enum: Optional[str]
+    # Where this field goes in a voice's canonical encoding (its parameters in
+    # the single-voice layout, minus the name), the canonical raw value for
+    # each raw value and, the other way round, the raw value for each
+    # canonical one (or -1 if this layout can't represent it)
+    canonical_byte: int
+    normalize: Tuple[int, ...]
+    denormalize: Tuple[int, ...]
+
+
+class Layout(NamedTuple):
+    size: int
+    fields: Tuple[Field, ...]
+    name_offset: int
+    name_length: int
+    canonical_size: int
+
+
+def _leaf_fields(struct, operator=None):
+    for field in struct._field_list:
+        if field._name.startswith('_'):
+            # Padding
+            continue
+
+        if field._name == 'operators':
+            for i in range(field._num_items):
+                yield from _leaf_fields(field._get_accessor_item(i), operator=i)
+        elif isinstance(field, BreadArray):
+            for i in range(field._num_items):
+                yield field._name, operator, i, field._get_accessor_item(i)
+        else:
+            yield field._name, operator, None, field
+
+
+def _decoder_parameters(field) -> tuple:
+    # Everything a field's decoder depends on: its length, offset and
+    # signedness, plus its values and default if it's an enum
+    variables = inspect.getclosurevars(field._decode_fn).nonlocals
+    values = default = None
+
+    if 'flattened_values' in variables:
+        # An enum, which decodes an integer and then looks it up
+        values = tuple(sorted(variables['flattened_values'].items()))
+        default = variables['default']
+        variables = inspect.getclosurevars(variables['old_decode_fn']).nonlocals
+
+    signed = variables['signed'] if 'signed' in variables else variables['int_type_key'].startswith('int')
+
+    return field._length, variables['offset'], signed, values, default
+
+
+def _decode_table(field, checked: Dict[tuple, Tuple[Any, ...]]) -> Tuple[Any, ...]:
+    # checked holds the tables already checked against bread, by decoder
+    parameters = _decoder_parameters(field)
+
+    if parameters in checked:
+        return checked[parameters]
+
+    length, offset, signed, values, default = parameters
+    lookup = dict(values) if values is not None else None
+    decode = []  # type: List[Any]
+
+    for raw in range(1 << length):
+        value = raw - (1 << length) if signed and raw >> (length - 1) else raw
+        value += offset
+
+        if lookup is not None:
+            value = lookup.get(value, default)
+
+            if value is None:
+                value = INVALID
+
+        decode.append(value)
+
+    for raw, value in enumerate(decode):
+        try:
+            expected = field._decode_fn(BitArray(uint=raw, length=length))
+        except ValueError:
+            expected = INVALID
+
+        if value != expected:
+            raise ValueError('Expected %s to decode %d as %s, but bread decodes it as %s' %
+                             (field._name, raw, value, expected))
+
+    checked[parameters] = tuple(decode)
+
+    return checked[parameters]
+
+
+def _compile_field(name: str, operator: Optional[int], element: Optional[int], field,
+                   canonical: Optional[Layout], decode_tables: Dict[tuple, Tuple[Any, ...]]) -> Field:
+    byte, bit = divmod(field._offset, 8)
+    length = field._length
+
+    if bit + length > 8:
+        raise ValueError('Field %s straddles a byte boundary' % (name))
+
+    decode = _decode_table(field, decode_tables)
+    encode = {}
+
+    for raw, value in enumerate(decode):
+        # Enums with several raw values for the same decoded value are always
+        # written back using the first one, same as bread does
+        if value is not INVALID and value not in encode:
+            encode[value] = raw
+
+    enum = None
+
+    if any(isinstance(value, str) for value in decode):
+        enum = next(enum_name for enum_name, values in enums.items()
+                    if set(values.values()) == set(encode.keys()))
+
+    if canonical is None:
+        # This is the canonical layout
+        canonical_byte = byte
+        canonical_encode = encode
+        canonical_decode = decode
+    else:
+        canonical_field = next(f for f in canonical.fields
+                               if (f.name, f.operator, f.element) == (name, operator, element))
+        canonical_byte = canonical_field.byte
+        canonical_encode = canonical_field.encode
+        canonical_decode = canonical_field.decode
+
+    normalize = tuple(0 if value is INVALID else canonical_encode[value] for value in decode)
+    denormalize = tuple(-1 if value is INVALID else encode.get(value, -1) for value in canonical_decode)
+
+    return Field(name, operator, element, byte, 8 - bit - length, (1 << length) - 1, decode, encode, enum,
+                 canonical_byte, normalize, denormalize)
+
+
+def _compile(spec: list, canonical: Optional[Layout] = None) -> Layout:
+    struct = bread.new(spec)
+    fields = []
+    decode_tables = {}  # type: Dict[tuple, Tuple[Any, ...]]
+
+    for name, operator, element, field in _leaf_fields(struct):
+        if name == 'name':
+            name_field = field
+        else:
+            fields.append(_compile_field(name, operator, element, field, canonical, decode_tables))
+
+    name_offset = name_field._offset // 8
+
+    return Layout(len(struct) // 8, tuple(fields), name_offset, name_field._length // 8,
+                  name_offset if canonical is None else canonical.canonical_size)
+
+
+@lru_cache(maxsize=None)
+def packed_layout() -> Layout:
+    return _compile(compressed_voice, canonical=unpacked_layout())
+
+
+@lru_cache(maxsize=None)
+def unpacked_layout() -> Layout:
+    return _compile(raw_voice)
+
+
+T = TypeVar('T')
+
+
+def per_layout(fn: Callable[[Layout], T]) -> Callable[[Layout], T]:
+    # Caches tables worked out from a layout (by whatever needs them, beyond
+    # what's compiled into it here). Layouts hold dicts, so they can't be
+    # hashed; they're only ever compiled once, though, so they're looked up by
+    # identity instead. Each entry keeps its layout alive, so that its id
+    # can't be reused.
+    cache = {}  # type: Dict[int, Tuple[Layout, T]]
+
+    @wraps(fn)
+    def cached(layout: Layout) -> T:
+        entry = cache.get(id(layout))
+
+        if entry is None or entry[0] is not layout:
+            entry = cache[id(layout)] = (layout, fn(layout))
+
+        return entry[1]
+
+    return cached
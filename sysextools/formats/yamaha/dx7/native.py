@@ -0,0 +1,94 @@
+from typing import List  # noqa
+
+from .layout import INVALID, Layout
+from .spec import NAME_ENCODING
+
+# A table-driven alternative to decoding and encoding voices through bread.
+# Voices are decoded into lightweight stand-ins for the bread structs that
+# parse_voice works with, so that the shape of a parsed voice is still defined
+# by parse_voice. Parsed voices are encoded with encode_parsed_fields, in
+# __init__.py.
+
+
+class DecodedArray(list):
+    def as_native(self) -> list:
+        return list(self)
+
+
+class DecodedStruct(object):
+    # Only set on voices, by decode_voice()
+    canonical_bytes: bytes
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def decode_voice(data, offset: int, layout: Layout) -> DecodedStruct:
+    operators = [{} for _ in range(6)]  # type: List[dict]
+    voice = {}  # type: dict
+    canonical = bytearray(layout.canonical_size)
+
+    for field in layout.fields:
+        raw = (data[offset + field.byte] >> field.shift) & field.mask
+        value = field.decode[raw]
+
+        if value is INVALID:
+            raise ValueError('%d is not a valid value for %s' % (raw, field.name))
+
+        canonical[field.canonical_byte] = field.normalize[raw]
+
+        target = voice if field.operator is None else operators[field.operator]
+
+        if field.element is None:
+            target[field.name] = value
+        elif field.element == 0:
+            target[field.name] = DecodedArray([value])
+        else:
+            target[field.name].append(value)
+
+    name_start = offset + layout.name_offset
+    voice['name'] = bytes(data[name_start:name_start + layout.name_length]).decode(NAME_ENCODING)
+    voice['operators'] = [DecodedStruct(**op) for op in operators]
+    # Computing the voice's canonical encoding along the way makes canonical
+    # signatures practically free
+    voice['canonical_bytes'] = bytes(canonical)
+
+    return DecodedStruct(**voice)
+
+
+def normalize_voice(data, offset: int, layout: Layout) -> bytes:
+    # The voice in the single-voice layout, with every value in its canonical
+    # encoding; this is what DX7Voice objects are built from
+    canonical = bytearray(layout.canonical_size)
+
+    for field in layout.fields:
+        raw = (data[offset + field.byte] >> field.shift) & field.mask
+
+        if field.decode[raw] is INVALID:
+            raise ValueError('%d is not a valid value for %s' % (raw, field.name))
+
+        canonical[field.canonical_byte] = field.normalize[raw]
+
+    name_start = offset + layout.name_offset
+    name = bytes(data[name_start:name_start + layout.name_length])
+    # Names that don't decode are rejected here, like the other engines do
+    name.decode(NAME_ENCODING)
+
+    return bytes(canonical) + name
+
+
+def transcode_voice(canonical, layout: Layout, out: bytearray, offset: int = 0):
+    # Writes a voice given in the single-voice layout (e.g. a DX7Voice's data)
+    # into out using layout, straight from the bytes, without decoding any
+    # values. out is expected to be zeroed where the voice will go
+    for field in layout.fields:
+        raw = field.denormalize[canonical[field.canonical_byte]]
+
+        if raw < 0:
+            raise ValueError('%d is not a valid value for %s' % (canonical[field.canonical_byte], field.name))
+
+        out[offset + field.byte] |= raw << field.shift
+
+    name_start = offset + layout.name_offset
+    name = canonical[layout.canonical_size:]
+    out[name_start:name_start + layout.name_length] = name[:layout.name_length]
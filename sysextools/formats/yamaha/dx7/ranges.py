@@ -0,0 +1,117 @@
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, List, NamedTuple, Tuple  # noqa
+
+from .... import metrics
+from .layout import Field, INVALID, Layout, per_layout
+from .spec import ranges
+
+# Checks that voices' parameters are within the ranges the DX7 accepts
+# (spec.ranges), and clamps them into range if asked to. The layouts will
+# happily decode an eg_rate of 127 or a detune of +8, which then ends up in
+# signatures and in whatever's dumped from them.
+#
+# Each field that can hold an out-of-range value compiles to a 256-entry
+# translation table that maps every value of the byte the field lives in to
+# the same byte with the field clamped into range. A field's bytes across all
+# of a message's voices are a single strided slice, so checking (or clamping)
+# that field for the whole message is one bytes.translate() and one
+# comparison, however many voices there are.
+
+VALIDATE_MODES = ('check', 'clamp')
+
+
+class RangeCheck(NamedTuple):
+    field: Field
+    label: str
+    # table[b] is byte b with this field's bits clamped into range
+    table: bytes
+
+
+def _in_range(field: Field, raw: int) -> bool:
+    value = field.decode[raw]
+
+    if value is INVALID:
+        return False
+
+    if field.enum is not None:
+        # Only the value the DX7 itself would send; the others (like 6 and 7
+        # for sample and hold) are only there for leniency's sake
+        return field.encode[value] == raw
+
+    bounds = ranges.get(field.name)
+
+    return bounds is None or bounds[0] <= value <= bounds[1]
+
+
+def valid_raw_values(field: Field) -> List[int]:
+    # Every raw value of the field that decodes to something the DX7 accepts
+    return [raw for raw in range(field.mask + 1) if _in_range(field, raw)]
+
+
+def _compile_check(field: Field) -> RangeCheck:
+    valid = valid_raw_values(field)
+
+    # Raw values are monotonic in decoded values for everything but enums, so
+    # the nearest valid raw value is the clamped one
+    def nearest_valid(raw: int) -> int:
+        i = bisect_left(valid, raw)
+
+        if i == len(valid) or (i > 0 and raw - valid[i - 1] <= valid[i] - raw):
+            return valid[i - 1]
+
+        return valid[i]
+
+    clamped = [nearest_valid(raw) for raw in range(field.mask + 1)]
+
+    field_bits = field.mask << field.shift
+    table = bytes((b & ~field_bits & 0xff) | (clamped[(b & field_bits) >> field.shift] << field.shift)
+                  for b in range(256))
+
+    label = field.name if field.element is None else '%s[%d]' % (field.name, field.element)
+
+    return RangeCheck(field, label, table)
+
+
+@per_layout
+def range_checks(layout: Layout) -> Tuple[RangeCheck, ...]:
+    # Checks for every field in the layout that can hold an out-of-range value
+    checks = [_compile_check(field) for field in layout.fields]
+
+    return tuple(check for check in checks if check.table != bytes(range(256)))
+
+
+def validate_voices(data, offset: int, num_voices: int, layout: Layout, clamp: bool = False) -> Counter:
+    # Counts the out-of-range values of each parameter across num_voices
+    # voices laid out back to back from offset. Operator parameters are
+    # counted across all six operators. With clamp set, the values are
+    # clamped into range too, so data has to be writable.
+    counts = Counter()  # type: Counter
+    end = offset + num_voices * layout.size
+
+    for check in range_checks(layout):
+        column_slice = slice(offset + check.field.byte, end, layout.size)
+        column = bytes(data[column_slice])
+        clamped = column.translate(check.table)
+
+        if clamped == column:
+            continue
+
+        counts[check.label] += sum(1 for a, b in zip(column, clamped) if a != b)
+
+        if clamp:
+            data[column_slice] = clamped
+
+    return counts
+
+
+def record_counts(counts: Counter):
+    # Passes the counts on to metrics, so that they add up across a corpus
+    # (see build_patch_bank's --stats)
+    if not counts:
+        return
+
+    metrics.count('out_of_range', sum(counts.values()))
+
+    for label, n in counts.items():
+        metrics.count('out_of_range:%s' % (label), n)
@@ -0,0 +1,200 @@
+from typing import Iterator, List, NamedTuple, Optional, Tuple  # noqa
+
+from . import compute_checksum, MULTI_VOICE_HEADER, parse_voice, SINGLE_VOICE_HEADER, SYSEX_HEADER_SIZE
+from .layout import INVALID, Layout, packed_layout, unpacked_layout
+from .native import decode_voice
+from .ranges import record_counts, validate_voices, VALIDATE_MODES
+from ....constants import SYSEX_END_BYTE, SYSEX_START_BYTE
+
+# Recovers what voices it can from files that parse() gives up on: banks with
+# a bad checksum, trailing garbage, a missing end byte or padding, banks cut
+# short, several messages run together, or bare voice data with no message
+# around it at all. Rather than expecting a well-formed message, the data is
+# scanned for DX7 message headers, and the voice frames after each are decoded
+# one by one. Data with no headers in it is only taken for bare voice data if
+# it's the size add_headers_and_footers() expects (whole 128-byte frames, or a
+# single 155-byte voice) and every frame in it decodes; anything else,
+# including other manufacturers' messages, is left alone.
+#
+# Each voice comes with how it was found and how much to trust it: a
+# confidence between 0 and 1 and a list of the problems that lowered it.
+# Frames that don't decode at all are reported, without a voice.
+#
+# Voices can be validated as parse() does: with validate='check', frames with
+# parameters outside the DX7's ranges are reported without a voice, like ones
+# that don't decode; with validate='clamp', they're clamped into range, which
+# counts as a problem of its own.
+
+# How far each problem lowers confidence
+PENALTIES = {
+    'bad checksum': 0.8,
+    'no end byte': 0.9,
+    'truncated': 0.8,
+    # Enough on its own to keep a voice out at the default threshold (0.5)
+    # if anything else is wrong with it
+    'no header': 0.6,
+    'non-MIDI bytes': 0.5,
+    'unprintable name': 0.7,
+    'out of range': 0.9
+}
+
+_MESSAGE_START = bytes([SYSEX_START_BYTE, 0x43])
+_PRINTABLE = frozenset(range(0x20, 0x7f))
+
+
+class SalvagedVoice(NamedTuple):
+    # Where the voice's frame starts in the data
+    offset: int
+    # Its slot in the bank it was found in (0 for single voices)
+    slot: int
+    # 'ok', 'suspect' or 'invalid'
+    status: str
+    confidence: float
+    problems: Tuple[str, ...]
+    # None if the frame couldn't be decoded
+    voice: Optional[dict]
+
+
+def _frame_problems(data, offset: int, layout: Layout) -> List[str]:
+    problems = []
+    frame = data[offset:offset + layout.size]
+
+    if any(byte > 0x7f for byte in frame):
+        problems.append('non-MIDI bytes')
+
+    name = frame[layout.name_offset:layout.name_offset + layout.name_length]
+
+    if not all(byte in _PRINTABLE for byte in name):
+        problems.append('unprintable name')
+
+    return problems
+
+
+def _decodes(data, offset: int, layout: Layout) -> bool:
+    for field in layout.fields:
+        if field.decode[(data[offset + field.byte] >> field.shift) & field.mask] is INVALID:
+            return False
+
+    return True
+
+
+def _salvage_frame(data, offset: int, slot: int, layout: Layout, problems: List[str],
+                   signature_mode: Optional[str], validate: Optional[str]) -> SalvagedVoice:
+    problems = problems + _frame_problems(data, offset, layout)
+
+    if validate is not None:
+        counts = validate_voices(data, offset, 1, layout, clamp=validate == 'clamp')
+        record_counts(counts)
+
+        if counts and validate == 'check':
+            return SalvagedVoice(offset, slot, 'invalid', 0.0, tuple(problems) + (
+                'out of range (%s)' % (', '.join(sorted(counts))),), None)
+
+        if counts:
+            problems.append('out of range')
+
+    try:
+        voice = parse_voice(decode_voice(data, offset, layout), signature_mode)
+    except (ValueError, UnicodeDecodeError) as e:
+        return SalvagedVoice(offset, slot, 'invalid', 0.0, tuple(problems) + (str(e),), None)
+
+    confidence = 1.0
+
+    for problem in problems:
+        confidence *= PENALTIES[problem]
+
+    return SalvagedVoice(offset, slot, 'suspect' if problems else 'ok', round(confidence, 3), tuple(problems), voice)
+
+
+def _headers(data) -> Iterator[Tuple[int, Layout, int]]:
+    # Every DX7 message header in data, as (offset of the start byte, layout,
+    # number of voices)
+    for header, layout, num_voices in ((MULTI_VOICE_HEADER, packed_layout(), 32),
+                                       (SINGLE_VOICE_HEADER, unpacked_layout(), 1)):
+        # The channel in the sub-status byte can be anything
+        pattern = header[1:]
+        position = data.find(pattern)
+
+        while position >= 0:
+            start = position - 3
+
+            if start >= 0 and data[start:start + 2] == _MESSAGE_START and data[start + 2] & 0xf0 == header[0]:
+                yield start, layout, num_voices
+
+            position = data.find(pattern, position + 1)
+
+
+def _salvage_message(data, start: int, end: int, layout: Layout, num_voices: int,
+                     signature_mode: Optional[str], validate: Optional[str]) -> List[SalvagedVoice]:
+    # The voices in a message starting at start, which runs (at most) until
+    # end, where the next one starts
+    voices_start = start + 2 + SYSEX_HEADER_SIZE
+    available = min(num_voices, (end - voices_start) // layout.size)
+    voices_end = voices_start + num_voices * layout.size
+    problems = []
+
+    if available == num_voices and voices_end < end:
+        expected = compute_checksum(data[voices_start:voices_end], 0, 0)
+
+        if data[voices_end] != expected:
+            problems.append('bad checksum')
+
+        if voices_end + 1 >= end or data[voices_end + 1] != SYSEX_END_BYTE:
+            problems.append('no end byte')
+    else:
+        # Cut short, or cut off by the next message; either way there's no
+        # checksum to check
+        problems.append('truncated')
+
+    return [_salvage_frame(data, voices_start + i * layout.size, i, layout, problems, signature_mode, validate)
+            for i in range(available)]
+
+
+def _salvage_headerless(data, signature_mode: Optional[str], validate: Optional[str]) -> List[SalvagedVoice]:
+    # Bare voice data: a single unpacked voice, or packed frames from the
+    # start of the data to the end, every one of which has to decode
+    layout = packed_layout()
+    single = unpacked_layout()
+
+    if len(data) >= 2 and data[0] == SYSEX_START_BYTE and data[1] != _MESSAGE_START[1]:
+        # Some other manufacturer's message
+        return []
+
+    if len(data) == single.size:
+        if not _decodes(data, 0, single):
+            return []
+
+        return [_salvage_frame(data, 0, 0, single, ['no header'], signature_mode, validate)]
+
+    if len(data) == 0 or len(data) % layout.size != 0:
+        return []
+
+    offsets = range(0, len(data), layout.size)
+
+    if not all(_decodes(data, offset, layout) for offset in offsets):
+        return []
+
+    return [_salvage_frame(data, offset, slot, layout, ['no header'], signature_mode, validate)
+            for slot, offset in enumerate(offsets)]
+
+
+def salvage(data, signature_mode: Optional[str] = None, validate: Optional[str] = None) -> List[SalvagedVoice]:
+    # Every voice that can be found in data, in the order they appear.
+    # Clamping happens in place, so it needs a copy of data that can be
+    # written to
+    if validate is not None and validate not in VALIDATE_MODES:
+        raise ValueError('Unknown validation mode %s' % (validate))
+
+    data = bytearray(data) if validate == 'clamp' else bytes(data)
+    headers = sorted(_headers(data))
+
+    if not headers:
+        return _salvage_headerless(data, signature_mode, validate)
+
+    salvaged = []
+
+    for i, (start, layout, num_voices) in enumerate(headers):
+        end = headers[i + 1][0] if i + 1 < len(headers) else len(data)
+        salvaged.extend(_salvage_message(data, start, end, layout, num_voices, signature_mode, validate))
+
+    return salvaged
@@ -0,0 +1,143 @@
+import os
+import struct
+from typing import Dict, Iterable, List, Optional, Set, Tuple  # noqa
+
+from .layout import unpacked_layout
+
+# An index for finding voices that are nearly, but not exactly, the same: a
+# copy with one detune step changed, say, or a renamed copy with a slightly
+# tweaked envelope. Voices are compared by their canonical encoding (every
+# parameter in the single-voice layout, name excluded), and the distance
+# between two voices is the sum of the absolute differences between their
+# parameters.
+#
+# Rather than comparing every pair of voices, the parameters are split into
+# blocks and each block is indexed exactly. Two voices within distance d of
+# each other differ in at most d parameters, so if d is less than the number of
+# blocks, they differ in at most d blocks, and must share at least one of any
+# d + 1 of them outright. Only voices that share one of the query's d + 1 least
+# common blocks are ever compared. Blocks that most voices have in common (an
+# unused operator, say) are skipped that way, which keeps queries exact up to
+# that distance and building the index linear in the number of voices.
+
+DEFAULT_NUM_BLOCKS = 16
+
+_FILE_MAGIC = b'SXND'
+_FILE_VERSION = 1
+_FILE_HEADER = struct.Struct('>4sBHH')
+
+
+def distance(a: bytes, b: bytes) -> int:
+    return sum(abs(x - y) for x, y in zip(a, b))
+
+
+class NearDuplicateIndex(object):
+    def __init__(self, num_blocks: int = DEFAULT_NUM_BLOCKS, vector_size: Optional[int] = None):
+        if vector_size is None:
+            vector_size = unpacked_layout().canonical_size
+
+        self.num_blocks = num_blocks
+        self.vector_size = vector_size
+        self.vectors = {}  # type: Dict[str, bytes]
+
+        # Blocks are as close to the same size as possible
+        self._bounds = [(i * vector_size // num_blocks, (i + 1) * vector_size // num_blocks)
+                        for i in range(num_blocks)]
+        self._blocks = [{} for _ in range(num_blocks)]  # type: List[Dict[bytes, Set[str]]]
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def __contains__(self, signature: str) -> bool:
+        return signature in self.vectors
+
+    def add(self, signature: str, vector: bytes):
+        if len(vector) != self.vector_size:
+            raise ValueError('Expected a vector of %d parameters, got %d' % (self.vector_size, len(vector)))
+
+        if signature in self.vectors:
+            self.remove(signature)
+
+        vector = bytes(vector)
+        self.vectors[signature] = vector
+
+        for (start, end), block in zip(self._bounds, self._blocks):
+            block.setdefault(vector[start:end], set()).add(signature)
+
+    def remove(self, signature: str):
+        vector = self.vectors.pop(signature, None)
+
+        if vector is None:
+            return
+
+        for (start, end), block in zip(self._bounds, self._blocks):
+            bucket = block[vector[start:end]]
+            bucket.discard(signature)
+
+            if not bucket:
+                del block[vector[start:end]]
+
+    def _candidates(self, vector: bytes, max_distance: int) -> Iterable[str]:
+        if max_distance >= self.num_blocks:
+            # Too far for the blocks to narrow anything down
+            return self.vectors.keys()
+
+        # By the pigeonhole argument above, any d + 1 of the query's blocks
+        # will do, so pick the ones with the fewest voices in them
+        buckets = [block.get(vector[start:end], ()) for (start, end), block in zip(self._bounds, self._blocks)]
+        buckets.sort(key=len)
+
+        return set().union(*buckets[:max_distance + 1])
+
+    def nearest(self, vector: bytes, max_distance: int, k: Optional[int] = None,
+                exclude: Optional[str] = None) -> List[Tuple[int, str]]:
+        # The k nearest voices (or all of them, if k is None) within
+        # max_distance of vector, as (distance, signature) pairs, nearest
+        # first. Ties are broken by signature so that results are stable.
+        matches = []
+
+        for signature in self._candidates(vector, max_distance):
+            if signature == exclude:
+                continue
+
+            d = distance(vector, self.vectors[signature])
+
+            if d <= max_distance:
+                matches.append((d, signature))
+
+        matches.sort()
+
+        return matches if k is None else matches[:k]
+
+    def save(self, path: str, tag: str = ''):
+        # tag is stored alongside the vectors (build_patch_bank uses it for the
+        # signature mode) and handed back by load
+        temp_path = path + '.tmp'
+        tag_bytes = tag.encode('utf-8')
+
+        with open(temp_path, 'wb') as fp:
+            fp.write(_FILE_HEADER.pack(_FILE_MAGIC, _FILE_VERSION, self.vector_size, len(tag_bytes)))
+            fp.write(tag_bytes)
+            fp.write(b''.join(bytes.fromhex(signature) + vector for signature, vector in self.vectors.items()))
+
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str, num_blocks: int = DEFAULT_NUM_BLOCKS) -> Tuple['NearDuplicateIndex', str]:
+        with open(path, 'rb') as fp:
+            magic, version, vector_size, tag_length = _FILE_HEADER.unpack(fp.read(_FILE_HEADER.size))
+
+            if magic != _FILE_MAGIC or version != _FILE_VERSION:
+                raise ValueError('%s is not a near-duplicate index this version can read' % (path))
+
+            tag = fp.read(tag_length).decode('utf-8')
+            data = fp.read()
+
+        index = cls(num_blocks, vector_size)
+        # Signatures are SHA-1 digests
+        record_size = 20 + vector_size
+
+        for offset in range(0, len(data), record_size):
+            index.add(data[offset:offset + 20].hex(), data[offset + 20:offset + record_size])
+
+        return index, tag
@@ -1,3 +1,5 @@
+from typing import Dict  # noqa
+
 import bread as b
 # Format taken from https://github.com/asb2m10/dexed/blob/master/Documentation/sysex-format.txt
 
@@ -24,6 +26,38 @@ enums = {
         # valid value for S&H, even though the spec's value is 5
         (5, 6, 7): 'sample and hold'
     }
+}  # type: Dict[str, dict]
+
+# The values the DX7 itself accepts for each parameter, as decoded (so with
+# any offset below already applied). Most fields below can hold more than
+# this; ranges.py compiles these into checks on the raw bytes. Enum-valued
+# parameters are limited to the first raw value listed for each of their
+# values instead.
+ranges = {
+    'eg_rates': (0, 99),
+    'eg_levels': (0, 99),
+    'keyboard_level_scaling_break_point': (0, 99),
+    'keyboard_level_scaling_left_depth': (0, 99),
+    'keyboard_level_scaling_right_depth': (0, 99),
+    'keyboard_rate_scaling': (0, 7),
+    'amp_mod_sensitivity': (0, 3),
+    'key_velocity_sensitivity': (0, 7),
+    'output_level': (0, 99),
+    'osc_frequency_coarse': (0, 31),
+    'osc_frequency_fine': (0, 99),
+    'osc_detune': (-7, 7),
+    'pitch_eg_rates': (0, 99),
+    'pitch_eg_levels': (0, 99),
+    'algorithm': (1, 32),
+    'feedback': (0, 7),
+    'oscillator_sync': (0, 1),
+    'lfo_speed': (0, 99),
+    'lfo_delay': (0, 99),
+    'lfo_pitch_mod_depth': (0, 99),
+    'lfo_amp_mod_depth': (0, 99),
+    'lfo_sync': (0, 1),
+    'pitch_mod_sensitivity': (0, 7),
+    'transpose': (0, 48)
 }
 
 raw_operator = [
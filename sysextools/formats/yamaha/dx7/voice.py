@@ -0,0 +1,164 @@
+from functools import lru_cache
+from hashlib import sha1
+from typing import Any, Dict, List, Optional, Tuple  # noqa
+
+from .layout import unpacked_layout
+from .native import DecodedArray
+from .spec import NAME_ENCODING
+
+# Compact voice objects, for when whole libraries need to be held in memory.
+# A DX7Voice is nothing but the voice's single-voice (155-byte) encoding plus
+# whatever metadata has been attached to it; parameters are decoded from the
+# bytes only when they're asked for. Parameters are exposed under the same
+# names as the bread structs in spec.py, so a DX7Voice can be handed to
+# anything that expects one of those.
+
+# The keys parse_voice fills in alongside a voice's parameters
+_DERIVED_KEYS = ('NAME', 'MANUFACTURER', 'MODEL', 'SIGNATURE')
+
+
+@lru_cache(maxsize=None)
+def _accessors() -> Tuple[Dict[str, list], Dict[str, list], int]:
+    voice_fields = {}  # type: Dict[str, list]
+    operator_fields = {}  # type: Dict[str, list]
+    operator_size = 0
+
+    for field in unpacked_layout().fields:
+        if field.operator is None:
+            voice_fields.setdefault(field.name, []).append(field)
+        elif field.operator == 0:
+            operator_fields.setdefault(field.name, []).append(field)
+        elif field.operator == 1 and operator_size == 0:
+            operator_size = field.byte
+
+    return voice_fields, operator_fields, operator_size
+
+
+def _decode(data: bytes, offset: int, fields: list):
+    if fields[0].element is None:
+        return fields[0].decode[data[offset + fields[0].byte]]
+
+    return DecodedArray(field.decode[data[offset + field.byte]] for field in fields)
+
+
+class DX7Operator(object):
+    __slots__ = ('_data', '_offset')
+
+    def __init__(self, data: bytes, index: int):
+        # index is in struct order, i.e. OP6 is operator 0
+        self._data = data
+        self._offset = index * _accessors()[2]
+
+    def __getattr__(self, attr: str):
+        fields = _accessors()[1].get(attr)
+
+        if fields is None:
+            raise AttributeError("No known field '%s'" % (attr))
+
+        return _decode(self._data, self._offset, fields)
+
+    def to_dict(self) -> dict:
+        from . import parse_operator
+
+        return parse_operator(self)
+
+
+class DX7Voice(object):
+    __slots__ = ('_data', '_signature', '_signature_mode', 'metadata')
+
+    def __init__(self, data: bytes, signature_mode: Optional[str] = None, metadata: Optional[dict] = None):
+        layout = unpacked_layout()
+
+        if len(data) != layout.size:
+            raise ValueError('Expected %d bytes of voice data, got %d' % (layout.size, len(data)))
+
+        self._data = bytes(data)
+        self._signature = None  # type: Optional[str]
+        self._signature_mode = signature_mode
+        self.metadata = metadata if metadata is not None else {}  # type: Dict[str, Any]
+
+    @classmethod
+    def from_dict(cls, voice: dict, signature_mode: Optional[str] = None) -> 'DX7Voice':
+        from . import canonical_bytes
+
+        layout = unpacked_layout()
+        name = voice['NAME'].encode(NAME_ENCODING)[:layout.name_length].ljust(layout.name_length)
+        metadata = {key: value for key, value in voice.items() if key.isupper() and key not in _DERIVED_KEYS}
+
+        return cls(canonical_bytes(voice) + name, signature_mode, metadata)
+
+    def __getattr__(self, attr: str):
+        if attr == 'operators':
+            return [DX7Operator(self._data, i) for i in range(6)]
+
+        if attr == 'name':
+            layout = unpacked_layout()
+            return self._data[layout.name_offset:layout.name_offset + layout.name_length].decode(NAME_ENCODING)
+
+        fields = _accessors()[0].get(attr)
+
+        if fields is None:
+            raise AttributeError("No known field '%s'" % (attr))
+
+        return _decode(self._data, 0, fields)
+
+    def __getitem__(self, key: str):
+        if key in self.metadata:
+            return self.metadata[key]
+
+        if key == 'NAME':
+            return self.name.strip()
+
+        if key == 'SIGNATURE':
+            return self.signature
+
+        if key == 'MANUFACTURER':
+            return 'yamaha'
+
+        if key == 'MODEL':
+            return 'dx7'
+
+        return self.to_dict()[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.metadata or key in _DERIVED_KEYS
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, DX7Voice):
+            return NotImplemented
+
+        return self._data == other._data and self.metadata == other.metadata
+
+    def __repr__(self) -> str:
+        return 'DX7Voice(%r)' % (self.name.strip())
+
+    @property
+    def data(self) -> bytes:
+        return self._data
+
+    @property
+    def canonical_bytes(self) -> bytes:
+        return self._data[:unpacked_layout().canonical_size]
+
+    @property
+    def signature(self) -> str:
+        if self._signature is None:
+            from . import compute_signature, DEFAULT_SIGNATURE_MODE, parse_voice_parameters
+
+            mode = self._signature_mode or DEFAULT_SIGNATURE_MODE
+
+            if mode == 'canonical':
+                self._signature = sha1(self.canonical_bytes).hexdigest()
+            else:
+                self._signature = compute_signature(parse_voice_parameters(self), mode)
+
+        return self._signature
+
+    def to_dict(self) -> dict:
+        from . import parse_voice_parameters
+
+        parsed_voice = parse_voice_parameters(self)
+        parsed_voice['SIGNATURE'] = self.signature
+        parsed_voice.update(self.metadata)
+
+        return parsed_voice
@@ -0,0 +1,152 @@
+from contextlib import contextmanager
+import json
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional  # noqa
+
+# Opt-in counters and timers for the parse/dump pipeline. Nothing is recorded
+# unless something is listening, either a Stats collected with collect_stats()
+# or a callback added with add_callback(); until then, timed() and count() do
+# next to nothing, so they're safe to leave in hot loops.
+#
+#     with collect_stats() as stats:
+#         parse('bank.syx')
+#
+#     print(stats.summary())
+
+# Callbacks get the stage's name, how long it took in seconds (None for plain
+# counters) and how many things it counted
+Callback = Callable[[str, Optional[float], int], None]
+
+_listeners = []  # type: List[Callback]
+
+
+class Stats(object):
+    def __init__(self):
+        self.counts = {}  # type: Dict[str, int]
+        self.seconds = {}  # type: Dict[str, float]
+
+    def __call__(self, stage: str, seconds: Optional[float], count: int):
+        self.counts[stage] = self.counts.get(stage, 0) + count
+
+        if seconds is not None:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def to_dict(self) -> dict:
+        return {'counts': dict(self.counts), 'seconds': dict(self.seconds)}
+
+    def summary(self) -> str:
+        lines = ['{:<24} {:>10} {:>12} {:>12}'.format('stage', 'count', 'seconds', 'ms each')]
+
+        for stage in sorted(self.counts):
+            seconds = self.seconds.get(stage)
+
+            if seconds is None:
+                lines.append('{:<24} {:>10}'.format(stage, self.counts[stage]))
+            else:
+                lines.append('{:<24} {:>10} {:>12.4f} {:>12.4f}'.format(
+                    stage, self.counts[stage], seconds, 1000 * seconds / max(self.counts[stage], 1)))
+
+        return '\n'.join(lines)
+
+
+def enabled() -> bool:
+    return len(_listeners) > 0
+
+
+def add_callback(callback: Callback):
+    _listeners.append(callback)
+
+
+def remove_callback(callback: Callback):
+    _listeners.remove(callback)
+
+
+def record(stage: str, seconds: Optional[float] = None, count: int = 1):
+    for listener in _listeners:
+        listener(stage, seconds, count)
+
+
+def count(stage: str, n: int = 1):
+    if _listeners:
+        record(stage, None, n)
+
+
+def merge(snapshot: Optional[dict]):
+    # Passes on counts and timings collected elsewhere (e.g. in a worker
+    # process) to whatever's listening here
+    if snapshot is None:
+        return
+
+    for stage, n in snapshot['counts'].items():
+        record(stage, snapshot['seconds'].get(stage), n)
+
+
+class _Timer(object):
+    __slots__ = ('stage', 'count', 'start')
+
+    def __init__(self, stage: str, count: int):
+        self.stage = stage
+        self.count = count
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        record(self.stage, time.perf_counter() - self.start, self.count)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timed(stage: str, count: int = 1):
+    # A context manager that times its body as one occurrence (or count
+    # occurrences) of stage
+    if not _listeners:
+        return _NULL_TIMER
+
+    return _Timer(stage, count)
+
+
+@contextmanager
+def collect_stats() -> Iterator[Stats]:
+    stats = Stats()
+    add_callback(stats)
+
+    try:
+        yield stats
+    finally:
+        remove_callback(stats)
+
+
+def report_stats(stats: Stats, destination: str):
+    # Prints a summary if destination is '-', and writes JSON to destination
+    # otherwise
+    if destination == '-':
+        print(stats.summary(), file=sys.stderr)
+    else:
+        with open(destination, 'w') as fp:
+            json.dump(stats.to_dict(), fp, indent=2)
+
+
+def run_with_stats(destination: Optional[str], fn: Callable[..., Any], *args, **kwargs) -> Any:
+    # Calls fn, collecting stats while it runs and reporting them to
+    # destination (see report_stats) if it's given. This is what the
+    # command-line tools' --stats option does.
+    if destination is None:
+        return fn(*args, **kwargs)
+
+    with collect_stats() as stats:
+        result = fn(*args, **kwargs)
+
+    report_stats(stats, destination)
+
+    return result
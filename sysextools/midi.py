@@ -0,0 +1,280 @@
+from collections import deque
+import logging
+import os
+import queue
+import select
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union  # noqa
+
+from . import dumps, metrics, parse, registry
+from .constants import EXTENDED_MANUFACTURER_ID_BYTE, SYSEX_END_BYTE
+from .errors import ChecksumError, NotSupportedError
+from .stream import SysExSplitter
+
+logger = logging.getLogger(__name__)
+
+# Sending SysEx to, and receiving it from, synths over MIDI. Synths only have
+# small input buffers and take a while to digest a bank, so outgoing messages
+# are sent in chunks, with a pause after each chunk and after each message.
+# Incoming bytes are split into messages as they arrive, and each message's
+# checksum is checked (for formats that have one) before it's handed on.
+#
+# The bytes themselves go through a backend. 'loopback' hands back whatever's
+# sent to it, for trying things out without a synth; 'raw' reads and writes a
+# raw MIDI device (e.g. /dev/snd/midiC1D0); 'mido' uses mido's ports, if mido
+# is installed. Other backends can be added with register_backend().
+#
+#     with Transport(open_backend('raw', port='/dev/snd/midiC1D0')) as transport:
+#         transport.send_voices(voices)
+
+
+# At MIDI's 31250 baud, a 4104-byte bank takes about 1.3 seconds on the wire
+DEFAULT_CHUNK_SIZE = 256
+DEFAULT_CHUNK_DELAY = 0.0
+DEFAULT_MESSAGE_DELAY = 0.1
+
+_RECEIVE_CHUNK_SIZE = 4096
+
+
+class LoopbackBackend(object):
+    # Everything sent comes straight back
+    def __init__(self):
+        self._queue = queue.Queue()  # type: queue.Queue
+
+    def send(self, data: bytes):
+        self._queue.put(bytes(data))
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        pass
+
+
+class RawBackend(object):
+    # A raw MIDI device (its path is the port), read and written as a byte
+    # stream
+    def __init__(self, port: str):
+        self._fd = os.open(port, os.O_RDWR | os.O_NONBLOCK)
+
+    def send(self, data: bytes):
+        view = memoryview(data)
+
+        while view:
+            try:
+                written = os.write(self._fd, view)
+            except BlockingIOError:
+                select.select([], [self._fd], [])
+                continue
+
+            view = view[written:]
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+
+        if not readable:
+            return None
+
+        return os.read(self._fd, _RECEIVE_CHUNK_SIZE)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class MidoBackend(object):
+    # mido only sends whole messages, so chunks are held on to until the
+    # message they're part of is complete, and only the delay between
+    # messages applies
+    def __init__(self, port: Optional[str] = None, output_port: Optional[str] = None):
+        try:
+            import mido
+        except ImportError:  # pragma: no cover
+            raise NotSupportedError('The mido backend requires mido')
+
+        self._mido = mido
+        self._input = mido.open_input(port)
+        self._output = mido.open_output(output_port if output_port is not None else port)
+        self._pending = bytearray()
+
+    def send(self, data: bytes):
+        self._pending += data
+
+        while SYSEX_END_BYTE in self._pending:
+            end = self._pending.index(SYSEX_END_BYTE) + 1
+            self._output.send(self._mido.Message.from_bytes(self._pending[:end]))
+            del self._pending[:end]
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            message = self._input.poll()
+
+            if message is not None:
+                return bytes(message.bytes())
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+            time.sleep(0.001)
+
+    def close(self):
+        self._input.close()
+        self._output.close()
+
+
+_backends = {
+    'loopback': LoopbackBackend,
+    'raw': RawBackend,
+    'mido': MidoBackend
+}  # type: Dict[str, Callable[..., Any]]
+
+
+def register_backend(name: str, factory: Callable[..., Any]):
+    # factory(**kwargs) should return an object with send(data),
+    # receive(timeout) (returning whatever bytes have arrived, or None once
+    # timeout seconds go by without any) and close() methods
+    _backends[name] = factory
+
+
+def open_backend(name: str, **kwargs) -> Any:
+    if name not in _backends:
+        raise NotSupportedError('Unknown MIDI backend %s' % (name))
+
+    return _backends[name](**kwargs)
+
+
+def validate_checksum(message: bytes) -> bool:
+    # Messages in formats without a checksum (or without a module that checks
+    # it), or from manufacturers that aren't supported, pass
+    start = 4 if message[1] == EXTENDED_MANUFACTURER_ID_BYTE else 2
+    body = message[start:-1]
+
+    try:
+        fmt = registry.detect_format(tuple(message[1:start]), body[:4])
+    except NotSupportedError:
+        return True
+
+    validate = getattr(registry.load(fmt), 'validate_checksum', None)
+
+    return validate is None or validate(body)
+
+
+class Transport(object):
+    def __init__(self, backend, chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+                 chunk_delay: float = DEFAULT_CHUNK_DELAY, message_delay: float = DEFAULT_MESSAGE_DELAY,
+                 sleep: Callable[[float], None] = time.sleep):
+        # chunk_size None sends each message in one go
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.message_delay = message_delay
+        self._sleep = sleep
+        self._splitter = SysExSplitter()
+        self._received = deque()  # type: deque
+
+    def __enter__(self) -> 'Transport':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.backend.close()
+
+    def send_message(self, message: bytes):
+        chunk_size = self.chunk_size or len(message)
+
+        with metrics.timed('send'):
+            for start in range(0, len(message), chunk_size):
+                if start > 0 and self.chunk_delay:
+                    self._sleep(self.chunk_delay)
+
+                self.backend.send(message[start:start + chunk_size])
+
+    def send_messages(self, messages: Iterable[bytes]) -> int:
+        count = 0
+
+        for message in messages:
+            if count > 0 and self.message_delay:
+                self._sleep(self.message_delay)
+
+            self.send_message(message)
+            count += 1
+
+        return count
+
+    def send(self, parsed_sysex: Union[Dict[str, Any], List[Dict[str, Any]]], **kwargs):
+        # Dumps a voice or a list of voices (see dumps()) and sends it
+        self.send_message(dumps(parsed_sysex, **kwargs))
+
+    def send_voices(self, voices: Iterable[Dict[str, Any]], bank_size: int = 32, **kwargs) -> int:
+        # Sends any number of voices a bank at a time, which is much quicker
+        # than a message per voice. Returns the number of banks sent.
+        def banks() -> Iterator[bytes]:
+            bank = []  # type: List[Dict[str, Any]]
+
+            for voice in voices:
+                bank.append(voice)
+
+                if len(bank) == bank_size:
+                    yield dumps(bank, **kwargs)
+                    bank = []
+
+            if bank:
+                yield dumps(bank, **kwargs)
+
+        return self.send_messages(banks())
+
+    def receive_messages(self, timeout: Optional[float] = None, max_messages: Optional[int] = None,
+                         strict: bool = True) -> Iterator[bytes]:
+        # Yields complete SysEx messages as they come in, until max_messages
+        # have, or until timeout seconds go by without anything arriving.
+        # Messages with bad checksums raise a ChecksumError, or are logged and
+        # dropped if strict is False.
+        count = 0
+
+        while max_messages is None or count < max_messages:
+            if not self._received:
+                data = self.backend.receive(timeout)
+
+                if data is None:
+                    return
+
+                self._received.extend(message for _, message in self._splitter.feed(data))
+                continue
+
+            message = self._received.popleft()
+
+            with metrics.timed('checksum'):
+                checksum_ok = validate_checksum(message)
+
+            if not checksum_ok:
+                if strict:
+                    raise ChecksumError('Received a SysEx message with a bad checksum')
+
+                logger.warning('Dropping a received %d-byte SysEx message with a bad checksum', len(message))
+                metrics.count('bad_checksum')
+                continue
+
+            count += 1
+            metrics.count('receive')
+
+            yield message
+
+    def receive(self, timeout: Optional[float] = None, max_messages: Optional[int] = None, strict: bool = True,
+                skip_unsupported: bool = True, **kwargs) -> Iterator[List[Dict[str, Any]]]:
+        # Like receive_messages(), but parses each message. Messages from
+        # manufacturers without a parser are skipped unless skip_unsupported
+        # is False.
+        for message in self.receive_messages(timeout, max_messages, strict):
+            try:
+                yield parse(message, **kwargs)
+            except NotSupportedError:
+                if skip_unsupported:
+                    continue
+
+                raise
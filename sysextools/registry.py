@@ -0,0 +1,178 @@
+from importlib import import_module
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple  # noqa
+
+from .errors import NotSupportedError
+
+# Every format sysextools can read or write, keyed by what its messages look
+# like, so that the right decoder can be picked straight from a message's
+# first few bytes without trying any parsers. Formats are described by the
+# fields of a (Yamaha-style) bulk dump header: the manufacturer ID, the
+# sub-status (with the MIDI channel masked off), the format number and the
+# byte count. Fields left as None match anything.
+#
+# A format's module is only imported when a message in that format turns up.
+# It has to provide parse(sysex_bytes, **kwargs) and dump(parsed_sysex,
+# **kwargs), which work on everything between the manufacturer ID and the end
+# byte, and add_headers_and_footers(bank_bytes), which adds back the same.
+#
+# Other packages can add formats through the 'sysextools.formats' entry point
+# group. Each entry point should name a function that calls register_format()
+# for each format the package provides. Entry points are only loaded once a
+# message turns up that the built-in formats don't cover.
+
+ENTRY_POINT_GROUP = 'sysextools.formats'
+
+# The sub-status of a bulk dump, once the channel has been masked off
+BULK_DUMP = 0x00
+
+_SUB_STATUS_MASK = 0x70
+
+
+class Format(NamedTuple):
+    manufacturer: str
+    model: str
+    # Dotted path to the module that parses and dumps the format
+    module: str
+    manufacturer_id: Tuple[int, ...]
+    sub_status: Optional[int]
+    format_number: Optional[int]
+    byte_count: Optional[int]
+
+
+HeaderKey = Tuple[Tuple[int, ...], Optional[int], Optional[int], Optional[int]]
+
+# (manufacturer ID, sub-status, format number, byte count) -> format
+_by_header = {}  # type: Dict[HeaderKey, Format]
+# (manufacturer, model) -> the first format registered for that model
+_by_model = {}  # type: Dict[Tuple[str, str], Format]
+_manufacturer_ids = {}  # type: Dict[str, Tuple[int, ...]]
+_modules = {}  # type: Dict[str, Any]
+_entry_points_loaded = False
+
+
+def register_format(manufacturer: str, model: str, module: str, manufacturer_id: Tuple[int, ...],
+                    sub_status: Optional[int] = None, format_number: Optional[int] = None,
+                    byte_count: Optional[int] = None):
+    fmt = Format(manufacturer, model, module, tuple(manufacturer_id), sub_status, format_number, byte_count)
+    key = (fmt.manufacturer_id, sub_status, format_number, byte_count)
+
+    if key in _by_header and _by_header[key] != fmt:
+        raise ValueError('Header %s is already registered to %s %s' %
+                         (key, _by_header[key].manufacturer, _by_header[key].model))
+
+    _by_header[key] = fmt
+    _by_model.setdefault((manufacturer, model), fmt)
+    _manufacturer_ids.setdefault(manufacturer, fmt.manufacturer_id)
+
+    # Messages whose byte count doesn't match any format (some devices get it
+    # wrong) still go to the format with their format number, as long as
+    # there's only one
+    loose_key = (fmt.manufacturer_id, sub_status, format_number, None)
+
+    if byte_count is not None and loose_key not in _by_header:
+        _by_header[loose_key] = fmt
+
+
+def _load_entry_points():
+    global _entry_points_loaded
+
+    if _entry_points_loaded:
+        return
+
+    _entry_points_loaded = True
+
+    from importlib.metadata import entry_points
+
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        entry_point.load()()
+
+
+def _lookup(key: HeaderKey) -> Optional[Format]:
+    manufacturer_id, sub_status, format_number, byte_count = key
+
+    for candidate in (key, (manufacturer_id, sub_status, format_number, None), (manufacturer_id, None, None, None)):
+        fmt = _by_header.get(candidate)
+
+        if fmt is not None:
+            return fmt
+
+    return None
+
+
+def header_key(manufacturer_id: Tuple[int, ...], header) -> HeaderKey:
+    # header is whatever follows the manufacturer ID; only the first four
+    # bytes are looked at
+    sub_status = header[0] & _SUB_STATUS_MASK if len(header) > 0 else None
+    format_number = header[1] if len(header) > 1 else None
+    byte_count = (header[2] << 7) | header[3] if len(header) > 3 else None
+
+    return (manufacturer_id, sub_status, format_number, byte_count)
+
+
+def detect_format(manufacturer_id: Tuple[int, ...], header) -> Format:
+    key = header_key(manufacturer_id, header)
+    fmt = _lookup(key)
+
+    if fmt is None and not _entry_points_loaded:
+        _load_entry_points()
+        fmt = _lookup(key)
+
+    if fmt is None:
+        if any(f.manufacturer_id == manufacturer_id for f in _by_header.values()):
+            raise NotSupportedError('No format registered for SysEx with header %s' % (key,))
+
+        raise NotSupportedError("Manufacturer ID for this SysEx (%s) not supported" % (manufacturer_id,))
+
+    return fmt
+
+
+def get_format(manufacturer: str, model: str) -> Format:
+    fmt = _by_model.get((manufacturer, model))
+
+    if fmt is None and not _entry_points_loaded:
+        _load_entry_points()
+        fmt = _by_model.get((manufacturer, model))
+
+    if fmt is None:
+        raise NotSupportedError('%s %s is not supported' % (manufacturer, model))
+
+    return fmt
+
+
+def manufacturer_id(manufacturer: str) -> Tuple[int, ...]:
+    if manufacturer not in _manufacturer_ids and not _entry_points_loaded:
+        _load_entry_points()
+
+    if manufacturer not in _manufacturer_ids:
+        raise NotSupportedError('Manufacturer %s is not supported' % (manufacturer))
+
+    return _manufacturer_ids[manufacturer]
+
+
+def manufacturer(manufacturer_id: Tuple[int, ...]) -> str:
+    for name, registered_id in _manufacturer_ids.items():
+        if registered_id == manufacturer_id:
+            return name
+
+    raise NotSupportedError("Manufacturer ID for this SysEx (%s) not supported" % (manufacturer_id,))
+
+
+def load(fmt: Format) -> Any:
+    module = _modules.get(fmt.module)
+
+    if module is None:
+        module = import_module(fmt.module)
+        _modules[fmt.module] = module
+
+    return module
+
+
+def formats() -> List[Format]:
+    _load_entry_points()
+
+    return list(dict.fromkeys(_by_header.values()))
+
+
+# The built-in formats
+register_format('yamaha', 'dx7', 'sysextools.formats.yamaha.dx7', (0x43,), BULK_DUMP, 0, 155)
+register_format('yamaha', 'dx7', 'sysextools.formats.yamaha.dx7', (0x43,), BULK_DUMP, 9, 4096)
@@ -0,0 +1,309 @@
+import io
+import os
+import re
+from typing import BinaryIO, cast, Iterable, Iterator, List, Optional, Tuple, Union  # noqa
+
+from .constants import SYSEX_START_BYTE, SYSEX_END_BYTE
+
+# Splitting of byte streams (raw SysEx dumps, MIDI captures and Standard MIDI
+# Files) into individual SysEx messages, a chunk at a time, so that
+# arbitrarily large captures can be processed in constant memory.
+
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+# Anything longer than this is assumed to be garbage (e.g. a start byte whose
+# end byte never came) and is thrown away rather than buffered indefinitely
+DEFAULT_MAX_MESSAGE_SIZE = 1 << 20
+
+# Any status byte other than a real-time one ends a SysEx message. Real-time
+# bytes may legally be interleaved with a message's data and are dropped.
+_STATUS_BYTE = re.compile(b'[\x80-\xf7]')
+_REALTIME_BYTES = bytes(range(0xf8, 0x100))
+
+_SMF_HEADER = b'MThd'
+_SMF_TRACK = b'MTrk'
+
+
+class SysExSplitter(object):
+    # Incrementally splits a stream of MIDI bytes into SysEx messages. Feed it
+    # chunks as they arrive; each call returns the messages completed by that
+    # chunk as (offset, message) pairs, where offset is the position of the
+    # message's start byte in the stream as a whole.
+
+    def __init__(self, max_message_size: Optional[int] = DEFAULT_MAX_MESSAGE_SIZE):
+        self.max_message_size = max_message_size
+        self._buffer = bytearray()
+        # Stream offset of the first byte in the buffer
+        self._base = 0
+        # Position in the buffer of the current message's start byte, if any
+        self._start = None  # type: Optional[int]
+        # Position in the buffer to resume scanning from
+        self._position = 0
+
+    def feed(self, chunk: bytes) -> List[Tuple[int, bytes]]:
+        buf = self._buffer
+        buf += chunk
+        messages = []
+        position = self._position
+
+        while True:
+            if self._start is None:
+                start = buf.find(SYSEX_START_BYTE, position)
+
+                if start < 0:
+                    position = len(buf)
+                    break
+
+                self._start = start
+                position = start + 1
+
+            match = _STATUS_BYTE.search(buf, position)
+
+            if match is None:
+                position = len(buf)
+
+                if self.max_message_size is not None and position - self._start > self.max_message_size:
+                    self._start = None
+
+                break
+
+            end = match.start()
+
+            if buf[end] == SYSEX_END_BYTE:
+                message = bytes(buf[self._start:end + 1]).translate(None, _REALTIME_BYTES)
+
+                if self.max_message_size is None or len(message) <= self.max_message_size:
+                    messages.append((self._base + self._start, message))
+
+                position = end + 1
+            else:
+                # The message was cut short; the status byte that interrupted
+                # it may well be the start of the next one
+                position = end
+
+            self._start = None
+
+        # Throw away everything that's been dealt with
+        consumed = position if self._start is None else self._start
+        del buf[:consumed]
+        self._base += consumed
+        self._position = position - consumed
+
+        if self._start is not None:
+            self._start -= consumed
+
+        return messages
+
+
+class _TruncatedTrack(Exception):
+    pass
+
+
+class _TrackReader(object):
+    # Reads a Standard MIDI File track's events from fp a buffer at a time,
+    # never reading past the end of the track. Running out of track (or of
+    # file) partway through an event raises _TruncatedTrack.
+
+    def __init__(self, fp: BinaryIO, length: int, chunk_size: int):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        # Bytes of the track not read from fp yet
+        self._unread = length
+        self._buffer = b''
+        self._position = 0
+        # Bytes of the track consumed so far
+        self.offset = 0
+
+    def at_end(self) -> bool:
+        return self._position == len(self._buffer) and self._unread == 0
+
+    def _fill(self, size: int):
+        available = len(self._buffer) - self._position
+
+        if available >= size:
+            return
+
+        data = self._fp.read(min(self._unread, max(size - available, self._chunk_size)))
+        self._unread -= len(data)
+        self._buffer = self._buffer[self._position:] + data
+        self._position = 0
+
+        if len(self._buffer) < size:
+            raise _TruncatedTrack()
+
+    def read_byte(self) -> int:
+        self._fill(1)
+        byte = self._buffer[self._position]
+        self._position += 1
+        self.offset += 1
+
+        return byte
+
+    def read_varlen(self) -> int:
+        value = 0
+
+        while True:
+            byte = self.read_byte()
+            value = (value << 7) | (byte & 0x7f)
+
+            if not byte & 0x80:
+                return value
+
+    def read(self, size: int) -> bytes:
+        self._fill(size)
+        data = self._buffer[self._position:self._position + size]
+        self._position += size
+        self.offset += size
+
+        return data
+
+    def skip(self, size: int):
+        available = len(self._buffer) - self._position
+
+        if size <= available:
+            self._position += size
+            self.offset += size
+            return
+
+        if size - available > self._unread:
+            raise _TruncatedTrack()
+
+        self._fp.seek(size - available, os.SEEK_CUR)
+        self._unread -= size - available
+        self._buffer = b''
+        self._position = 0
+        self.offset += size
+
+    def skip_rest(self):
+        # Moves fp to the end of the track, wherever reading stopped
+        self._fp.seek(self._unread, os.SEEK_CUR)
+        self._unread = 0
+        self._buffer = b''
+        self._position = 0
+
+
+def _iter_track_messages(track: _TrackReader, base: int,
+                         max_message_size: Optional[int]) -> Iterator[Tuple[int, bytes]]:
+    # The SysEx messages in a track starting at offset base. Messages split
+    # across several events are put back together; like SysExSplitter, this
+    # throws away any longer than max_message_size without buffering them.
+    running_status = 0
+    pending = None  # type: Optional[Tuple[int, bytearray]]
+
+    while not track.at_end():
+        track.read_varlen()
+        status = track.read_byte()
+        # Data bytes of the event already read
+        consumed = 0
+
+        if not status & 0x80:
+            # Running status: that was the event's first data byte
+            status = running_status
+            consumed = 1
+
+        if status in (0xf0, 0xf7):
+            event_start = base + track.offset - 1
+            length = track.read_varlen()
+
+            if status == 0xf0:
+                size = 1 + length
+            elif pending is not None:
+                size = len(pending[1]) + length
+            else:
+                # Nothing to continue
+                track.skip(length)
+                continue
+
+            if max_message_size is not None and size > max_message_size:
+                track.skip(length)
+                pending = None
+                continue
+
+            data = track.read(length)
+
+            if status == 0xf0:
+                pending = (event_start, bytearray([SYSEX_START_BYTE]) + data)
+            elif pending is not None:
+                # A continuation of a SysEx message split across events
+                pending[1].extend(data)
+
+            if pending is not None and pending[1][-1] == SYSEX_END_BYTE:
+                yield pending[0], bytes(pending[1])
+                pending = None
+        elif status == 0xff:
+            track.read_byte()
+            track.skip(track.read_varlen())
+        else:
+            running_status = status
+            track.skip((1 if 0xc0 <= status < 0xe0 else 2) - consumed)
+
+
+def _iter_smf_messages(fp: BinaryIO, base: int, chunk_size: int,
+                       max_message_size: Optional[int]) -> Iterator[Tuple[int, bytes]]:
+    # Standard MIDI Files store SysEx as length-prefixed events, so they can't
+    # be scanned for start and end bytes; walk the events of each track
+    # instead, a buffer at a time. A track that's cut short is read up to
+    # where it stops.
+    offset = base
+
+    while True:
+        chunk_header = fp.read(8)
+
+        if len(chunk_header) < 8:
+            return
+
+        chunk_type = chunk_header[:4]
+        chunk_length = int.from_bytes(chunk_header[4:], byteorder='big')
+        offset += 8
+
+        if chunk_type != _SMF_TRACK:
+            fp.seek(chunk_length, os.SEEK_CUR)
+            offset += chunk_length
+            continue
+
+        track = _TrackReader(fp, chunk_length, chunk_size)
+
+        try:
+            yield from _iter_track_messages(track, offset, max_message_size)
+        except _TruncatedTrack:
+            track.skip_rest()
+
+        offset += chunk_length
+
+
+def _iter_chunks(stream, chunk_size: int) -> Iterator[bytes]:
+    if hasattr(stream, 'read'):
+        yield from iter(lambda: stream.read(chunk_size), b'')
+    else:
+        yield from stream
+
+
+def iter_messages(stream: Union[str, os.PathLike, BinaryIO, Iterable[bytes]], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                  max_message_size: Optional[int] = DEFAULT_MAX_MESSAGE_SIZE) -> Iterator[Tuple[int, bytes]]:
+    # Yields every SysEx message in the stream, lazily, as (offset, message)
+    # pairs. stream can be a path, a binary file object or an iterable of
+    # byte chunks; Standard MIDI Files are recognized by their header.
+    if isinstance(stream, (str, os.PathLike)):
+        with open(stream, 'rb') as fp:
+            yield from iter_messages(fp, chunk_size, max_message_size)
+        return
+
+    if isinstance(stream, (bytes, bytearray, memoryview)):
+        stream = io.BytesIO(stream)
+
+    chunks = _iter_chunks(stream, chunk_size)
+    first_chunk = next(chunks, b'')
+
+    if first_chunk[:4] == _SMF_HEADER and hasattr(stream, 'seek'):
+        smf = cast(BinaryIO, stream)
+        base = smf.tell() - len(first_chunk)
+        smf.seek(base, os.SEEK_SET)
+        yield from _iter_smf_messages(smf, base, chunk_size, max_message_size)
+        return
+
+    splitter = SysExSplitter(max_message_size)
+
+    yield from splitter.feed(first_chunk)
+
+    for chunk in chunks:
+        yield from splitter.feed(chunk)